@@ -0,0 +1,207 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Per-alignment QC metrics of a BAM file as columns.
+
+The BAM is streamed once, the metrics of each alignment are written into preallocated NumPy
+arrays of BATCH_SIZE rows. Full batches are filtered with threshold expressions like
+'mapq>=20' or 'identity>0.9' and kept, so only passing rows are held in memory. Read IDs (and
+sequences, if requested) of the current batch are held as Python strings until the batch is
+filtered, sequences of passing alignments are handed to a callback per batch instead of being kept.
+The columns are written to a compressed NPZ file, or to a Parquet file if the output ends with
+.parquet and pyarrow is installed.
+
+Identity is 1 - NM / alignment columns (M, =, X, I and D bases), from =/X CIGAR operations if
+the NM tag is missing and NaN if neither is available. Read length includes hard clipped bases,
+clip_start and clip_end are the soft and hard clipped bases at the 5' and 3' end of the read.
+'''
+
+import operator
+import os
+import re
+import numpy as np
+import pysam
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from src.fastx_io import log
+from src.ids import ALIGNMENT_FORMATS
+
+BATCH_SIZE = 1 << 16
+
+COLUMNS = {
+    'flag' : np.uint16,
+    'reference_id' : np.int32,
+    'reference_start' : np.int64,
+    'mapq' : np.uint8,
+    'read_length' : np.int64,
+    'aligned_length' : np.int64,
+    'reference_length' : np.int64,
+    'clip_start' : np.int64,
+    'clip_end' : np.int64,
+    'identity' : np.float32,
+    'reverse' : np.bool_,
+    'mapped' : np.bool_,
+    'secondary' : np.bool_,
+    'supplementary' : np.bool_,
+    }
+
+OPERATORS = {
+    '>=' : operator.ge,
+    '<=' : operator.le,
+    '==' : operator.eq,
+    '!=' : operator.ne,
+    '>' : operator.gt,
+    '<' : operator.lt,
+    }
+
+# CIGAR operation indices of pysam get_cigar_stats
+MATCH, INS, DEL, SOFT_CLIP, HARD_CLIP, EQUAL, DIFF, NM = 0, 1, 2, 4, 5, 7, 8, 10
+
+def parseFilter(expression : str) -> tuple:
+    '''
+    Parses a threshold expression like 'mapq>=20' into (column, operator, value).
+    '''
+    match = re.fullmatch(r'\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*([-+.\w]+)\s*', expression)
+    assert match, f'Invalid filter {expression}, use e.g. mapq>=20 or identity>0.9'
+    column, op, value = match.groups()
+    assert column in COLUMNS, f'Unknown column {column} in filter {expression}, columns are {", ".join(COLUMNS)}'
+    if value.lower() in ('true', 'false'):
+        value = value.lower() == 'true'
+    return column, OPERATORS[op], float(value)
+
+def filterMask(columns : dict, filters : list, n : int) -> np.ndarray:
+    '''
+    Mask of the first n rows passing all filters, comparisons with NaN fail.
+    '''
+    mask = np.ones(n, dtype=bool)
+    for column, op, value in filters:
+        mask &= op(columns[column][:n], value)
+    return mask
+
+def clipping(read : pysam.AlignedSegment) -> tuple:
+    '''
+    Soft and hard clipped bases at the 5' and 3' end of the read.
+    '''
+    cigar = read.cigartuples
+    if not cigar:
+        return 0, 0
+    start = end = 0
+    for op, length in cigar:
+        if op not in (SOFT_CLIP, HARD_CLIP):
+            break
+        start += length
+    for op, length in reversed(cigar):
+        if op not in (SOFT_CLIP, HARD_CLIP):
+            break
+        end += length
+    return (end, start) if read.is_reverse else (start, end)
+
+def alignmentMetrics(bam : str, filters : list = None, batchSize : int = BATCH_SIZE, threads : int = 1, write = None) -> dict:
+    '''
+    Collects the metrics of all alignments passing the filters.
+
+    Parameters
+    ----------
+    bam : str
+        SAM/BAM file, - for stdin
+    filters : list = None
+        (column, operator, value) tuples of parseFilter
+    batchSize : int = BATCH_SIZE
+        rows per preallocated batch
+    threads : int = 1
+        BGZF decompression threads
+    write : callable = None
+        called with read_id and sequence of every passing alignment with a sequence, batch by batch while streaming
+
+    Returns
+    -------
+    metrics : dict
+        column name to array, read_id as bytes
+    '''
+    filters = filters or []
+    batch = {column : np.empty(batchSize, dtype=dtype) for column, dtype in COLUMNS.items()}
+    names = []
+    seqs = []
+    kept = {column : [] for column in ['read_id'] + list(COLUMNS)}
+    total = 0
+
+    def flush(n):
+        mask = filterMask(batch, filters, n)
+        kept['read_id'].append(np.array(names, dtype=bytes)[mask] if n else np.empty(0, dtype='S1'))
+        for column in COLUMNS:
+            kept[column].append(batch[column][:n][mask].copy())
+        if write is not None:
+            for name, seq, keep in zip(names, seqs, mask.tolist()):
+                if keep and seq is not None:
+                    write(name, seq)
+        names.clear()
+        seqs.clear()
+
+    mode = ALIGNMENT_FORMATS.get(os.path.splitext(bam)[1].lower(), 'rb')
+    with pysam.AlignmentFile(bam, mode, check_sq=False, threads=threads) as alignments:
+        i = 0
+        for read in alignments.fetch(until_eof=True):
+            mapped = not read.is_unmapped
+            stats = read.get_cigar_stats()[0] if mapped and read.cigartuples else None
+            names.append(read.query_name)
+            if write is not None:
+                seqs.append(read.query_sequence)
+            batch['flag'][i] = read.flag
+            batch['reference_id'][i] = read.reference_id
+            batch['reference_start'][i] = read.reference_start
+            batch['mapq'][i] = read.mapping_quality
+            batch['read_length'][i] = read.infer_read_length() or read.query_length
+            batch['aligned_length'][i] = read.query_alignment_length if mapped else 0
+            batch['reference_length'][i] = (read.reference_length or 0) if mapped else 0
+            batch['clip_start'][i], batch['clip_end'][i] = clipping(read) if mapped else (0, 0)
+            identity = np.nan
+            if stats is not None:
+                columns = stats[MATCH] + stats[INS] + stats[DEL] + stats[EQUAL] + stats[DIFF]
+                if columns and read.has_tag('NM'):
+                    identity = 1 - stats[NM] / columns
+                elif columns and stats[EQUAL] + stats[DIFF]:
+                    identity = stats[EQUAL] / columns
+            batch['identity'][i] = identity
+            batch['reverse'][i] = read.is_reverse
+            batch['mapped'][i] = mapped
+            batch['secondary'][i] = read.is_secondary
+            batch['supplementary'][i] = read.is_supplementary
+            i += 1
+            if i == batchSize:
+                flush(i)
+                total += i
+                i = 0
+        flush(i)
+        total += i
+    metrics = {column : np.concatenate(arrays) for column, arrays in kept.items()}
+    log(f'Kept metrics of {len(metrics["read_id"])} of {total} alignments')
+    return metrics
+
+def writeMetrics(metrics : dict, path : str) -> None:
+    '''
+    Writes the columns to a Parquet file if path ends with .parquet, else to a compressed NPZ file.
+    '''
+    if path.lower().endswith('.parquet'):
+        assert pyarrow is not None, 'Writing Parquet needs pyarrow, install it or write an .npz file'
+        table = pyarrow.table({column : values.astype(str) if column == 'read_id' else values for column, values in metrics.items()})
+        pyarrow.parquet.write_table(table, path)
+    else:
+        # np.savez appends .npz to other file names
+        with open(path, 'wb') as out:
+            np.savez_compressed(out, **metrics)
+
+def loadMetrics(path : str) -> dict:
+    if path.lower().endswith('.parquet'):
+        assert pyarrow is not None, 'Reading Parquet needs pyarrow'
+        table = pyarrow.parquet.read_table(path)
+        return {column : table.column(column).to_numpy() for column in table.column_names}
+    with np.load(path) as npz:
+        return {column : npz[column] for column in npz.files}
@@ -0,0 +1,156 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Processing many FASTX files (a directory or a glob, e.g. nanopore fastq_pass chunks) on a
+process pool in a single call.
+
+Files are handed to the workers in sorted order and results come back in the same order.
+Outputs are either written per file into an output directory, or every worker writes temporary
+part files that are appended to the final outputs in input order, so concatenated outputs do not
+depend on scheduling. Statistics returned by the workers are merged into one summary.
+'''
+
+import glob
+from multiprocessing import Pool
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from src.fastx_io import STDIO, formatFromPath
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+# statistics that are not summed up when merging
+MERGE = {
+    'longest' : max,
+    'shortest' : min,
+    'unseen' : lambda a, b : a & b,
+    }
+
+def isBatchInput(path : str) -> bool:
+    '''
+    True for a directory or a glob pattern that is not an existing file.
+    '''
+    return path != STDIO and (os.path.isdir(path) or (not os.path.exists(path) and GLOB_CHARS.search(path) is not None))
+
+def expandInputs(path : str) -> list:
+    '''
+    Returns the sorted FASTA/FASTQ files (also gzipped) in a directory or matching a glob.
+    '''
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in os.listdir(path)]
+        files = [file for file in files if os.path.isfile(file) and formatFromPath(file) is not None]
+    else:
+        files = [file for file in glob.glob(path) if os.path.isfile(file)]
+    assert files, f'No FASTA or FASTQ files found for {path}'
+    return sorted(files)
+
+def isOutputDir(path : str) -> bool:
+    return path != STDIO and (os.path.isdir(path) or path.endswith(os.sep))
+
+def perFileOutput(inPath : str, outDir : str, format : str = None, suffix : str = '') -> str:
+    '''
+    Output path in outDir with the basename of inPath, the extension is replaced if format is given.
+    Gzipped inputs give gzipped outputs.
+    '''
+    name = os.path.basename(inPath)
+    gz = name.lower().endswith('.gz')
+    if gz:
+        name = name[:-3]
+    stem, ext = os.path.splitext(name)
+    if format is not None:
+        ext = '.' + format
+    return os.path.join(outDir, stem + suffix + ext + ('.gz' if gz else ''))
+
+def mergeStats(stats : list) -> dict:
+    '''
+    Merges statistics dicts of all files, counts are summed up, see MERGE for the exceptions.
+    '''
+    merged = {}
+    for entry in stats:
+        for key, value in (entry or {}).items():
+            if key not in merged:
+                merged[key] = value
+            else:
+                merged[key] = MERGE.get(key, lambda a, b : a + b)(merged[key], value)
+    return merged
+
+def formatStats(stats : dict) -> str:
+    return ', '.join(f'{key}: {len(value) if isinstance(value, set) else value}' for key, value in stats.items())
+
+def _call(task : tuple):
+    function, args = task
+    return function(*args)
+
+def appendPart(part : str, out, skipLines : int = 0) -> None:
+    '''
+    Appends a part file to an opened binary output without its first skipLines lines and removes it.
+    '''
+    with open(part, 'rb') as p:
+        for _ in range(skipLines):
+            p.readline()
+        shutil.copyfileobj(p, out, 1 << 20)
+    os.remove(part)
+
+def runBatch(worker, args, inputs : list, outputs : list, processes : int = None, headerLines : list = None) -> list:
+    '''
+    Calls worker(args, inPath, *outPaths) for every input file on a process pool.
+
+    Parameters
+    ----------
+    worker : function
+        module level function processing one file and returning a statistics dict
+    args : Namespace
+        passed to every call
+    inputs : list
+        input files
+    outputs : list
+        final output paths (- for stdout) the outputs of all files are concatenated into in
+        input order, or a list of functions mapping an input path to its own output paths
+    processes : int = None
+        number of worker processes, number of CPUs if None
+    headerLines : list = None
+        number of header lines per output that are only kept from the first file, e.g. 1 for CSV
+
+    Returns
+    -------
+    stats : list
+        statistics of every file in input order
+    '''
+    headerLines = headerLines or [0] * len(outputs)
+    processes = min(processes or os.cpu_count() or 1, len(inputs))
+
+    if all(callable(output) for output in outputs):
+        tasks = [(worker, (args, inPath, *(output(inPath) for output in outputs))) for inPath in inputs]
+        with Pool(processes) as pool:
+            return list(pool.imap(_call, tasks))
+
+    tmpDir = os.path.dirname(os.path.abspath(outputs[0])) if outputs[0] != STDIO else None
+    handles = [sys.stdout.buffer if output == STDIO else open(output, 'wb') for output in outputs]
+    stats = []
+    try:
+        with tempfile.TemporaryDirectory(dir=tmpDir, prefix='.batch_') as tmp:
+
+            def parts(idx):
+                # keep the extensions, so workers detect format and compression from the part paths
+                names = [os.path.basename(output) if output != STDIO else re.sub(r'\.gz$', '', os.path.basename(inputs[idx]), flags=re.I) for output in outputs]
+                return [os.path.join(tmp, f'part_{idx:06d}_{o}_{name}') for o, name in enumerate(names)]
+
+            tasks = [(worker, (args, inPath, *parts(idx))) for idx, inPath in enumerate(inputs)]
+            with Pool(processes) as pool:
+                for idx, result in enumerate(pool.imap(_call, tasks)):
+                    for o, (part, handle) in enumerate(zip(parts(idx), handles)):
+                        appendPart(part, handle, headerLines[o] if idx else 0)
+                    stats.append(result)
+    finally:
+        for handle in handles:
+            if handle is sys.stdout.buffer:
+                handle.flush()
+            else:
+                handle.close()
+    return stats
@@ -0,0 +1,108 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Checkpoints and part files shared by watch mode, resumable single-file runs and split_fastx.
+
+A Checkpoint is a JSON file of processed input files (watch mode) or the progress in one input
+(resume.py) together with the sizes of the outputs, replaced atomically on save. Outputs are
+written through part files next to them that are appended, copyRange copies byte ranges between
+files inside the kernel where possible.
+'''
+
+import json
+import os
+
+from src.fastx_io import log
+
+COPY_CHUNK = 1 << 30
+
+class Checkpoint:
+    '''
+    Processed files with their size and modification time and the sizes of the concatenated outputs.
+    Long single-file runs store their progress in the input instead of processed files.
+    '''
+
+    def __init__(self, path : str) -> None:
+        self.path = path
+        self.files = {}
+        self.outputs = {}
+        self.progress = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as state:
+                content = json.load(state)
+            self.files = content['files']
+            self.outputs = content['outputs']
+            self.progress = content.get('progress', {})
+
+    def isDone(self, file : str) -> bool:
+        return os.path.abspath(file) in self.files
+
+    def markDone(self, file : str, stat : os.stat_result, outputs : dict) -> None:
+        self.files[os.path.abspath(file)] = {'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns}
+        self.outputs.update(outputs)
+
+    def markProgress(self, progress : dict, outputs : dict) -> None:
+        self.progress = progress
+        self.outputs.update(outputs)
+
+    def save(self) -> None:
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as state:
+            json.dump({'files' : self.files, 'outputs' : self.outputs, 'progress' : self.progress}, state)
+            state.flush()
+            os.fsync(state.fileno())
+        os.replace(tmp, self.path)
+
+    def restore(self, outputs : list) -> None:
+        '''
+        Truncates outputs to their checkpointed size, removing parts appended after the last checkpoint.
+        '''
+        for output in outputs:
+            size = self.outputs.get(os.path.abspath(output), 0)
+            if os.path.isfile(output) and os.path.getsize(output) > size:
+                log(f'Truncating {output} to the last checkpoint ({size} bytes)')
+                with open(output, 'r+b') as out:
+                    out.truncate(size)
+
+def partPath(output : str) -> str:
+    '''
+    Temporary file next to the output with the same extensions.
+    '''
+    directory, name = os.path.split(output)
+    return os.path.join(directory, f'.part_{os.getpid()}_{name}')
+
+def copyRange(src : int, dst : int, start : int, length : int) -> None:
+    '''
+    Copies length bytes from position start of file descriptor src to the current position of dst,
+    inside the kernel if possible.
+    '''
+    offset = start
+    end = start + length
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(src, dst, min(COPY_CHUNK, end - offset), offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            pass
+    if offset < end and hasattr(os, 'sendfile'):
+        try:
+            while offset < end:
+                sent = os.sendfile(dst, src, offset, min(COPY_CHUNK, end - offset))
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            pass
+    while offset < end:
+        chunk = os.pread(src, min(1 << 20, end - offset), offset)
+        if not chunk:
+            break
+        os.write(dst, chunk)
+        offset += len(chunk)
+    assert offset == end, f'Could only copy {offset - start} of {length} bytes'
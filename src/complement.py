@@ -8,6 +8,9 @@ import os
 from Bio import SeqIO
 from Bio.Seq import Seq
 
+from src.twobit import parseFasta
+from src.fastx_io import STDIO, formatFromPath, openInput, openOutput
+
 COMPLEMENT_DNA = {
     'A':'T',
     'C':'G',
@@ -52,9 +55,10 @@ def parse() -> Namespace:
         formatter_class=ArgumentDefaultsHelpFormatter,
         add_help='Translate nucleotide sequences to its complement'
     )
-    parser.add_argument('sequences', help='Input sequence separated with "," or fasta file')
+    parser.add_argument('sequences', help='Input sequence separated with "," or fasta file, - to read fasta from stdin and write to stdout')
     parser.add_argument('--reverse', action='store_true', help='Use to print 3\'->5\' sequence.')
     parser.add_argument('--rna', action='store_true', help='Translate RNA sequences')
+    parser.add_argument('--no_cache', action='store_true', help='Do not create or read the 2-bit sequence cache of the fasta file')
     return parser.parse_args()
 
 def main() -> None:
@@ -63,19 +67,27 @@ def main() -> None:
     rev : bool = args.reverse
     rna : bool = args.rna
 
-    if inp.endswith('.fa') or inp.endswith('.fasta'):
-        assert os.path.exists(inp) and os.path.isfile(inp)
-        outfile = os.path.join(f'{os.path.splitext(inp)[0]}_reverse-complement{os.path.splitext(inp)[1]}') if rev else os.path.join(f'{os.path.splitext(inp)[0]}_complement{os.path.splitext(inp)[1]}')
+    if inp == STDIO or formatFromPath(inp) == 'fasta':
+        if inp == STDIO:
+            outfile = STDIO
+            handle, _ = openInput(inp, 'fasta')
+            inrecords = SeqIO.parse(handle, 'fasta')
+        else:
+            assert os.path.exists(inp) and os.path.isfile(inp)
+            outfile = os.path.join(f'{os.path.splitext(inp)[0]}_reverse-complement{os.path.splitext(inp)[1]}') if rev else os.path.join(f'{os.path.splitext(inp)[0]}_complement{os.path.splitext(inp)[1]}')
+            inrecords = parseFasta(inp, not args.no_cache)
         records = []
 
-        for rec in SeqIO.parse(inp, 'fasta'):
+        for rec in inrecords:
             c = complement(rec.seq, rna)
             rec.seq = Seq(c[::-1]) if rev else Seq(c)
             rec.id += '_reverse-complement' if rev else '_complement'
             records.append(rec)
             rec.description = ''
 
-        SeqIO.write(records, outfile, 'fasta')
+        out, _ = openOutput(outfile, 'fasta')
+        SeqIO.write(records, out, 'fasta')
+        out.close()
 
     else:
         for seq in inp.split(','):
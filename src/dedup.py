@@ -0,0 +1,214 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Streaming removal of exact duplicate reads by sequence or by read ID.
+
+Only 64 or 128 bit digests of the seen keys are kept in memory, in a NumPy open addressing
+table (DigestSet) of 8 or 16 bytes per slot that is at most 3/4 full, so about 11 to 21 bytes
+per distinct read for 64 bit digests and 21 to 43 bytes for 128 bit digests. For inputs with more distinct
+reads than fit into memory, the partitioned mode spills (digest, read index) pairs into
+partition files on disk, finds the duplicates per partition and streams the input a second
+time to write the first occurrence of every read.
+'''
+
+from hashlib import blake2b
+import heapq
+import os
+import tempfile
+import numpy as np
+
+KEYS = ['sequence', 'id']
+MASK64 = (1 << 64) - 1
+
+def dedupKey(record : tuple, by : str) -> bytes:
+    '''
+    Key of a raw (header, sequence, quality) record.
+    '''
+    if by == 'sequence':
+        return record[1]
+    return record[0].split(maxsplit=1)[0] if record[0] else b''
+
+def digest(key : bytes, bits : int = 64) -> int:
+    return int.from_bytes(blake2b(key, digest_size=bits // 8).digest(), 'little')
+
+class DigestSet:
+    '''
+    Set of 64 or 128 bit digests in NumPy arrays with open addressing and linear probing.
+    The digests are uniformly distributed, so their low bits are the slot. A low word of 0 marks
+    an empty slot, digests with a low word of 0 are stored with 1 instead.
+    '''
+
+    def __init__(self, bits : int = 64, capacity : int = 1 << 16) -> None:
+        assert bits in (64, 128), 'Digests have 64 or 128 bits'
+        assert capacity > 0 and capacity & (capacity - 1) == 0, 'Capacity has to be a power of 2'
+        self.bits = bits
+        self.size = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity : int) -> None:
+        self.mask = capacity - 1
+        self.lo = np.zeros(capacity, dtype=np.uint64)
+        self.hi = np.zeros(capacity, dtype=np.uint64) if self.bits == 128 else None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, d : int) -> bool:
+        '''
+        Adds the digest, returns False if it was already in the set.
+        '''
+        lo = d & MASK64 or 1
+        hi = d >> 64
+        i = lo & self.mask
+        while True:
+            slot = self.lo.item(i)
+            if slot == 0:
+                break
+            if slot == lo and (self.hi is None or self.hi.item(i) == hi):
+                return False
+            i = (i + 1) & self.mask
+        self.lo[i] = lo
+        if self.hi is not None:
+            self.hi[i] = hi
+        self.size += 1
+        if 4 * self.size > 3 * len(self.lo):
+            self._grow()
+        return True
+
+    def _grow(self) -> None:
+        '''
+        Doubles the table and inserts all digests again, in rounds that place every digest whose
+        current slot is empty (the first of them per slot) and move the others one slot on.
+        '''
+        full = self.lo != 0
+        lo = self.lo[full]
+        hi = self.hi[full] if self.hi is not None else None
+        self._allocate(2 * len(self.lo))
+        pending = np.arange(len(lo))
+        slots = (lo & np.uint64(self.mask)).astype(np.int64)
+        while len(pending):
+            free = self.lo[slots] == 0
+            _, first = np.unique(slots[free], return_index=True)
+            placed = np.flatnonzero(free)[first]
+            self.lo[slots[placed]] = lo[pending[placed]]
+            if hi is not None:
+                self.hi[slots[placed]] = hi[pending[placed]]
+            waiting = np.ones(len(pending), dtype=bool)
+            waiting[placed] = False
+            pending = pending[waiting]
+            slots = (slots[waiting] + 1) & self.mask
+
+def newStats() -> dict:
+    return {'reads' : 0, 'unique' : 0}
+
+def dedupRecords(records, by : str = 'sequence', bits : int = 64, stats : dict = None):
+    '''
+    Yields the first occurrence of every read, keeping the key digests in a DigestSet in memory,
+    about 11 to 21 bytes per distinct read for 64 bit digests and twice that for 128 bits.
+
+    Parameters
+    ----------
+    records : iterable
+        raw (header, sequence, quality) records
+    by : str = 'sequence'
+        'sequence' or 'id'
+    bits : int = 64
+        digest size, 128 bits make collisions negligible for billions of reads
+    stats : dict = None
+        counts of 'reads' and 'unique' reads are updated in this dict
+    '''
+    stats = newStats() if stats is None else stats
+    seen = DigestSet(bits)
+    for record in records:
+        stats['reads'] += 1
+        if not seen.add(digest(dedupKey(record, by), bits)):
+            continue
+        stats['unique'] += 1
+        yield record
+
+def _digestType(bits : int) -> np.dtype:
+    return np.dtype([('hi', '<u8'), ('lo', '<u8'), ('idx', '<u8')]) if bits == 128 else np.dtype([('lo', '<u8'), ('idx', '<u8')])
+
+def _duplicateIndices(path : str, dtype : np.dtype) -> np.ndarray:
+    '''
+    Sorted read indices of a partition file that are not the first occurrence of their digest.
+    '''
+    entries = np.fromfile(path, dtype=dtype)
+    if not len(entries):
+        return np.zeros(0, dtype=np.uint64)
+    keys = [entries['idx'], entries['lo']] + ([entries['hi']] if 'hi' in dtype.names else [])
+    order = np.lexsort(keys)
+    entries = entries[order]
+    same = entries['lo'][1:] == entries['lo'][:-1]
+    if 'hi' in dtype.names:
+        same &= entries['hi'][1:] == entries['hi'][:-1]
+    return np.sort(entries['idx'][1:][same])
+
+def dedupPartitioned(openRecords, by : str = 'sequence', bits : int = 64, partitions : int = 64, tmpDir : str = None, stats : dict = None):
+    '''
+    Yields the first occurrence of every read with bounded memory, using partition files on disk.
+
+    Parameters
+    ----------
+    openRecords : function
+        returns a new iterator over the raw records, it is called twice
+    by : str = 'sequence'
+        'sequence' or 'id'
+    bits : int = 64
+        digest size, 64 or 128
+    partitions : int = 64
+        number of partition files, each has to fit into memory when sorted
+    tmpDir : str = None
+        directory for the partition files
+    stats : dict = None
+        counts of 'reads' and 'unique' reads are updated in this dict
+    '''
+    stats = newStats() if stats is None else stats
+    dtype = _digestType(bits)
+    with tempfile.TemporaryDirectory(dir=tmpDir, prefix='dedup_') as tmp:
+        paths = [os.path.join(tmp, f'part_{p}.bin') for p in range(partitions)]
+        buffers = [[] for _ in range(partitions)]
+        files = [open(path, 'wb') for path in paths]
+
+        def flush(p):
+            np.array(buffers[p], dtype=dtype).tofile(files[p])
+            buffers[p].clear()
+
+        try:
+            for idx, record in enumerate(openRecords()):
+                d = digest(dedupKey(record, by), bits)
+                p = d % partitions
+                lo = d & MASK64
+                buffers[p].append((d >> 64, lo, idx) if bits == 128 else (lo, idx))
+                if len(buffers[p]) >= 65536:
+                    flush(p)
+            for p in range(partitions):
+                flush(p)
+        finally:
+            for f in files:
+                f.close()
+
+        duplicates = []
+        for p, path in enumerate(paths):
+            dups = _duplicateIndices(path, dtype)
+            os.remove(path)
+            dupPath = path + '.dup.npy'
+            np.save(dupPath, dups)
+            duplicates.append(np.load(dupPath, mmap_mode='r'))
+
+        skip = heapq.merge(*(iter(dups) for dups in duplicates))
+        nextSkip = next(skip, None)
+        for idx, record in enumerate(openRecords()):
+            stats['reads'] += 1
+            if nextSkip is not None and idx == nextSkip:
+                nextSkip = next(skip, None)
+                continue
+            stats['unique'] += 1
+            yield record
+        del duplicates, skip
+
+def duplicationRate(stats : dict) -> float:
+    return 1 - stats['unique'] / stats['reads'] if stats['reads'] else 0.0
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Entry point for subcommands working on FASTA/FASTQ files.
+'''
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+import os
+from Bio import SeqIO
+
+from src.fastx_io import STDIO, BATCH_SIZE, QUEUE_DEPTH, openInput, openOutput, readAhead, writeBehind, log
+from src.pipeline import buildPipeline, runPipeline
+from src.stats import lengthStats, output
+from src.sort_fastx import SORT_KEYS, MEMORY, sortOutput
+from src.split_fastx import splitOutput
+from src.serve import CACHE_MB, serve, request, parseRegion
+from src.ids import iterIDs
+
+def parse() -> Namespace:
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description='Tools for FASTA and FASTQ files'
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', formatter_class=ArgumentDefaultsHelpFormatter, help='Run a pipeline of stages over the records in one pass')
+    run.add_argument('inFastx', type=str, help='Fastx file to read records from, - for stdin')
+    run.add_argument('pipeline', type=str, help='Stages separated by "|", e.g. "length>=1000 | ids:keep.txt | slice:1-500 | revcomp"')
+    run.add_argument('outFastx', type=str, help='Fastx file to write records to, - for stdout')
+    run.add_argument('-f', '--force', action='store_true', help='Force output overwrite')
+    run.add_argument('--format', choices=['fasta', 'fastq'], default=None, help='Input format, detected from file extension or first byte if not set')
+    run.add_argument('--out_format', choices=['fasta', 'fastq'], default=None, help='Output format, taken from file extension or input format if not set')
+    run.add_argument('--pipelined', action='store_true', help='Read and write on separate threads while the stages run on the main thread')
+    run.add_argument('--batch_size', type=int, default=BATCH_SIZE, help='Number of records per batch handed between threads in --pipelined mode')
+    run.add_argument('--queue_depth', type=int, default=QUEUE_DEPTH, help='Number of batches or compressed chunks buffered between threads')
+
+    stats = sub.add_parser('stats', formatter_class=ArgumentDefaultsHelpFormatter, help='Read length statistics (N50, quantiles, histogram) in one pass')
+    stats.add_argument('inFastx', type=str, help='Fastx file, - for stdin')
+    stats.add_argument('--format', choices=['fasta', 'fastq'], default=None, help='Input format, detected from file extension or first byte if not set')
+    stats.add_argument('--exact', action='store_true', help='Count every distinct read length for exact N50 and quantiles instead of ~1%% wide bins')
+    stats.add_argument('--no_index', action='store_true', help='Do not read lengths from an existing <inFastx>.fai index')
+    stats.add_argument('--bins_per_octave', type=int, default=2, choices=[1, 2, 4, 8, 16], help='Histogram bins per doubling of read length')
+
+    sort = sub.add_parser('sort', formatter_class=ArgumentDefaultsHelpFormatter, help='Sort records by ID, length or mean quality with bounded memory (external merge sort)')
+    sort.add_argument('inFastx', type=str, help='Fastx file, - for stdin')
+    sort.add_argument('outFastx', type=str, help='Sorted fastx file, - for stdout')
+    sort.add_argument('-k', '--key', choices=SORT_KEYS, default='id', help='Sort by read ID (ascending, byte order), length or mean quality (both descending)')
+    sort.add_argument('-r', '--reverse', action='store_true', help='Reverse the sort order')
+    sort.add_argument('-m', '--memory', type=int, default=MEMORY, help='Memory budget for records in MB, larger inputs are spilled to sorted runs on disk')
+    sort.add_argument('--tmp_dir', type=str, default=None, help='Directory for the sorted runs, needs about the size of the uncompressed input, defaults to the output directory')
+    sort.add_argument('-f', '--force', action='store_true', help='Force output overwrite')
+    sort.add_argument('--format', choices=['fasta', 'fastq'], default=None, help='Input format, detected from file extension or first byte if not set')
+    sort.add_argument('--out_format', choices=['fasta', 'fastq'], default=None, help='Output format, taken from file extension or input format if not set')
+
+    split = sub.add_parser('split', formatter_class=ArgumentDefaultsHelpFormatter, help='Split an uncompressed fastx file at record boundaries without parsing it')
+    split.add_argument('inFastx', type=str, help='Uncompressed fastx file')
+    split.add_argument('outDir', type=str, help='Directory for the parts and the manifest <prefix>.manifest.tsv')
+    size = split.add_mutually_exclusive_group(required=True)
+    size.add_argument('-n', '--parts', type=int, default=None, help='Number of parts of about equal size')
+    size.add_argument('-b', '--bytes', type=str, default=None, help='Target size of the parts, e.g. 500M or 2G')
+    size.add_argument('-r', '--records', type=int, default=None, help='Number of records per part')
+    split.add_argument('--prefix', type=str, default=None, help='Name of the parts before .part_<i>, input file name without extension if not set')
+    split.add_argument('--format', choices=['fasta', 'fastq'], default=None, help='Input format, detected from file extension or first byte if not set')
+
+    server = sub.add_parser('serve', formatter_class=ArgumentDefaultsHelpFormatter, help='Serve reads of an uncompressed fastx file by ID or region on a local UNIX socket')
+    server.add_argument('inFastx', type=str, help='Uncompressed fastx file, indexed into <inFastx>.fxi on first use')
+    server.add_argument('-s', '--socket', type=str, default=None, help='Path of the UNIX socket, <inFastx>.sock if not set')
+    server.add_argument('--cache_mb', type=int, default=CACHE_MB, help='Memory cap of the cache of recently fetched reads in MB')
+    server.add_argument('--format', choices=['fasta', 'fastq'], default=None, help='Input format, detected from file extension or first byte if not set')
+
+    fetch = sub.add_parser('fetch', formatter_class=ArgumentDefaultsHelpFormatter, help='Fetch reads or regions from a running fastx serve')
+    fetch.add_argument('socket', type=str, help='UNIX socket of the server')
+    fetch.add_argument('outFastx', type=str, help='Fastx file to write the reads to, - for stdout')
+    what = fetch.add_mutually_exclusive_group(required=True)
+    what.add_argument('-i', '--read_ids', metavar='IDS', type=str, default=None, help='ID list, FASTA, FASTQ or BAM file with the read IDs to fetch')
+    what.add_argument('-r', '--region', type=str, nargs='+', default=None, help='Regions ID:START-END (1-based, inclusive) or whole reads ID')
+
+    return parser.parse_args()
+
+def run(args : Namespace) -> None:
+    inFastx = args.inFastx
+    outFastx = args.outFastx
+    assert args.force or outFastx == STDIO or not os.path.exists(outFastx), f'{outFastx} already exists!'
+
+    inp, informat = openInput(inFastx, args.format, args.queue_depth)
+    files = [inp]
+    try:
+        stages = buildPipeline(args.pipeline, informat, files)
+        out, outformat = openOutput(outFastx, args.out_format, depth=args.queue_depth)
+        files.append(out)
+        if args.pipelined:
+            records = runPipeline(readAhead(SeqIO.parse(inp, informat), args.batch_size, args.queue_depth), stages)
+            written = writeBehind(records, out, outformat or informat, args.batch_size, args.queue_depth)
+        else:
+            written = SeqIO.write(runPipeline(SeqIO.parse(inp, informat), stages), out, outformat or informat)
+    finally:
+        for file in files:
+            file.close()
+    log(f'Wrote {written} records to {outFastx}')
+
+def main() -> None:
+    args = parse()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'stats':
+        output(lengthStats(args.inFastx, args.format, args.exact, not args.no_index), args.bins_per_octave)
+    elif args.command == 'sort':
+        sortOutput(args.inFastx, args.outFastx, args.key, args.reverse, args.memory, args.tmp_dir, args.format, args.out_format, args.force)
+    elif args.command == 'serve':
+        serve(args.inFastx, args.socket or args.inFastx + '.sock', args.cache_mb, args.format)
+    elif args.command == 'fetch':
+        payload = {'ids' : list(iterIDs(args.read_ids))} if args.read_ids is not None else {'regions' : [parseRegion(region) for region in args.region]}
+        header, data = request(args.socket, payload)
+        out, _ = openOutput(args.outFastx)
+        with out:
+            out.buffer.write(data)
+        log(f'Fetched {header["found"]} reads from {header["path"]}, missing: {len(header["missing"])}')
+    elif args.command == 'split':
+        splitOutput(args.inFastx, args.outDir, args.parts, args.bytes, args.records, args.format, args.prefix)
+
+if __name__ == '__main__':
+    main()
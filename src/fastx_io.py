@@ -0,0 +1,362 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Opening FASTA/FASTQ files, stdin and stdout for the scripts.
+A path of '-' reads from stdin or writes to stdout. If the format is neither given
+nor known from the file extension, it is detected from the first byte ('>' or '@').
+
+Gzip compressed input is detected by its magic bytes, output is compressed if the path ends
+with .gz. Compression and decompression run on their own threads. readAhead and writeBehind
+overlap parsing and writing of records with the work done on the main thread.
+'''
+
+import io
+import os
+import sys
+import zlib
+from queue import Full, Queue
+from threading import Event, Thread
+from Bio import SeqIO
+
+STDIO = '-'
+BUFFER_SIZE = 1 << 20
+BATCH_SIZE = 1000
+QUEUE_DEPTH = 4
+GZIP_MAGIC = b'\x1f\x8b'
+# seconds a blocked producer waits before checking if the consumer stopped
+PUT_TIMEOUT = 0.1
+
+FORMATS = {
+    '.fa' : 'fasta',
+    '.fasta' : 'fasta',
+    '.fq' : 'fastq',
+    '.fastq' : 'fastq',
+    }
+
+FIRST_BYTE = {
+    b'>' : 'fasta',
+    b'@' : 'fastq',
+    }
+
+def formatFromPath(path : str) -> str:
+    '''
+    Returns 'fasta' or 'fastq' by the file extension, None if unknown or stdin/stdout.
+    '''
+    if path == STDIO:
+        return None
+    root, ext = os.path.splitext(path)
+    if ext.lower() == '.gz':
+        ext = os.path.splitext(root)[1]
+    return FORMATS.get(ext.lower())
+
+def sniffFormat(raw : io.BufferedReader) -> str:
+    '''
+    Detects the format from the first non-whitespace byte without consuming the stream.
+    Returns None if the stream is empty or the first byte is unknown.
+    '''
+    head = raw.peek(BUFFER_SIZE).lstrip()
+    return FIRST_BYTE.get(head[:1])
+
+def _put(queue : Queue, item, stop : Event) -> bool:
+    '''
+    Puts item into a bounded queue, gives up if stop is set while the queue is full.
+    Returns False if the consumer stopped.
+    '''
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=PUT_TIMEOUT)
+            return True
+        except Full:
+            pass
+    return False
+
+class _QueueReader(io.RawIOBase):
+    '''
+    Readable stream over chunks of bytes that are put into a queue by another thread.
+    None marks the end of the stream, an exception is raised in the reading thread.
+    Closing sets stop, so the producing thread ends and closes raw.
+    '''
+
+    def __init__(self, chunks : Queue, stop : Event) -> None:
+        self.chunks = chunks
+        self.stop = stop
+        self.chunk = memoryview(b'')
+        self.eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not len(self.chunk):
+            if self.eof:
+                return 0
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+                return 0
+            if isinstance(chunk, BaseException):
+                raise chunk
+            self.chunk = memoryview(chunk)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self) -> None:
+        self.stop.set()
+        super().close()
+
+class _QueueWriter(io.RawIOBase):
+    '''
+    Writable stream that hands the written bytes to a compression thread.
+    '''
+
+    def __init__(self, raw, level : int = 6, depth : int = QUEUE_DEPTH) -> None:
+        self.raw = raw
+        self.chunks = Queue(maxsize=depth)
+        self.errors = []
+        self.thread = Thread(target=self._compress, args=(level,), daemon=True)
+        self.thread.start()
+
+    def _compress(self, level : int) -> None:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if self.errors:
+                continue
+            try:
+                self.raw.write(compressor.compress(chunk))
+            except BaseException as e:
+                self.errors.append(e)
+        if not self.errors:
+            self.raw.write(compressor.flush())
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        if self.errors:
+            raise self.errors[0]
+        self.chunks.put(bytes(b))
+        return len(b)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.chunks.put(None)
+        self.thread.join()
+        self.raw.close()
+        super().close()
+        if self.errors:
+            raise self.errors[0]
+
+def _decompress(raw, chunks : Queue, stop : Event) -> None:
+    '''
+    Decompresses (multi-member) gzip data from raw into the queue, until the end or until stop is set.
+    '''
+    try:
+        decompressor = zlib.decompressobj(47)
+        while True:
+            data = raw.read(BUFFER_SIZE)
+            if not data:
+                break
+            while data:
+                out = decompressor.decompress(data)
+                if out and not _put(chunks, out, stop):
+                    return
+                data = b''
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(47)
+        _put(chunks, None, stop)
+    except BaseException as e:
+        _put(chunks, e, stop)
+    finally:
+        raw.close()
+
+def log(*args, **kwargs) -> None:
+    '''
+    Prints status messages to stderr, stdout might be used for records.
+    '''
+    print(*args, file=sys.stderr, **kwargs)
+
+def openInput(path : str, format : str = None, depth : int = QUEUE_DEPTH) -> tuple:
+    '''
+    Opens a FASTX file or stdin for reading, gzip input is decompressed on a separate thread.
+
+    Parameters
+    ----------
+    path : str
+        file path or '-' for stdin
+    format : str = None
+        'fasta' or 'fastq', detected if None
+    depth : int = QUEUE_DEPTH
+        number of decompressed chunks buffered ahead
+
+    Returns
+    -------
+    handle : TextIOWrapper
+        text handle to pass to SeqIO.parse
+    format : str
+        'fasta' or 'fastq'
+    '''
+    if path == STDIO:
+        raw = open(sys.stdin.fileno(), 'rb', buffering=BUFFER_SIZE, closefd=False)
+    else:
+        raw = open(path, 'rb', buffering=BUFFER_SIZE)
+    if raw.peek(2)[:2] == GZIP_MAGIC:
+        chunks = Queue(maxsize=depth)
+        stop = Event()
+        Thread(target=_decompress, args=(raw, chunks, stop), daemon=True).start()
+        raw = io.BufferedReader(_QueueReader(chunks, stop), BUFFER_SIZE)
+    format = format or formatFromPath(path) or sniffFormat(raw)
+    if format is None:
+        raw.close()
+        raise ValueError(f'Unknown format of {"stdin" if path == STDIO else path}, must start with ">" or "@" or use .fa/.fasta or .fq/.fastq')
+    return io.TextIOWrapper(raw), format
+
+def openOutput(path : str, format : str = None, append : bool = False, depth : int = QUEUE_DEPTH) -> tuple:
+    '''
+    Opens a FASTX file or stdout for writing with a large buffer.
+    Paths ending with .gz are compressed on a separate thread.
+
+    Parameters
+    ----------
+    path : str
+        file path or '-' for stdout
+    format : str = None
+        'fasta' or 'fastq', taken from the file extension if None
+    append : bool = False
+        append to an existing file, for .gz a new gzip member is appended
+    depth : int = QUEUE_DEPTH
+        number of chunks buffered for the compression thread
+
+    Returns
+    -------
+    handle : TextIOWrapper
+        text handle to pass to SeqIO.write
+    format : str
+        'fasta' or 'fastq', None if unknown
+    '''
+    if path == STDIO:
+        sys.stdout.flush()
+        handle = open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE, closefd=False)
+    elif path.lower().endswith('.gz'):
+        raw = _QueueWriter(open(path, 'ab' if append else 'wb'), depth=depth)
+        handle = io.TextIOWrapper(io.BufferedWriter(raw, BUFFER_SIZE))
+    else:
+        handle = open(path, 'a' if append else 'w', buffering=BUFFER_SIZE)
+    return handle, format or formatFromPath(path)
+
+def readAhead(records, batchSize : int = BATCH_SIZE, depth : int = QUEUE_DEPTH):
+    '''
+    Parses records on a reader thread and yields them on the calling thread.
+    If the caller stops iterating early (break, close or garbage collection), the reader thread stops too.
+
+    Parameters
+    ----------
+    records : iterable
+        records, e.g. from SeqIO.parse
+    batchSize : int = BATCH_SIZE
+        number of records handed over at once
+    depth : int = QUEUE_DEPTH
+        number of batches buffered ahead
+    '''
+    batches = Queue(maxsize=depth)
+    stop = Event()
+
+    def read():
+        try:
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) >= batchSize:
+                    if not _put(batches, batch, stop):
+                        return
+                    batch = []
+            if _put(batches, batch, stop):
+                _put(batches, None, stop)
+        except BaseException as e:
+            _put(batches, e, stop)
+
+    thread = Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
+
+def writeBehind(records, handle, format : str, batchSize : int = BATCH_SIZE, depth : int = QUEUE_DEPTH, write = SeqIO.write) -> int:
+    '''
+    Writes records on a writer thread while the calling thread produces them.
+
+    Parameters
+    ----------
+    records : iterable
+        records to write, consumed on the calling thread
+    handle : TextIOWrapper
+        opened output
+    format : str
+        'fasta' or 'fastq'
+    batchSize : int = BATCH_SIZE
+        number of records handed over at once
+    depth : int = QUEUE_DEPTH
+        number of batches buffered for writing
+    write = SeqIO.write
+        function called with (list of records, handle, format) on the writer thread
+
+    Returns
+    -------
+    written : int
+        number of written records
+    '''
+    batches = Queue(maxsize=depth)
+    errors = []
+    # set by the writer on errors and by the caller when it stops
+    stop = Event()
+
+    def writer():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            try:
+                write(batch, handle, format)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                return
+
+    thread = Thread(target=writer, daemon=True)
+    thread.start()
+    written = 0
+    batch = []
+    try:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batchSize:
+                if not _put(batches, batch, stop):
+                    break
+                written += len(batch)
+                batch = []
+        if batch and _put(batches, batch, stop):
+            written += len(batch)
+    finally:
+        _put(batches, None, stop)
+        stop.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+    return written
@@ -9,17 +9,23 @@ from io import TextIOWrapper
 import pysam
 
 from src.filter_fastx import filterLength
+from src.fastx_io import STDIO, openOutput, log
+from src.bam_metrics import COLUMNS, parseFilter, alignmentMetrics, writeMetrics
 
 def parse() -> Namespace:
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter,
-        description='Filter bam file for read lengths and write them to a fasta file, fastq not available yet'
+        description='Filter bam file for read lengths and write them to a fasta file, fastq not available yet. Export per-alignment metrics with --metrics.'
     )
-    parser.add_argument('-b', '--bam', type=str, help='Mapping bam file', required=True)
-    mode = parser.add_mutually_exclusive_group(required=True)
+    parser.add_argument('-b', '--bam', type=str, help='Mapping bam file, - for stdin', required=True)
+    mode = parser.add_mutually_exclusive_group()
     mode.add_argument('-l', '--long', metavar='LENGTH', type=int, default=None, help='Filter BAM file for reads given length or longer')
     mode.add_argument('-s', '--short', metavar='LENGTH', type=int, default=None, help='Filter BAM file for reads given length or shorter')
-    parser.add_argument('-o', '--outfile', type=str, help='fasta file to write reads to', required=True)
+    parser.add_argument('-o', '--outfile', type=str, default=None, help='fasta file to write reads to, - for stdout')
+    metrics = parser.add_argument_group('metrics mode', f'Per-alignment metrics as columns: read_id, {", ".join(COLUMNS)}')
+    metrics.add_argument('-m', '--metrics', type=str, default=None, help='Write the metrics of passing alignments to this .npz file, or .parquet file if pyarrow is installed')
+    metrics.add_argument('-f', '--filter', type=str, nargs='+', default=[], help='Threshold filters on metric columns, all have to pass, e.g. "mapq>=20" "identity>0.9" "secondary==0"')
+    metrics.add_argument('-t', '--threads', type=int, default=1, help='Number of BGZF decompression threads')
     return parser.parse_args()
 
 def main() -> None:
@@ -28,11 +34,21 @@ def main() -> None:
     long=args.long
     short=args.short
     outfile=args.outfile
-    print(f'Analysing {bam}')
+    log(f'Analysing {bam}')
 
-    assert outfile.lower().endswith('.fa') or outfile.lower().endswith('.fasta')
+    assert outfile is not None or args.metrics is not None, 'Give an outfile, a metrics file or both'
+    assert outfile is None or outfile == STDIO or outfile.lower().endswith('.fa') or outfile.lower().endswith('.fasta')
+    assert args.metrics is not None or args.filter or long is not None or short is not None, 'Give a length filter, --filter or --metrics'
 
-    if long is not None:
+    if args.metrics is not None or args.filter:
+        filters = [parseFilter(expression) for expression in args.filter]
+        # length filters keep their meaning, mapped reads by aligned length
+        if long is not None:
+            filters += [parseFilter('mapped==1'), parseFilter(f'aligned_length>={long}')]
+        elif short is not None:
+            filters += [parseFilter('mapped==1'), parseFilter(f'aligned_length<={short}')]
+        metricsOutput(bam, outfile, args.metrics, filters, args.threads)
+    elif long is not None:
         filterLength(bam, outfile, long, 'long')
     elif short is not None:
         filterLength(bam, outfile, short, 'short')
@@ -43,15 +59,33 @@ def filterLength(bamfile : str, outfile : str, threshold : int, mode : str) -> N
         'short':lambda length: True if length <= threshold else False
         }[mode]
 
-    out = open(outfile, 'w')
+    out, _ = openOutput(outfile, 'fasta')
 
     bam = pysam.Samfile(bamfile, "rb")
-    for read in bam.fetch():
+    for read in bam.fetch(until_eof=True):
         if read.is_mapped:
             if func(read.query_alignment_length):
                 writeFastx(out, read.query_name, read.query_sequence)
-                print(f'Found {read.query_name} with length {read.query_alignment_length}', end = '\r')
-    print('\nDone')
+                log(f'Found {read.query_name} with length {read.query_alignment_length}', end = '\r')
+    out.close()
+    log('\nDone')
+
+def metricsOutput(bamfile : str, outfile : str, metricsfile : str, filters : list, threads : int = 1) -> None:
+    '''
+    Filters the alignments on their metrics in one pass, writes the metrics and/or the sequences of passing alignments.
+    Sequences are written while the BAM is streamed, the metrics once it is read.
+    '''
+    out = None
+    if outfile is not None:
+        out, _ = openOutput(outfile, 'fasta')
+    try:
+        metrics = alignmentMetrics(bamfile, filters, threads=threads, write=None if out is None else lambda name, seq: writeFastx(out, name, seq))
+    finally:
+        if out is not None:
+            out.close()
+    if metricsfile is not None:
+        writeMetrics(metrics, metricsfile)
+        log(f'Wrote metrics of {len(metrics["read_id"])} alignments to {metricsfile}')
 
 def writeFastx(file : TextIOWrapper, name : str, read : str) -> None:
     file.write(f'>{name}\n{read}\n')
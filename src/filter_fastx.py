@@ -4,38 +4,156 @@
 # website: https://jannessp.github.io
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+from contextlib import nullcontext
+from functools import partial
 from io import TextIOWrapper
 from Bio import SeqIO
 import numpy as np
+import os
 from os.path import exists
 
+from src.fastx_io import STDIO, BATCH_SIZE, QUEUE_DEPTH, openInput, openOutput, readAhead, writeBehind, log
+from src.recordbatch import batched, iterBatches, iterRawRecords, ERROR_PROBABILITY, PHRED_OFFSET
+from src.dedup import KEYS, dedupRecords, dedupPartitioned, newStats, duplicationRate
+from src.batch import isBatchInput, expandInputs, isOutputDir, perFileOutput, runBatch, mergeStats, formatStats
+from src.watch import addWatchArguments, watch
+from src.ids import iterIDs, readIDs
+from src.serve import request
+from src.paired import POLICIES, iterPairs, iterInterleaved, filterPairs, writePairs, mateID
+
+LENGTH_FILTER = {
+    'long':lambda length, threshold: True if length >= threshold else False,
+    'short':lambda length, threshold: True if length <= threshold else False
+    }
+
+# vectorized LENGTH_FILTER for arrays of read lengths
+LENGTH_MASK = {
+    'long':np.greater_equal,
+    'short':np.less_equal
+    }
+
 def parse() -> Namespace:
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter,
-        description='Filter FASTA or FASTQ file for ids or length of reads'
+        description='Filter FASTA or FASTQ file for ids, length or quality of reads'
     )
 
-    parser.add_argument('inFASTX', metavar='inFASTX', type=str, help='Multi FASTQ or FASTA file')
-    parser.add_argument('outFASTX', metavar='outFASTX', type=str, help='FASTQ or FASTA file containing provided reads')
+    parser.add_argument('inFASTX', metavar='inFASTX', type=str, help='Multi FASTQ or FASTA file, - for stdin, a directory or a quoted glob filters all FASTX files in batch mode')
+    parser.add_argument('outFASTX', metavar='outFASTX', type=str, help='FASTQ or FASTA file containing provided reads, - for stdout, in batch mode a directory (existing or ending with /) for one output per input file')
     mode = parser.add_mutually_exclusive_group(required = True)
-    mode.add_argument('-i', '--read_ids', metavar='IDS', type=str, default=None, help='One read ID per line in file, line separated read IDs')
+    mode.add_argument('-i', '--read_ids', metavar='IDS', type=str, default=None, help='One read ID per line in file, line separated read IDs, or a FASTA, FASTQ, SAM or BAM file to take the read IDs from')
     mode.add_argument('-l', '--long', metavar='LENGTH', type=int, default=None, help='Filter FASTA or FASTQ file for reads given length or longer')
     mode.add_argument('-s', '--short', metavar='LENGTH', type=int, default=None, help='Filter FASTA or FASTQ file for reads given length or shorter')
     mode.add_argument('-n', '--number', metavar='NUMBER', type=int, default=None, help='Filter FASTA or FASTQ file for given number of reads')
+    mode.add_argument('-q', '--min_mean_quality', metavar='PHRED', type=float, default=None, help='Filter FASTQ file for reads with given mean quality or higher, averaged over error probabilities')
+    mode.add_argument('-d', '--dedup', choices=KEYS, default=None, help='Remove exact duplicate reads by sequence or read ID, the first occurrence is kept')
+    mode.add_argument('-e', '--max_expected_errors', metavar='ERRORS', type=float, default=None, help='Filter FASTQ file for reads with given number of expected errors or fewer')
     nt_mode = parser.add_mutually_exclusive_group()
     nt_mode.add_argument('--dna', action='store_true', default=False, help='Convert output sequences to dna (ACGT)')
     nt_mode.add_argument('--rna', action='store_true', default=False, help='Convert output sequences to rna (ACGU)')
     parser.add_argument('-f', '--force', action='store_true', help='Force output overwrite')
     parser.add_argument('--inverse', action='store_true', help='Remove reads listed in --read_ids instead of filtering for them.')
+    parser.add_argument('--format', choices=['fasta', 'fastq'], default=None, help='Input format, detected from file extension or first byte if not set')
+    parser.add_argument('--out_format', choices=['fasta', 'fastq'], default=None, help='Output format, taken from file extension or input format if not set')
+    dedup = parser.add_argument_group('deduplication')
+    dedup.add_argument('--digest_bits', type=int, choices=[64, 128], default=64, help='Size of the digests kept for every seen read')
+    dedup.add_argument('--dedup_partitions', type=int, default=0, help='Spill digests into this many partition files on disk for inputs larger than memory, reads the input twice, 0 keeps all digests in memory')
+    dedup.add_argument('--tmp_dir', type=str, default=None, help='Directory for the partition files')
+    paired = parser.add_argument_group('paired-end reads', 'Filter mates in lockstep, inFASTX and outFASTX hold R1 (or interleaved pairs)')
+    paired.add_argument('--in2', metavar='R2', type=str, default=None, help='FASTQ or FASTA file with R2 mates')
+    paired.add_argument('--out2', metavar='R2', type=str, default=None, help='Output file for R2 mates, interleaved into outFASTX if not set')
+    paired.add_argument('--interleaved', action='store_true', help='inFASTX contains interleaved R1/R2 mates')
+    paired.add_argument('--pair_policy', choices=list(POLICIES), default='both', help='Keep a pair if both mates or either mate pass the filter')
+    addWatchArguments(parser)
+    parser.add_argument('--server', metavar='SOCKET', type=str, default=None, help='Fetch the --read_ids from a running "fastx.py serve inFASTX" on this socket instead of parsing inFASTX')
+    parser.add_argument('--processes', type=int, default=None, help='Number of files filtered in parallel in batch mode, number of CPUs if not set')
+    parser.add_argument('--pipelined', action='store_true', help='Read, filter and write on separate threads to overlap I/O with filtering (not for --number)')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE, help='Number of records per batch handed between threads in --pipelined mode')
+    parser.add_argument('--queue_depth', type=int, default=QUEUE_DEPTH, help='Number of batches or compressed chunks buffered between threads')
 
     return parser.parse_args()
 
 def main() -> None:
     args = parse()
+    inFX = args.inFASTX
+    outFX = args.outFASTX
+
+    if args.server is not None:
+        if args.read_ids is None or args.inverse or args.dna or args.rna or args.out_format is not None:
+            log('--server only fetches reads for --read_ids, without --inverse, --dna, --rna or --out_format')
+            exit(1)
+        if not args.force and outFX != STDIO:
+            assert not exists(outFX), f'{outFX} already exists!'
+        fetchFromServer(args.server, inFX, args.read_ids, outFX)
+        return
+
+    if isBatchInput(inFX) or args.watch:
+        if args.number is not None or args.dedup is not None or args.in2 is not None or args.interleaved:
+            log('Batch and watch mode do not support --number, --dedup or paired reads, they need all reads at once')
+            exit(1)
+        # a restarted watch continues the outputs recorded in its checkpoint
+        state = args.state or (os.path.join(outFX, '.watch.json') if isOutputDir(outFX) else f'{outFX}.watch.json')
+        check = not args.force and not (args.watch and exists(state))
+        if isOutputDir(outFX):
+            os.makedirs(outFX, exist_ok=True)
+            outputs = [partial(perFileOutput, outDir=outFX, format=args.out_format)]
+        else:
+            if check and outFX != STDIO:
+                assert not exists(outFX), f'{outFX} already exists!'
+            outputs = [outFX]
+
+        if args.watch:
+            stats = watch(filterFastx, args, inFX, outputs, state, args.poll_interval, args.settle, args.idle_exit)
+            log(formatStats(stats))
+            return
+
+        inputs = expandInputs(inFX)
+        if check and isOutputDir(outFX):
+            for inPath in inputs:
+                assert not exists(outputs[0](inPath)), f'{outputs[0](inPath)} already exists!'
+        log(f'Filtering {len(inputs)} files with {args.processes or os.cpu_count()} processes')
+        stats = mergeStats(runBatch(filterFastx, args, inputs, outputs, args.processes))
+        log(f'Files: {len(inputs)}, {formatStats(stats)}')
+        return
+
+    if not args.force and outFX != STDIO:
+        assert not exists(outFX), f'{outFX} already exists!'
+    filterFastx(args, inFX, outFX)
+
+def fetchFromServer(socket : str, inFX : str, ids : str, outFX : str) -> dict:
+    '''
+    Fetches the reads of the given IDs from a running `fastx.py serve` of inFX.
+    '''
+    header, data = request(socket, {'ids' : list(iterIDs(ids))})
+    if inFX != STDIO and os.path.realpath(header['path']) != os.path.realpath(inFX):
+        log(f'Error: the server on {socket} serves {header["path"]}, not {inFX}')
+        exit(1)
+    out, _ = openOutput(outFX)
+    with out:
+        out.buffer.write(data)
+    log('Found Reads: ', header['found'], ', Unseen IDs: ', len(header['missing']))
+    return {'written' : header['found'], 'unseen' : set(header['missing'])}
 
-    inFX=args.inFASTX
+def filterFastx(args : Namespace, inFX : str, outFX : str) -> dict:
+    '''
+    Filters one FASTX file with the filter selected in the parsed arguments.
+
+    Parameters
+    ----------
+    args : Namespace
+        parsed arguments, see parse
+    inFX : str
+        input FASTX, - for stdin
+    outFX : str
+        output FASTX, - for stdout
+
+    Returns
+    -------
+    stats : dict
+        number of written reads (or pairs) and filter specific counts
+    '''
+    inPath=inFX
     ids=args.read_ids
-    outFX=args.outFASTX
     long=args.long
     short=args.short
     number=args.number
@@ -44,42 +162,114 @@ def main() -> None:
     force=args.force
     inverse=args.inverse
 
-    print('Filtering', inFX)
+    log('Filtering', inFX)
 
     # Check Parameters
-    if inFX.lower().endswith('.fa') or inFX.lower().endswith('.fasta'):
-        informat = 'fasta'
-    elif inFX.lower().endswith('.fq') or inFX.lower().endswith('.fastq'):
-        informat = 'fastq'
-    else:
-        print('Unknown input file format for', inFX)
-        print('Must be .fa/.fasta or .fq/.fastq')
-        exit(1)
+    assert inFX == STDIO or exists(inFX), f'{inFX} does not exist!'
 
-    if outFX.lower().endswith('.fa') or outFX.lower().endswith('.fasta'):
-        outformat = 'fasta'
-    elif outFX.lower().endswith('.fq') or outFX.lower().endswith('.fastq'):
-        outformat = 'fastq'
-    else:
-        print('Unknown output file format for', outFX)
-        print('Must be .fa/.fasta or .fq/.fastq')
-        exit(2)
-
-    if not force:
-        assert not exists(outFX), f'{outFX} already exists!'
-    assert exists(inFX), f'{inFX} does not exist!'
+    try:
+        inFX, informat = openInput(inFX, args.format, args.queue_depth)
+    except ValueError as e:
+        log(e)
+        exit(1)
 
+    if args.in2 is not None or args.interleaved:
+        if number is not None or args.dedup is not None:
+            log('Paired filtering for a number of reads or duplicates is not supported')
+            exit(1)
+        if args.out2 is not None and not force:
+            assert not exists(args.out2), f'{args.out2} already exists!'
+        if (args.min_mean_quality is not None or args.max_expected_errors is not None) and informat != 'fastq':
+            log('Quality filters need FASTQ input')
+            exit(1)
+        if ids is not None:
+            assert exists(ids), f'{ids} file does not exist!'
+            ids = readIDs(ids)
+        predicate = recordPredicate(ids, inverse, long, short, args.min_mean_quality, args.max_expected_errors)
+        in2 = None
+        if args.in2 is not None:
+            in2, _ = openInput(args.in2, informat, args.queue_depth)
+        with inFX, in2 if in2 is not None else nullcontext():
+            written = filterPairedFastx(inFX, in2, informat, predicate, args.pair_policy, outFX, args.out2, args.out_format, args.queue_depth, dna, rna)
+        log('Written pairs:', written)
+        return {'pairs' : written}
+
+    if args.dedup is not None:
+        stats = newStats()
+        if args.dedup_partitions:
+            assert inPath != STDIO, 'Partitioned deduplication reads the input twice and needs a file'
+            inFX.close()
+
+            def openRecords():
+                handle, _ = openInput(inPath, informat, args.queue_depth)
+                with handle:
+                    yield from iterRawRecords(handle.buffer, informat)
+
+            records = dedupPartitioned(openRecords, args.dedup, args.digest_bits, args.dedup_partitions, args.tmp_dir, stats)
+        else:
+            records = dedupRecords(iterRawRecords(inFX.buffer, informat), args.dedup, args.digest_bits, stats)
+        outFX, outformat = openOutput(outFX, args.out_format, depth=args.queue_depth)
+        writeBatches(converted(batched(records, args.batch_size), dna, rna), outFX.buffer, outformat or informat)
+        outFX.close()
+        log(f'Reads: {stats["reads"]}, Unique: {stats["unique"]}, Duplicates: {stats["reads"] - stats["unique"]}, Duplication rate: {duplicationRate(stats):.4f}')
+        return stats
+
+    predicate = None
+    if args.min_mean_quality is not None or args.max_expected_errors is not None:
+        if informat != 'fastq':
+            log('Quality filters need FASTQ input')
+            exit(1)
+        if args.min_mean_quality is not None:
+            predicate = lambda batch : batch.meanQuality() >= args.min_mean_quality
+        else:
+            predicate = lambda batch : batch.expectedErrors() <= args.max_expected_errors
+    elif args.pipelined and (long is not None or short is not None):
+        threshold, mode = (long, 'long') if long is not None else (short, 'short')
+        predicate = lambda batch : LENGTH_MASK[mode](batch.lengths(), threshold)
+
+    if predicate is not None:
+        stats = {'written' : 0}
+        outFX, outformat = openOutput(outFX, args.out_format, depth=args.queue_depth)
+        batches = filterBatches(inFX.buffer, informat, predicate, args.batch_size, args.queue_depth if args.pipelined else 0, dna, rna)
+        batches = counted(batches, stats)
+        if args.pipelined:
+            writeBehind(batches, outFX.buffer, outformat or informat, 1, args.queue_depth, writeBatches)
+        else:
+            writeBatches(batches, outFX.buffer, outformat or informat)
+        outFX.close()
+        return stats
+
+    if args.pipelined and number is None:
+        # imported here, src.pipeline imports this module
+        from src.pipeline import idStage, translateStage
+        records = readAhead(SeqIO.parse(inFX, informat), args.batch_size, args.queue_depth)
+        assert exists(ids), f'{ids} file does not exist!'
+        records = idStage(records, readIDs(ids), inverse)
+        if dna:
+            records = translateStage(records, 'U', 'T')
+        if rna:
+            records = translateStage(records, 'T', 'U')
+        outFX, outformat = openOutput(outFX, args.out_format, depth=args.queue_depth)
+        written = writeBehind(records, outFX, outformat or informat, args.batch_size, args.queue_depth)
+        outFX.close()
+        log('Written reads:', written)
+        return {'written' : written}
+
+    stats = {}
     if ids is not None:
         assert exists(ids), f'{ids} file does not exist!'
-        records, filtered, missed = filterIDs(inFX, informat, open(ids, 'r'), inverse)
-        print('Found Reads: ', len(records), ', Filtered:, ', len(filtered), ', Unseen IDs: ', len(missed))
+        records, filtered, missed = filterIDs(inFX, informat, iterIDs(ids), inverse)
+        log('Found Reads: ', len(records), ', Filtered:, ', len(filtered), ', Unseen IDs: ', len(missed))
+        stats = {'filtered' : len(filtered), 'unseen' : missed}
 
     elif long is not None:
         records, longest, shortest = filterLength(inFX, informat, long, 'long')
+        stats = {'longest' : longest, 'shortest' : shortest}
 
     elif short is not None:
         records, longest, shortest = filterLength(inFX, informat, short, 'short')
-        print('longest', longest, 'shortest', shortest)
+        log('longest', longest, 'shortest', shortest)
+        stats = {'longest' : longest, 'shortest' : shortest}
     
     elif number is not None:
         records = filterNum(inFX, informat, number)
@@ -90,7 +280,144 @@ def main() -> None:
         if rna:
             record.seq = record.seq.replace('T', 'U')
 
-    SeqIO.write(records, outFX, outformat)
+    outFX, outformat = openOutput(outFX, args.out_format, depth=args.queue_depth)
+    stats['written'] = SeqIO.write(records, outFX, outformat or informat)
+    outFX.close()
+    return stats
+
+def recordPredicate(ids : set = None, inverse : bool = False, long : int = None, short : int = None, minMeanQuality : float = None, maxExpectedErrors : float = None):
+    '''
+    Returns a function that decides for a single SeqRecord if it passes the filter given by the
+    one parameter that is not None. Read IDs are compared without /1 and /2 mate suffix.
+    '''
+    if ids is not None:
+        return lambda record : (mateID(record.id) in ids or record.id in ids) != inverse
+    if long is not None:
+        return lambda record : LENGTH_FILTER['long'](len(record), long)
+    if short is not None:
+        return lambda record : LENGTH_FILTER['short'](len(record), short)
+
+    def errors(record):
+        return ERROR_PROBABILITY[np.asarray(record.letter_annotations['phred_quality']) + PHRED_OFFSET].sum()
+
+    if minMeanQuality is not None:
+        return lambda record : len(record) > 0 and -10 * np.log10(errors(record) / len(record)) >= minMeanQuality
+    if maxExpectedErrors is not None:
+        return lambda record : errors(record) <= maxExpectedErrors
+    raise ValueError('No filter given')
+
+def filterPairedFastx(in1, in2, format : str, predicate, policy : str, out1 : str, out2 : str = None, outformat : str = None, depth : int = QUEUE_DEPTH, dna : bool = False, rna : bool = False) -> int:
+    '''
+    Filters paired reads in one pass and writes synchronized outputs.
+
+    Parameters
+    ----------
+    in1 : TextIOWrapper
+        R1 mates, or interleaved pairs if in2 is None
+    in2 : TextIOWrapper
+        R2 mates or None
+    format : str
+        input format
+    predicate : function
+        takes a SeqRecord and returns True to keep it, see recordPredicate
+    policy : str
+        'both' or 'either' mate has to pass
+    out1 : str
+        output for R1 mates, - for stdout
+    out2 : str = None
+        output for R2 mates, pairs are interleaved into out1 if None
+    outformat : str = None
+        output format, taken from the extension of out1 or input format if None
+    depth : int = QUEUE_DEPTH
+        number of compressed chunks buffered for .gz outputs
+    dna : bool = False
+        convert U to T
+    rna : bool = False
+        convert T to U
+
+    Returns
+    -------
+    written : int
+        number of written pairs
+    '''
+    if in2 is None:
+        pairs = iterInterleaved(SeqIO.parse(in1, format))
+    else:
+        pairs = iterPairs(SeqIO.parse(in1, format), SeqIO.parse(in2, format))
+
+    def converted(pairs):
+        for pair in pairs:
+            for record in pair:
+                if dna:
+                    record.seq = record.seq.replace('U', 'T')
+                if rna:
+                    record.seq = record.seq.replace('T', 'U')
+            yield pair
+
+    handle1, outformat = openOutput(out1, outformat, depth=depth)
+    handle2 = openOutput(out2, outformat, depth=depth)[0] if out2 is not None else None
+    try:
+        written = writePairs(converted(filterPairs(pairs, predicate, policy)), handle1, handle2, outformat or format)
+    finally:
+        handle1.close()
+        if handle2 is not None:
+            handle2.close()
+    return written
+
+def writeBatches(batches : list, handle, format : str) -> None:
+    for batch in batches:
+        batch.write(handle, format)
+
+def filterBatches(handle, format : str, predicate, batchSize : int = BATCH_SIZE, depth : int = 0, dna : bool = False, rna : bool = False):
+    '''
+    Filters reads on columnar RecordBatches with a vectorized predicate.
+
+    Parameters
+    ----------
+    handle : BufferedReader
+        binary FASTX input
+    format : str
+        'fasta' or 'fastq'
+    predicate : function
+        takes a RecordBatch and returns a boolean mask of reads to keep
+    batchSize : int = BATCH_SIZE
+        number of reads per batch
+    depth : int = 0
+        number of batches parsed ahead on a reader thread, 0 parses on the calling thread
+    dna : bool = False
+        convert U to T
+    rna : bool = False
+        convert T to U
+
+    Yields
+    ------
+    batch : RecordBatch
+        reads passing the filter
+    '''
+    batches = iterBatches(handle, format, batchSize)
+    if depth:
+        batches = readAhead(batches, 1, depth)
+    for batch in batches:
+        yield from converted([batch.select(predicate(batch))], dna, rna)
+
+def counted(batches, stats : dict):
+    '''
+    Adds the number of reads of passing RecordBatches to stats['written'].
+    '''
+    for batch in batches:
+        stats['written'] += len(batch)
+        yield batch
+
+def converted(batches, dna : bool = False, rna : bool = False):
+    '''
+    Converts U to T (dna) or T to U (rna) in RecordBatches.
+    '''
+    for batch in batches:
+        if dna:
+            batch.translate('U', 'T')
+        if rna:
+            batch.translate('T', 'U')
+        yield batch
 
 def filterNum(inFX : str, format : str, number : int) -> list:
     '''
@@ -139,30 +466,30 @@ def filterLength(inFX : str, format : str, threshold : int, mode : str) -> tuple
     out : list
         list of desired reads
     longest : int
-        length of longest read in inFX
+        length of longest read in inFX, 0 if empty
     shortest : int
-        length of shortest read in inFX
+        length of shortest read in inFX, 0 if empty
     '''
-    func = {
-        'long':lambda length, threshold: True if length >= threshold else False,
-        'short':lambda length, threshold: True if length <= threshold else False
-        }[mode]
+    func = LENGTH_FILTER[mode]
 
     infx = SeqIO.parse(inFX, format)
     out = []
-    longest = -np.inf
-    shortest = np.inf
+    longest = 0
+    shortest = None
     for i, seq_record in enumerate(infx):
         if (i+1)%1000==0:
-            print('Checking read', i+1, '\tFound', len(out), end='\r')
-        if func(len(seq_record), threshold):
+            log('Checking read', i+1, '\tFound', len(out), end='\r')
+        length = len(seq_record)
+        if func(length, threshold):
             out.append(seq_record)
-        longest = max(longest, len(seq_record))
-        shortest = min(shortest, len(seq_record))
-    print()
+        longest = max(longest, length)
+        shortest = length if shortest is None else min(shortest, length)
+    log()
+    if shortest is None:
+        shortest = 0
     return out, longest, shortest
 
-def filterIDs(inFX : str, format : str, ids : TextIOWrapper, inverse : bool) -> tuple:
+def filterIDs(inFX : str, format : str, ids, inverse : bool = False) -> tuple:
     '''
     Filters the input FASTX for ids in given list and writes filtered FASTX.
     
@@ -175,8 +502,10 @@ def filterIDs(inFX : str, format : str, ids : TextIOWrapper, inverse : bool) ->
         Input FASTA/FASTQ
     format : str
         define the input file format
-    ids : TextIOWrapper
-        ReadIDs to filter for
+    ids : iterable
+        ReadIDs to filter for, e.g. an opened ID file or src.ids.iterIDs
+    inverse : bool = False
+        remove the given reads instead
 
     Returns
     -------
@@ -188,17 +517,17 @@ def filterIDs(inFX : str, format : str, ids : TextIOWrapper, inverse : bool) ->
         list of missed IDs
     '''
 
-    ids_list = set(map(lambda id : id.strip(), ids.readlines()))
+    ids_list = set(map(lambda id : id.strip(), ids))
     foundRecords = []
     removedIDs = []
 
     infx = SeqIO.parse(inFX, format)
 
-    print(f'Looking for {len(ids_list)} ids')
+    log(f'Looking for {len(ids_list)} ids')
 
     for idx, seq_record in enumerate(infx):
         if (idx+1)%1000==0:
-            print(f'Processing line {idx+1} ...', end='\r')
+            log(f'Processing line {idx+1} ...', end='\r')
 
         if not inverse:
 
@@ -216,7 +545,7 @@ def filterIDs(inFX : str, format : str, ids : TextIOWrapper, inverse : bool) ->
                 removedIDs.append(seq_record.name)
                 ids_list.remove(seq_record.name)
 
-    print(f'Processed lines {idx}\t\t')
+    log(f'Processed lines {idx}\t\t')
 
     return foundRecords, removedIDs, ids_list
 
@@ -0,0 +1,120 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Reading read IDs from ID lists, FASTA, FASTQ, SAM and BAM files without parsing whole records.
+
+FASTQ headers are taken from every fourth line, FASTA headers from lines starting with '>',
+sequence and quality lines are skipped without decoding. For SAM/BAM only the read names are
+read by pysam, the ID of a FASTX header is the part before the first whitespace.
+'''
+
+import gzip
+from itertools import islice
+import os
+import sys
+import pysam
+
+from src.fastx_io import STDIO, GZIP_MAGIC, formatFromPath, openInput
+
+ALIGNMENT_FORMATS = {
+    '.bam' : 'rb',
+    '.sam' : 'r',
+    '.cram' : 'rc',
+    }
+
+BAM_MAGIC = b'BAM\1'
+
+def sourceType(path : str) -> str:
+    '''
+    Returns 'fasta', 'fastq', 'bam' or 'ids' for a plain list of IDs, by file extension or content.
+    '''
+    if path == STDIO:
+        return 'ids'
+    if os.path.splitext(path)[1].lower() in ALIGNMENT_FORMATS:
+        return 'bam'
+    format = formatFromPath(path)
+    if format is not None:
+        return format
+    # BAM files are BGZF compressed, FASTX may be gzipped
+    with open(path, 'rb') as raw:
+        gzipped = raw.read(2) == GZIP_MAGIC
+    if gzipped:
+        with gzip.open(path, 'rb') as raw:
+            if raw.read(4) == BAM_MAGIC:
+                return 'bam'
+    try:
+        handle, format = openInput(path)
+    except ValueError:
+        return 'ids'
+    handle.close()
+    return format
+
+def headerID(header : bytes) -> str:
+    '''
+    ID of a FASTX header line without the leading '>' or '@'.
+    '''
+    fields = header[1:].split(maxsplit=1)
+    return fields[0].decode() if fields else ''
+
+def fastxIDs(path : str, format : str):
+    '''
+    Yields read IDs from FASTA or FASTQ headers, FASTQ records are expected to have four lines.
+    '''
+    handle, format = openInput(path, format)
+    with handle:
+        raw = handle.buffer
+        if format == 'fastq':
+            for header in islice(raw, 0, None, 4):
+                if not header.strip():
+                    continue
+                assert header[:1] == b'@', f'Invalid FASTQ header {header.rstrip()}, records need four lines'
+                yield headerID(header)
+        else:
+            for line in raw:
+                if line[:1] == b'>':
+                    yield headerID(line)
+
+def alignmentIDs(path : str):
+    '''
+    Yields the read names of all alignments in a SAM/BAM/CRAM file, unmapped reads included.
+    '''
+    mode = ALIGNMENT_FORMATS.get(os.path.splitext(path)[1].lower(), 'rb')
+    with pysam.AlignmentFile(path, mode, check_sq=False) as alignments:
+        for alignment in alignments.fetch(until_eof=True):
+            yield alignment.query_name
+
+def listIDs(handle):
+    for line in handle:
+        line = line.strip()
+        if line:
+            yield line
+
+def iterIDs(source):
+    '''
+    Yields read IDs of a source, IDs can repeat (e.g. secondary alignments).
+
+    Parameters
+    ----------
+    source : str or TextIOWrapper
+        path of an ID list (one ID per line), FASTA, FASTQ (also gzipped), SAM or BAM file,
+        - for an ID list on stdin, or an opened ID list
+    '''
+    if not isinstance(source, str):
+        yield from listIDs(source)
+        return
+    type = sourceType(source)
+    if type == 'bam':
+        yield from alignmentIDs(source)
+    elif type in ('fasta', 'fastq'):
+        yield from fastxIDs(source, type)
+    elif source == STDIO:
+        yield from listIDs(sys.stdin)
+    else:
+        with open(source, 'r') as handle:
+            yield from listIDs(handle)
+
+def readIDs(source) -> set:
+    return set(iterIDs(source))
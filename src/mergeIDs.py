@@ -4,30 +4,33 @@
 # github: https://github.com/JannesSP
 # website: https://jannessp.github.io
 
-from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace, FileType
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
 from os.path import exists
-from io import TextIOWrapper
+import sys
+
+from src.ids import iterIDs
 
 def parse() -> Namespace:
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter,
         description='Write IDs to output file that is present in every provided ID file.'
     )
-    parser.add_argument('file', type=FileType('r'), nargs='+', help='Provide a list of ID files')
+    parser.add_argument('file', type=str, nargs='+', help='Provide a list of ID files (one ID per line), FASTA, FASTQ, SAM or BAM files, - for an ID file on stdin')
     parser.add_argument('method', choices=['intersect', 'union'], default='intersect', help='Merge method for lists of IDs')
-    parser.add_argument('outfile', type=str, help='File to write output IDs')
+    parser.add_argument('outfile', type=str, help='File to write output IDs, - for stdout')
     parser.add_argument('-i', '--ignore', action='store_true', default=False)
     return parser.parse_args()
 
 def main() -> None:
     args = parse()
-    # This is already a list of TextIOWrappers
     files = args.file
     method = args.method
     outfile = args.outfile
-    if not args.ignore:
+    if not args.ignore and outfile != '-':
         assert not exists(outfile), f'{outfile} already exists!'
     assert len(files) > 0
+    for file in files:
+        assert file == '-' or exists(file), f'{file} does not exist!'
     if method == 'intersect':
         ids = intersect(files)
     elif method == 'union':
@@ -46,6 +49,9 @@ def write(ids : set, outfile : str) -> None:
     ids: set
     outfile : str
     '''
+    if outfile == '-':
+        sys.stdout.writelines(f'{id}\n' for id in ids)
+        return
     with open(outfile, 'w') as w:
         for id in ids:
             w.write(f'{id}\n')
@@ -57,22 +63,15 @@ def intersect(files : list) -> set:
     Parameters
     ----------
     files : list
+        paths or opened ID files, see src.ids.iterIDs
 
     Returns
     -------
     IDs : set
     '''
     for i, file in enumerate(files):
-        tset = set()
-        # files is already a list of TextIOWrappers, safety check for test.py
-        if file is not TextIOWrapper:
-            file = open(file, 'r')
-        for line in file:
-            line : str = line.strip()
-            tset.add(line)
-        if file is TextIOWrapper:
-            file.close()
-        iset = tset.copy() if i == 0 else iset.intersection(tset)
+        # only IDs already in the intersection are kept, the first file sets the upper bound
+        iset = set(iterIDs(file)) if i == 0 else iset.intersection(iterIDs(file))
 
     return iset
 
@@ -83,6 +82,7 @@ def union(files : list) -> set:
     Parameters
     ----------
     files : list
+        paths or opened ID files, see src.ids.iterIDs
 
     Returns
     -------
@@ -90,14 +90,7 @@ def union(files : list) -> set:
     '''
     uset = set()
     for file in files:
-        # files is already a list of TextIOWrappers, safety check for test.py
-        if file is not TextIOWrapper:
-            file = open(file, 'r')
-        for line in file:
-            line : str = line.strip()
-            uset.add(line)
-        if file is TextIOWrapper:
-            file.close()
+        uset.update(iterIDs(file))
     return uset
 
 if __name__ == '__main__':
@@ -0,0 +1,86 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Reading, filtering and writing paired-end reads (R1/R2 files or interleaved FASTQ) in lockstep.
+Mates are checked to have the same ID while streaming, nothing is buffered besides the current pair.
+'''
+
+from itertools import zip_longest
+import re
+
+POLICIES = {
+    'both' : all,
+    'either' : any,
+    }
+
+MATE_SUFFIX = re.compile(r'/[12]$')
+
+def mateID(id : str) -> str:
+    '''
+    Read ID without the /1 or /2 mate suffix.
+    '''
+    return MATE_SUFFIX.sub('', id)
+
+def checkMates(r1, r2, idx : int) -> None:
+    if r1 is None or r2 is None:
+        raise ValueError(f'Different number of mates, pair {idx+1} has only one mate')
+    if mateID(r1.id) != mateID(r2.id):
+        raise ValueError(f'Mate IDs of pair {idx+1} do not match: {r1.id} and {r2.id}')
+
+def iterPairs(records1, records2):
+    '''
+    Yields (R1, R2) tuples from two record iterators read in lockstep.
+    Raises a ValueError if mate IDs differ or one file has more records.
+    '''
+    for idx, (r1, r2) in enumerate(zip_longest(records1, records2)):
+        checkMates(r1, r2, idx)
+        yield r1, r2
+
+def iterInterleaved(records):
+    '''
+    Yields (R1, R2) tuples from an interleaved record iterator.
+    Raises a ValueError if mate IDs differ or the last record has no mate.
+    '''
+    records = iter(records)
+    for idx, r1 in enumerate(records):
+        r2 = next(records, None)
+        checkMates(r1, r2, idx)
+        yield r1, r2
+
+def filterPairs(pairs, predicate, policy : str = 'both'):
+    '''
+    Yields pairs where the predicate holds for both mates or either mate.
+
+    Parameters
+    ----------
+    pairs : iterable
+        (R1, R2) tuples
+    predicate : function
+        takes a record and returns True to keep it
+    policy : str = 'both'
+        'both' or 'either'
+    '''
+    keep = POLICIES[policy]
+    for r1, r2 in pairs:
+        if keep((predicate(r1), predicate(r2))):
+            yield r1, r2
+
+def writePairs(pairs, out1, out2, format : str) -> int:
+    '''
+    Writes pairs to two synchronized outputs, or interleaved to out1 if out2 is None.
+
+    Returns
+    -------
+    written : int
+        number of written pairs
+    '''
+    out2 = out2 or out1
+    written = 0
+    for r1, r2 in pairs:
+        out1.write(r1.format(format))
+        out2.write(r2.format(format))
+        written += 1
+    return written
@@ -0,0 +1,178 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Generator stages over SeqRecords that can be chained in one process.
+Every stage takes an iterable of records and yields records, so a pipeline like
+
+    length>=1000 | ids:keep.txt | slice:1-500 | revcomp
+
+parses the input once and writes the output once.
+'''
+
+from Bio.Seq import Seq
+import re
+
+from src.filter_fastx import LENGTH_FILTER
+from src.slice_fastx import sliceRecord, getSliceRegion, slice_start, slice_end
+from src.complement import complement
+from src.replace_fastx import replaceRecord
+from src.ids import readIDs
+
+def lengthStage(records, threshold : int, mode : str):
+    '''
+    Yields records of given length or longer (mode 'long') or shorter (mode 'short').
+    '''
+    func = LENGTH_FILTER[mode]
+    for record in records:
+        if func(len(record), threshold):
+            yield record
+
+def idStage(records, ids : set, inverse : bool = False):
+    '''
+    Yields records whose name is in ids, or not in ids if inverse.
+    '''
+    for record in records:
+        if (record.name in ids) != inverse:
+            yield record
+
+def sliceStage(records, slice : tuple, format : str):
+    '''
+    Yields records sliced to the 0-based [included, excluded) interval, see sliceRecord.
+    '''
+    for record in records:
+        sliceRecord(record, slice, format)
+        yield record
+
+def complementStage(records, reverse : bool = False, rna : bool = False):
+    '''
+    Yields complemented or reverse complemented records. Qualities are reversed accordingly.
+    '''
+    for record in records:
+        c = complement(str(record.seq), rna)
+        phred_quality = record.letter_annotations.pop('phred_quality', None)
+        record.seq = Seq(c[::-1]) if reverse else Seq(c)
+        if phred_quality is not None:
+            record.letter_annotations['phred_quality'] = phred_quality[::-1] if reverse else phred_quality
+        record.description += ' reverse-complement' if reverse else ' complement'
+        yield record
+
+def replaceStage(records, srcbase : str, tgtbase : str, csv = None):
+    '''
+    Yields records with srcbase replaced by tgtbase, see replaceRecord.
+    Replaced positions are written to the opened csv if provided.
+    '''
+    for record in records:
+        positions = replaceRecord(record, srcbase, tgtbase)
+        if csv is not None and positions:
+            csv.write('\n'.join(f'{record.id},{pos},{srcbase},{tgtbase}' for pos in positions) + '\n')
+        yield record
+
+def translateStage(records, src : str, tgt : str):
+    '''
+    Yields records with all src bases converted to tgt, e.g. U -> T for --dna.
+    '''
+    for record in records:
+        record.seq = record.seq.replace(src, tgt)
+        yield record
+
+def headStage(records, number : int):
+    '''
+    Yields the first number of records.
+    '''
+    for i, record in enumerate(records):
+        if i >= number:
+            break
+        yield record
+
+def buildPipeline(expression : str, format : str, files : list = None) -> list:
+    '''
+    Parses a pipeline expression into a list of stages.
+
+    Stages are separated by '|':
+        length>=N, length<=N        filter for read length
+        ids:FILE, exclude:FILE      keep or remove read IDs listed in FILE
+        slice:A-B                   slice 1-based inclusive region
+        slice_start:N, slice_end:N  slice N bases from start or end
+        complement, revcomp         (reverse) complement, append ':rna' for RNA
+        replace:SRC:TGT[:CSV]       replace bases, optionally log positions to CSV
+        dna, rna                    convert U -> T or T -> U
+        head:N                      keep first N records
+
+    Parameters
+    ----------
+    expression : str
+        pipeline expression
+    format : str
+        format of the input records, 'fasta' or 'fastq'
+    files : list = None
+        opened side output files are appended to this list, the caller has to close them
+
+    Returns
+    -------
+    stages : list
+        functions that take and return an iterable of records
+    '''
+    stages = []
+    for token in filter(None, map(str.strip, expression.split('|'))):
+        name, _, arg = token.partition(':')
+        length = re.fullmatch(r'length\s*(>=|<=)\s*(\d+)', token)
+
+        if length:
+            mode = 'long' if length.group(1) == '>=' else 'short'
+            stages.append(lambda recs, t=int(length.group(2)), m=mode: lengthStage(recs, t, m))
+        elif name in ('ids', 'exclude'):
+            ids = readIDs(arg)
+            stages.append(lambda recs, ids=ids, inv=name == 'exclude': idStage(recs, ids, inv))
+        elif name == 'slice':
+            bounds = re.fullmatch(r'\s*(\d+)\s*-\s*(\d+)\s*', arg)
+            if not bounds:
+                raise ValueError(f'Invalid pipeline stage: {token}, use slice:LOWER-UPPER')
+            region = getSliceRegion(None, None, int(bounds.group(1)), int(bounds.group(2)))
+            stages.append(lambda recs, r=region: sliceStage(recs, r, format))
+        elif name == 'slice_start':
+            stages.append(lambda recs, r=slice_start(int(arg)): sliceStage(recs, r, format))
+        elif name == 'slice_end':
+            stages.append(lambda recs, r=slice_end(int(arg)): sliceStage(recs, r, format))
+        elif name in ('complement', 'revcomp'):
+            stages.append(lambda recs, rev=name == 'revcomp', rna=arg == 'rna': complementStage(recs, rev, rna))
+        elif name == 'replace':
+            src, tgt, *csvfile = arg.split(':')
+            csv = None
+            if csvfile:
+                csv = open(csvfile[0], 'w')
+                csv.write('readid,position,sourcebase,targetbase\n')
+                if files is not None:
+                    files.append(csv)
+            stages.append(lambda recs, s=src, t=tgt, c=csv: replaceStage(recs, s, t, c))
+        elif name == 'dna':
+            stages.append(lambda recs: translateStage(recs, 'U', 'T'))
+        elif name == 'rna':
+            stages.append(lambda recs: translateStage(recs, 'T', 'U'))
+        elif name == 'head':
+            stages.append(lambda recs, n=int(arg): headStage(recs, n))
+        else:
+            raise ValueError(f'Unknown pipeline stage: {token}')
+    return stages
+
+def runPipeline(records, stages : list):
+    '''
+    Chains the stages lazily over the records.
+
+    Parameters
+    ----------
+    records : iterable
+        SeqRecords, e.g. from SeqIO.parse
+    stages : list
+        stages from buildPipeline
+
+    Returns
+    -------
+    records : generator
+        records after the last stage
+    '''
+    for stage in stages:
+        records = stage(records)
+    return records
@@ -0,0 +1,215 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Columnar representation of a group of FASTA/FASTQ records.
+
+A RecordBatch stores the sequences and qualities of all records concatenated in two
+uint8 arrays, an offsets array marking where each record starts and the record headers.
+Per-read metrics (length, GC fraction, mean quality, base counts) are computed with NumPy
+over the whole batch, so filters become boolean masks over thousands of reads.
+'''
+
+import numpy as np
+
+PHRED_OFFSET = 33
+
+# error probability of every quality byte, characters below the offset are treated as Phred 0
+ERROR_PROBABILITY = 10 ** (-np.clip(np.arange(256) - PHRED_OFFSET, 0, None) / 10)
+
+class RecordBatch:
+    '''
+    Parameters
+    ----------
+    headers : list
+        header lines as bytes without '>' or '@'
+    seq : np.ndarray
+        concatenated sequences as uint8
+    offsets : np.ndarray
+        start of record i at offsets[i], end at offsets[i+1]
+    qual : np.ndarray = None
+        concatenated quality strings as uint8, None for FASTA
+    '''
+
+    def __init__(self, headers : list, seq : np.ndarray, offsets : np.ndarray, qual : np.ndarray = None) -> None:
+        self.headers = headers
+        self.seq = seq
+        self.offsets = offsets
+        self.qual = qual
+
+    @classmethod
+    def fromRecords(cls, records : list) -> 'RecordBatch':
+        '''
+        Builds a batch from (header, sequence, quality) tuples of bytes, quality is None for FASTA.
+        '''
+        headers = [record[0] for record in records]
+        lengths = np.fromiter((len(record[1]) for record in records), dtype=np.int64, count=len(records))
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        seq = np.frombuffer(b''.join(record[1] for record in records), dtype=np.uint8).copy()
+        qual = None
+        if records and records[0][2] is not None:
+            qual = np.frombuffer(b''.join(record[2] for record in records), dtype=np.uint8).copy()
+        return cls(headers, seq, offsets, qual)
+
+    def __len__(self) -> int:
+        return len(self.headers)
+
+    @property
+    def ids(self) -> list:
+        return [header.split(maxsplit=1)[0].decode() if header else '' for header in self.headers]
+
+    def _segmentSums(self, values : np.ndarray) -> np.ndarray:
+        '''
+        Sums values per record, also correct for records of length 0.
+        Floats are summed per record, a difference of cumulative sums would lose precision on large batches.
+        '''
+        if values.dtype.kind == 'f':
+            sums = np.zeros(len(self), dtype=values.dtype)
+            nonempty = self.lengths() > 0
+            if nonempty.any():
+                sums[nonempty] = np.add.reduceat(values, self.offsets[:-1][nonempty])
+            return sums
+        cumulative = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(values, out=cumulative[1:])
+        return cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def baseCounts(self, symbols : bytes = b'ACGTUN') -> np.ndarray:
+        '''
+        Counts the given symbols (case insensitive) per record.
+
+        Returns
+        -------
+        counts : np.ndarray
+            shape (len(batch), len(symbols))
+        '''
+        upper = self.seq & 0xDF
+        columns = np.full(256, len(symbols), dtype=np.int64)
+        columns[np.frombuffer(symbols, dtype=np.uint8)] = np.arange(len(symbols))
+        records = np.repeat(np.arange(len(self)), self.lengths())
+        width = len(symbols) + 1
+        counts = np.bincount(records * width + columns[upper], minlength=len(self) * width)
+        return counts.reshape(len(self), width)[:, :len(symbols)]
+
+    def gcFraction(self) -> np.ndarray:
+        '''
+        Fraction of G, C and S bases per record, 0 for empty records.
+        '''
+        upper = self.seq & 0xDF
+        gc = self._segmentSums((upper == ord('G')) | (upper == ord('C')) | (upper == ord('S')))
+        return gc / np.maximum(self.lengths(), 1)
+
+    def meanPhred(self) -> np.ndarray:
+        '''
+        Arithmetic mean of the Phred scores per record, NaN for empty records.
+        '''
+        assert self.qual is not None, 'FASTA records have no qualities'
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._segmentSums(self.qual.astype(np.int64) - PHRED_OFFSET) / self.lengths()
+
+    def expectedErrors(self) -> np.ndarray:
+        '''
+        Sum of the error probabilities of all bases per record.
+        '''
+        assert self.qual is not None, 'FASTA records have no qualities'
+        return self._segmentSums(ERROR_PROBABILITY[self.qual])
+
+    def meanQuality(self) -> np.ndarray:
+        '''
+        Phred score of the mean error probability per record, NaN for empty records.
+        Unlike meanPhred, a few low quality bases lower the score as much as they add errors.
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return -10 * np.log10(self.expectedErrors() / self.lengths())
+
+    def select(self, mask : np.ndarray) -> 'RecordBatch':
+        '''
+        Returns a new batch with the records where mask is True.
+        '''
+        lengths = self.lengths()
+        bases = np.repeat(mask, lengths)
+        offsets = np.zeros(np.count_nonzero(mask) + 1, dtype=np.int64)
+        np.cumsum(lengths[mask], out=offsets[1:])
+        headers = [header for header, keep in zip(self.headers, mask) if keep]
+        return RecordBatch(headers, self.seq[bases], offsets, None if self.qual is None else self.qual[bases])
+
+    def translate(self, src : str, tgt : str) -> None:
+        '''
+        Replaces base src with tgt in place, lowercase bases are replaced by lowercase tgt.
+        '''
+        for s, t in ((src.upper(), tgt.upper()), (src.lower(), tgt.lower())):
+            self.seq[self.seq == ord(s)] = ord(t)
+
+    def write(self, handle, format : str) -> None:
+        '''
+        Writes the records to a binary handle as 'fasta' or 'fastq'.
+        '''
+        seq = self.seq.tobytes()
+        offsets = self.offsets.tolist()
+        if format == 'fastq':
+            assert self.qual is not None, 'Cannot write FASTQ without qualities'
+            qual = self.qual.tobytes()
+            handle.write(b''.join(b'@%s\n%s\n+\n%s\n' % (header, seq[a:b], qual[a:b]) for header, a, b in zip(self.headers, offsets, offsets[1:])))
+        else:
+            handle.write(b''.join(b'>%s\n%s\n' % (header, seq[a:b]) for header, a, b in zip(self.headers, offsets, offsets[1:])))
+
+def iterRawRecords(handle, format : str):
+    '''
+    Parses a binary FASTA/FASTQ handle without creating SeqRecords.
+    FASTQ records are expected to have four lines.
+
+    Yields
+    ------
+    record : tuple
+        header, sequence and quality as bytes, quality is None for FASTA
+    '''
+    if format == 'fastq':
+        while True:
+            header = handle.readline()
+            if not header.strip():
+                if not header:
+                    return
+                continue
+            seq = handle.readline().rstrip()
+            plus = handle.readline()
+            qual = handle.readline().rstrip()
+            assert header[:1] == b'@' and plus[:1] == b'+', f'Invalid FASTQ record {header.rstrip()}'
+            assert len(seq) == len(qual), f'Lengths of sequence and quality differ for {header.rstrip()}'
+            yield header[1:].rstrip(), seq, qual
+    else:
+        header = None
+        seq = []
+        for line in handle:
+            if line[:1] == b'>':
+                if header is not None:
+                    yield header, b''.join(seq), None
+                header = line[1:].rstrip()
+                seq = []
+            elif header is not None:
+                seq.append(line.rstrip())
+        if header is not None:
+            yield header, b''.join(seq), None
+
+def batched(records, size : int = 1000):
+    '''
+    Groups raw (header, sequence, quality) records into RecordBatches of up to size records.
+    '''
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield RecordBatch.fromRecords(chunk)
+            chunk = []
+    if chunk:
+        yield RecordBatch.fromRecords(chunk)
+
+def iterBatches(handle, format : str, size : int = 1000):
+    '''
+    Yields RecordBatches of up to size records from a binary FASTA/FASTQ handle.
+    '''
+    yield from batched(iterRawRecords(handle, format), size)
@@ -7,21 +7,39 @@
 '''
 After using `replace_fastx.py` a list of replaced base positions per sequence is stored.
 `replace_bam.py` now fixes the altered mapped reads.
+
+Positions in the CSV are 0-based on the read as sequenced. Primary, secondary and supplementary
+alignments are restored by mapping these positions through the hard clips and the strand of each
+alignment, positions inside hard clips are not part of the alignment and skipped. Secondary
+alignments stored without sequence are written unchanged.
+
+With --checkpoint_every, the progress is checkpointed with the position in the input BAM and an
+interrupted run continues with --resume (see resume.py).
 '''
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+import os
+import numpy as np
 import pandas as pd
 import pysam
 
+from src.fastx_io import log
+from src.resume import BGZF_EOF, CHECKPOINT_EVERY, addResumeArguments, checkpointInterval, checkpointPath, checkpointsEnabled, startCheckpoint, segments, appendBlocks, finish
+from src.checkpoint import Checkpoint, partPath
+
 IDENT = {'A':'A', 'C':'C', 'G':'G', 'T':'T', 'U':'T'}
+COMPLEMENT = bytes.maketrans(b'ACGTN', b'TGCAN')
+THREADS = 4
 
 def parse() -> Namespace:
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument("inbam")
-    parser.add_argument("outbam")
+    parser.add_argument("inbam", help="Input BAM file, - for stdin")
+    parser.add_argument("outbam", help="Output BAM file, - for stdout")
     parser.add_argument("readreplaceCSV")
+    parser.add_argument("-t", "--threads", type=int, default=THREADS, help="Number of threads for BGZF decompression and compression each")
+    addResumeArguments(parser)
     return parser.parse_args()
 
 def revComp(seq : str) -> str:
@@ -30,52 +48,170 @@ def revComp(seq : str) -> str:
     rev_comp_seq = ''.join(complement_dict[base] for base in rev_seq)
     return rev_comp_seq
 
-def main() -> None:
-    args = parse()
-    inbam = pysam.AlignmentFile(args.inbam, 'rb')
-    outbam = pysam.AlignmentFile(args.outbam, 'wb', template=inbam)
-    readreplaceDF = pd.read_csv(args.readreplaceCSV)
-
-    for ridx, read in enumerate(inbam):
-        if (ridx + 1) % 10 == 0:
-            print(f'Read {ridx+1}', end='\r')
-        
-        if read.is_supplementary:
-            # TODO how to handle these?
-            continue
-
-        readreplacedBases = readreplaceDF[readreplaceDF['readid'] == read.query_name]
-        qualities = read.query_qualities
-        query_sequence = list(str(read.get_forward_sequence()))
+def readReplacements(csv : str) -> dict:
+    '''
+    Groups the replaced positions of a replace_fastx.py CSV by read ID.
+
+    Returns
+    -------
+    replacements : dict
+        {readid : (positions, sourcebases, targetbases)}, positions as numpy array, bases as bytes in the DNA alphabet
+    '''
+    df = pd.read_csv(csv, dtype={'readid' : str, 'sourcebase' : str, 'targetbase' : str})
+    positions = df['position'].to_numpy(dtype=np.int64)
+    source = np.array([IDENT[b] for b in df['sourcebase']])
+    target = np.array([IDENT[b] for b in df['targetbase']])
+    replacements = {}
+    for readid, rows in df.groupby('readid', sort=False).indices.items():
+        replacements[readid] = (positions[rows], ''.join(source[rows]).encode(), ''.join(target[rows]).encode())
+    return replacements
+
+def hardClips(read : pysam.AlignedSegment) -> tuple:
+    '''
+    Lengths of the hard clips at the start and end of the alignment, in reference direction.
+    '''
+    cigar = read.cigartuples
+    if not cigar:
+        return 0, 0
+    start = cigar[0][1] if cigar[0][0] == pysam.CHARD_CLIP else 0
+    end = cigar[-1][1] if cigar[-1][0] == pysam.CHARD_CLIP and len(cigar) > 1 else 0
+    return start, end
+
+def queryIndices(positions : np.ndarray, read : pysam.AlignedSegment) -> np.ndarray:
+    '''
+    Maps 0-based positions on the read as sequenced to indices into read.query_sequence, which is
+    reverse complemented for reverse alignments and misses hard clipped bases. Positions in hard clips get -1.
+    '''
+    length = read.query_length
+    start, end = hardClips(read)
+    readLength = start + length + end
+    assert (positions < readLength).all(), f'Replaced position {positions.max()} outside of read {read.query_name} with length {readLength}'
+    indices = (readLength - 1 - positions if read.is_reverse else positions) - start
+    return np.where((indices >= 0) & (indices < length), indices, -1)
+
+def restoreAlignment(read : pysam.AlignedSegment, replacement : tuple) -> int:
+    '''
+    Writes the source bases back into the sequence of one alignment, qualities are kept.
+    Raises a ValueError if a replaced position does not hold the target base.
 
+    Returns
+    -------
+    restored : int
+        number of restored bases, positions in hard clips are not counted
+    '''
+    positions, source, target = replacement
+    indices = queryIndices(positions, read)
+    inside = indices >= 0
+    if not inside.any():
+        return 0
+    if read.is_reverse:
+        source, target = source.translate(COMPLEMENT), target.translate(COMPLEMENT)
+    indices = indices[inside]
+    seq = np.frombuffer(bytearray(read.query_sequence.encode()), dtype=np.uint8)
+    source = np.frombuffer(source, dtype=np.uint8)[inside]
+    target = np.frombuffer(target, dtype=np.uint8)[inside]
+    wrong = seq[indices] != target
+    if wrong.any():
+        i = np.argmax(wrong)
+        raise ValueError(f'Base {chr(seq[indices[i]])} at position {positions[inside][i]} of alignment {read.query_name} ({"reverse" if read.is_reverse else "forward"}, flag {read.flag}) is not the replaced base {chr(target[i])}')
+    seq[indices] = source
+    qualities = read.query_qualities
+    read.query_sequence = seq.tobytes().decode()
+    read.query_qualities = qualities
+    return len(indices)
+
+def replaceBam(inbam : str, outbam : str, readreplaceCSV : str, threads : int = THREADS, checkpoint : Checkpoint = None, every : int = CHECKPOINT_EVERY) -> dict:
+    '''
+    Restores the replaced bases in all alignments of inbam and writes them to outbam in the same order.
+
+    Parameters
+    ----------
+    inbam : str
+        BAM file of the reads with replaced bases, - for stdin
+    outbam : str
+        output BAM file, - for stdout
+    readreplaceCSV : str
+        CSV of replace_fastx.py
+    threads : int = THREADS
+        threads for BGZF decompression and compression each
+    checkpoint : Checkpoint = None
+        checkpoint of startCheckpoint, the run continues from its progress, no checkpoints if None
+    every : int = CHECKPOINT_EVERY
+        number of alignments between checkpoints
+
+    Returns
+    -------
+    stats : dict
+        number of alignments, restored alignments and bases, secondary alignments without sequence
+    '''
+    replacements = readReplacements(readreplaceCSV)
+    stats = {'alignments' : 0, 'restored_alignments' : 0, 'restored_bases' : 0, 'without_sequence' : 0}
+
+    def restored(reads):
+        for read in reads:
+            stats['alignments'] += 1
+            if stats['alignments'] % 100000 == 0:
+                log(f'Read {stats["alignments"]}', end='\r')
+            replacement = replacements.get(read.query_name)
+            if replacement is not None:
+                if read.query_sequence is None:
+                    stats['without_sequence'] += 1
+                else:
+                    restored = restoreAlignment(read, replacement)
+                    stats['restored_alignments'] += restored > 0
+                    stats['restored_bases'] += restored
+            yield read
+
+    with pysam.AlignmentFile(inbam, 'rb', check_sq=False, threads=threads) as inp:
+        if checkpoint is None:
+            with pysam.AlignmentFile(outbam, 'wb', template=inp, threads=threads) as out:
+                for read in restored(inp):
+                    out.write(read)
+            return stats
+
+        if checkpoint.progress:
+            stats.update(checkpoint.progress['stats'])
+            inp.seek(checkpoint.progress['offset'])
+            log(f'Resuming after {stats["alignments"]} alignments')
+        # every segment is written as a complete BAM file, its blocks are appended to outbam
+        segment = partPath(outbam)
         try:
-            for _, replacedPos in readreplacedBases.iterrows():
-                assert query_sequence[replacedPos['position']] == replacedPos['targetbase']
-                query_sequence[replacedPos['position']] = IDENT[replacedPos['sourcebase']]
-        except IndexError as e:
-            print("IndexError:")
-            print(read.query_name, len(query_sequence), read.query_alignment_start)
-            print(read.get_forward_sequence())
-            print(replacedPos['position'], query_sequence[replacedPos['position']], replacedPos['targetbase'])
-            print(e.with_traceback())
-            exit(1)
-        except AssertionError as e:
-            print("AssertionError:")
-            print(read.query_name, len(query_sequence), read.query_alignment_start)
-            print(read.get_forward_sequence())
-            print(replacedPos['position'], query_sequence[replacedPos['position']], replacedPos['targetbase'])
-            print(e.with_traceback())
-            exit(1)
-
-        # print(query_sequence)
-        if read.is_reverse:
-            read.query_sequence = revComp(''.join(query_sequence))
+            for reads in segments(inp, every):
+                with pysam.AlignmentFile(segment, 'wb', template=inp, threads=threads) as out:
+                    # the header is flushed into its own blocks
+                    header = out.tell() >> 16
+                    for read in restored(reads):
+                        out.write(read)
+                size = appendBlocks(segment, outbam, header if os.path.isfile(outbam) and os.path.getsize(outbam) else 0)
+                checkpoint.markProgress({'offset' : inp.tell(), 'stats' : stats}, {os.path.abspath(outbam) : size})
+                checkpoint.save()
+        finally:
+            if os.path.exists(segment):
+                os.remove(segment)
+        if os.path.isfile(outbam) and os.path.getsize(outbam):
+            with open(outbam, 'ab') as out:
+                out.write(BGZF_EOF)
         else:
-            read.query_sequence = ''.join(query_sequence)
-        read.query_qualities = qualities
-        outbam.write(read)
+            # no alignments
+            pysam.AlignmentFile(outbam, 'wb', template=inp).close()
+    finish(checkpoint)
+    return stats
 
-    print(f'Read {ridx+1}')
+def main() -> None:
+    args = parse()
+    every = checkpointInterval(args)
+    checkpoint = None
+    if checkpointsEnabled([args.inbam], [args.outbam], every):
+        checkpoint = startCheckpoint(args.checkpoint or checkpointPath(args.outbam), [args.outbam], args.resume)
+    elif args.resume:
+        log('Error: --resume needs file input and output')
+        exit(1)
+    try:
+        stats = replaceBam(args.inbam, args.outbam, args.readreplaceCSV, args.threads, checkpoint, every)
+    except ValueError as e:
+        log(f'Error: {e}')
+        exit(1)
+    log(f'Read {stats["alignments"]} alignments, restored {stats["restored_bases"]} bases in {stats["restored_alignments"]} alignments, {stats["without_sequence"]} alignments without sequence')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
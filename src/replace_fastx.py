@@ -11,39 +11,150 @@ This script takes:
 - a target base to replace the source base with.
 
 It produces an output fasta/fastq file with the replaced base and a csv file with information about the replaces bases.
+With --checkpoint_every, single files are checkpointed and an interrupted run continues with --resume.
 '''
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+from functools import partial
+from itertools import islice
 import os
 from Bio import SeqIO
 import re
 
+from src.fastx_io import STDIO, formatFromPath, openInput, openOutput, log
+from src.batch import isBatchInput, expandInputs, perFileOutput, runBatch, mergeStats, formatStats
+from src.watch import addWatchArguments, watch
+from src.checkpoint import Checkpoint
+from src.resume import CHECKPOINT_EVERY, addResumeArguments, checkpointInterval, checkpointPath, checkpointsEnabled, startCheckpoint, segments, syncedSize, finish
+
 def parse() -> Namespace:
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument("fastx", type = str, help = "Input fasta/fastq file.")
+    parser.add_argument("fastx", type = str, help = "Input fasta/fastq file, - to read from stdin and write records to stdout. A directory or a quoted glob processes all fasta/fastq files in batch mode.")
     parser.add_argument("srcbase", type = str, help = "Source base to be replaced.")
     parser.add_argument("tgtbase", type = str, help = "Target base that is inserted.")
     parser.add_argument("outdir", type = str, help = "Output directory")
+    parser.add_argument("--format", choices = ['fasta', 'fastq'], default = None, help = "Input format, detected from file extension or first byte if not set")
+    parser.add_argument("--processes", type = int, default = None, help = "Number of files processed in parallel in batch mode, number of CPUs if not set")
+    addWatchArguments(parser)
+    addResumeArguments(parser)
+    parser.add_argument("--concat", action = "store_true", help = "In batch or watch mode, concatenate the records and csv files of all inputs in input order into outdir/batch_replaced<src><tgt>.<format|csv> instead of writing outputs per file to outdir")
     return parser.parse_args()
 
-def replaceBase(file : str, format : str, srcbase: str, tgtbase : str, outfastx : str, outcsv : str) -> None:
+def replaceRecord(record : SeqIO.SeqRecord, srcbase : str, tgtbase : str) -> list:
+    '''
+    Replaces srcbase with tgtbase in the record sequence.
+
+    Parameters
+    ----------
+    record : SeqIO.SeqRecord
+        record to alter in place
+    srcbase : str
+        base to be replaced
+    tgtbase : str
+        base that is inserted
 
-    sequences = []
+    Returns
+    -------
+    positions : list
+        0-based positions of the replaced bases
+    '''
+    positions = [idx.start() for idx in re.finditer(srcbase, str(record.seq))]
+    record.seq = record.seq.replace(srcbase, tgtbase)
+    return positions
 
-    with open(outcsv, 'w') as csv:
-        csv.write('readid,position,sourcebase,targetbase\n')
+def replaceBase(file : str, format : str, srcbase: str, tgtbase : str, outfastx : str, outcsv : str, checkpoint : Checkpoint = None, every : int = CHECKPOINT_EVERY) -> dict:
+    '''
+    Replaces srcbase with tgtbase in all records of file, writes the records to outfastx and the replaced positions to outcsv.
+    With a checkpoint the outputs are closed and checkpointed every `every` reads and the run continues after the checkpointed reads.
 
-        for record in SeqIO.parse(file, format):
-            indices = re.finditer(srcbase, str(record.seq))
-            record.seq = record.seq.replace(srcbase, tgtbase)
-            sequences.append(record)
-            outlines = [f'{record.id},{idx.start()},{srcbase},{tgtbase}' for idx in indices]
+    Returns
+    -------
+    stats : dict
+        number of processed reads and replaced bases
+    '''
+    stats = {'reads' : 0, 'replaced' : 0}
+    if checkpoint is not None and checkpoint.progress:
+        stats.update(checkpoint.progress['stats'])
+        log(f'Resuming after {stats["reads"]} reads')
+    skip = stats['reads']
+
+    def replaced(records, csv):
+        for record in records:
+            positions = replaceRecord(record, srcbase, tgtbase)
+            stats['reads'] += 1
+            stats['replaced'] += len(positions)
+            outlines = [f'{record.id},{pos},{srcbase},{tgtbase}' for pos in positions]
             if outlines:
                 csv.write('\n'.join(outlines) + '\n')
-        
-    SeqIO.write(sequences, outfastx, format)
+            yield record
+
+    inp, format = openInput(file, format)
+    records = islice(SeqIO.parse(inp, format), skip, None)
+    append = skip > 0
+    # one segment without checkpoints, an empty input still gets its outputs
+    for segment in (segments(records, every) if checkpoint is not None else [records]):
+        out, _ = openOutput(outfastx, format, append)
+        with open(outcsv, 'a' if append else 'w') as csv:
+            if not append:
+                csv.write('readid,position,sourcebase,targetbase\n')
+            SeqIO.write(replaced(segment, csv), out, format)
+        out.close()
+        append = True
+        if checkpoint is not None:
+            # .gz outputs end with a complete gzip member, the next segment appends a new one
+            checkpoint.markProgress({'records' : stats['reads'], 'stats' : stats}, {os.path.abspath(output) : syncedSize(output) for output in (outfastx, outcsv)})
+            checkpoint.save()
+    inp.close()
+    if checkpoint is not None and not append:
+        # empty input
+        openOutput(outfastx, format)[0].close()
+        with open(outcsv, 'w') as csv:
+            csv.write('readid,position,sourcebase,targetbase\n')
+    finish(checkpoint)
+    return stats
+
+def replaceWorker(args : Namespace, file : str, outfastx : str, outcsv : str) -> dict:
+    return replaceBase(file, args.format, args.srcbase, args.tgtbase, outfastx, outcsv)
+
+def csvPath(outfastx : str) -> str:
+    '''
+    Path of the CSV of replaced positions next to the records output.
+    '''
+    return os.path.splitext(outfastx[:-3] if outfastx.lower().endswith('.gz') else outfastx)[0] + '.csv'
+
+def replaceBatch(args : Namespace) -> None:
+    '''
+    Replaces bases in all fasta/fastq files of a directory or glob on a process pool, or in new files as they appear in watch mode.
+    '''
+    suffix = f'_replaced{args.srcbase}{args.tgtbase}'
+    os.makedirs(args.outdir, exist_ok=True)
+    if args.concat:
+        format = args.format or formatFromPath(args.fastx)
+        if format is None and not args.watch:
+            format = formatFromPath(expandInputs(args.fastx)[0])
+        if format is None:
+            log(f'Error: Unknown format of {args.fastx}, set --format')
+            exit(1)
+        outputs = [os.path.join(args.outdir, f'batch{suffix}.{format}'), os.path.join(args.outdir, f'batch{suffix}.csv')]
+    else:
+
+        def csvOutput(file):
+            return csvPath(perFileOutput(file, args.outdir, suffix=suffix))
+
+        outputs = [partial(perFileOutput, outDir=args.outdir, suffix=suffix), csvOutput]
+
+    if args.watch:
+        state = args.state or os.path.join(args.outdir, f'.watch{suffix}.json')
+        stats = watch(replaceWorker, args, args.fastx, outputs, state, args.poll_interval, args.settle, args.idle_exit, [0, 1])
+        log(formatStats(stats))
+        return
+
+    inputs = expandInputs(args.fastx)
+    log(f'Replacing {args.srcbase} with {args.tgtbase} in {len(inputs)} files')
+    stats = mergeStats(runBatch(replaceWorker, args, inputs, outputs, args.processes, [0, 1]))
+    log(f'Files: {len(inputs)}, {formatStats(stats)}')
 
 def main() -> None:
     args = parse()
@@ -51,17 +162,33 @@ def main() -> None:
     srcbase = args.srcbase
     tgtbase = args.tgtbase
     
-    if fastx.endswith('fasta') or fastx.endswith('fa') or fastx.endswith('fn'):
-        format = 'fasta'
-    elif fastx.endswith('fastq') or fastx.endswith('fq'):
-        format = 'fastq'
+    format = args.format
+
+    if isBatchInput(fastx) or args.watch:
+        replaceBatch(args)
+        return
+
+    os.makedirs(args.outdir, exist_ok=True)
+    if fastx == STDIO:
+        outfastx = STDIO
+        outcsv = os.path.join(args.outdir, f'stdin_replaced{srcbase}{tgtbase}.csv')
     else:
-        print(f'Error: Unknown file extension {os.path.splitext(fastx)[1]}')
+        if format is None:
+            format = 'fasta' if fastx.endswith('fn') else formatFromPath(fastx)
+        if format is None:
+            log(f'Error: Unknown file extension {os.path.splitext(fastx)[1]}')
+            exit(1)
+        # like in batch mode, gzipped inputs give gzipped outputs
+        outfastx = perFileOutput(fastx, args.outdir, format, f'_replaced{srcbase}{tgtbase}')
+        outcsv = csvPath(outfastx)
+    every = checkpointInterval(args)
+    checkpoint = None
+    if checkpointsEnabled([fastx], [outfastx], every):
+        checkpoint = startCheckpoint(args.checkpoint or checkpointPath(outfastx), [outfastx, outcsv], args.resume)
+    elif args.resume:
+        log('Error: --resume needs file input and output')
         exit(1)
-
-    outfastx = os.path.splitext(fastx)[0] + f'_replaced{srcbase}{tgtbase}.{format}'
-    outcsv = os.path.splitext(fastx)[0] + f'_replaced{srcbase}{tgtbase}.csv'
-    replaceBase(fastx, format, srcbase, tgtbase, outfastx, outcsv)
+    replaceBase(fastx, format, srcbase, tgtbase, outfastx, outcsv, checkpoint, every)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,118 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Checkpoints of long single-file runs, so a killed job continues where it stopped with --resume.
+Checkpoints are only written if --checkpoint_every, --checkpoint or --resume is given, plain runs
+write their outputs directly.
+
+The input is processed in segments of --checkpoint_every records. After each segment the outputs
+are closed and synced, then the position in the input, the statistics so far and the output sizes
+are written atomically to the checkpoint (a checkpoint.Checkpoint). Compressed outputs are closed block-wise:
+every segment of a .gz output is its own gzip member and every segment of a BAM output is a run
+of complete BGZF blocks, so a file cut at a checkpointed size is still valid. --resume truncates
+the outputs to the checkpointed sizes and continues after the checkpointed input position. The
+checkpoint is removed once the run is complete.
+'''
+
+from argparse import ArgumentParser
+from itertools import chain, islice
+import os
+
+from src.fastx_io import STDIO, log
+from src.checkpoint import Checkpoint, copyRange
+
+CHECKPOINT_EVERY = 100000
+
+# empty BGZF block marking the end of a BAM file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def addResumeArguments(parser : ArgumentParser) -> None:
+    resume = parser.add_argument_group('checkpoints', 'Checkpoint the progress of a single input file and continue an interrupted run')
+    resume.add_argument('--resume', action='store_true', help='Continue from the checkpoint, outputs are truncated to the last checkpoint')
+    resume.add_argument('--checkpoint', type=str, default=None, help='Write checkpoints to this file, defaults to <output>.checkpoint.json if checkpoints are enabled')
+    resume.add_argument('--checkpoint_every', type=int, default=None, help=f'Write a checkpoint every this many records, {CHECKPOINT_EVERY} if only --checkpoint or --resume is given, no checkpoints by default')
+
+def checkpointInterval(args) -> int:
+    '''
+    Number of records between checkpoints, 0 if checkpoints are not requested.
+    '''
+    if args.checkpoint_every is not None:
+        return args.checkpoint_every
+    return CHECKPOINT_EVERY if args.checkpoint is not None or args.resume else 0
+
+def checkpointPath(output : str) -> str:
+    return f'{output}.checkpoint.json'
+
+def startCheckpoint(path : str, outputs : list, resume : bool) -> Checkpoint:
+    '''
+    Loads the checkpoint and truncates the outputs to it if resuming, starts an empty checkpoint and
+    empties existing outputs otherwise. Exits if a checkpoint exists but resume is not set, to not
+    overwrite the progress of an interrupted run.
+    '''
+    if not resume:
+        if os.path.exists(path):
+            log(f'Error: Checkpoint {path} of an interrupted run exists, continue with --resume or remove it')
+            exit(1)
+        for output in outputs:
+            if os.path.isfile(output):
+                open(output, 'wb').close()
+        return Checkpoint(path)
+    checkpoint = Checkpoint(path)
+    if not checkpoint.progress:
+        log(f'No checkpoint {path}, starting from the beginning')
+    for output in outputs:
+        size = checkpoint.outputs.get(os.path.abspath(output), 0)
+        if size and (not os.path.isfile(output) or os.path.getsize(output) < size):
+            log(f'Error: {output} is shorter than at the checkpoint, cannot resume')
+            exit(1)
+    checkpoint.restore(outputs)
+    return checkpoint
+
+def checkpointsEnabled(inputs : list, outputs : list, every : int) -> bool:
+    '''
+    Checkpoints need seekable or re-readable inputs and truncatable outputs.
+    '''
+    return every > 0 and STDIO not in inputs and STDIO not in outputs
+
+def syncedSize(path : str) -> int:
+    '''
+    Syncs a closed output to disk and returns its size.
+    '''
+    with open(path, 'ab') as out:
+        os.fsync(out.fileno())
+        return out.tell()
+
+def segments(records, size : int):
+    '''
+    Splits an iterable into consecutive iterables of size items, each has to be consumed before the next.
+    '''
+    records = iter(records)
+    for first in records:
+        yield chain([first], islice(records, size - 1))
+
+def appendBlocks(segment : str, output : str, skip : int = 0) -> int:
+    '''
+    Appends the BGZF blocks of a closed BAM segment after skip bytes (its header) without the EOF block
+    to output and returns the synced size of output.
+    '''
+    size = os.path.getsize(segment)
+    end = size - len(BGZF_EOF) if size >= len(BGZF_EOF) else size
+    with open(segment, 'rb') as src:
+        src.seek(end)
+        assert src.read() == BGZF_EOF, f'{segment} is not a complete BGZF file'
+        # copy_file_range and sendfile do not work on files opened for appending
+        out = os.open(output, os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            os.lseek(out, 0, os.SEEK_END)
+            copyRange(src.fileno(), out, skip, end - skip)
+            os.fsync(out)
+            return os.lseek(out, 0, os.SEEK_CUR)
+        finally:
+            os.close(out)
+
+def finish(checkpoint : Checkpoint) -> None:
+    if checkpoint is not None and os.path.exists(checkpoint.path):
+        os.remove(checkpoint.path)
@@ -0,0 +1,336 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Local server answering read fetch requests for a large uncompressed FASTA/FASTQ file over a UNIX
+domain socket, so repeated lookups do not pay startup, import and a full parse every time.
+
+On start the byte range of every record is loaded from the index `<fastx>.fxi`, which is built by
+one scan on first use and rebuilt when the file changes. Requested records are read with os.pread,
+records close to each other in the file are read with a single call. Recently fetched records are
+kept in an LRU cache up to a memory cap.
+
+Protocol: the client sends one JSON line per request, {"ids" : [...]} or
+{"regions" : [[id, start, end], ...]} with 0-based [start, end) intervals. The server answers with
+one JSON line {"found" : n, "missing" : [...], "bytes" : size, "path" : served file} followed by
+size bytes of records in the request order.
+'''
+
+from collections import OrderedDict
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from src.fastx_io import GZIP_MAGIC, formatFromPath, sniffFormat, log
+
+INDEX_SUFFIX = '.fxi'
+INDEX_MAGIC = '#fxi'
+CACHE_MB = 256
+# records closer than this are read with one pread call
+MAX_GAP = 1 << 16
+MAX_READ = 1 << 26
+
+def indexPath(fastx : str) -> str:
+    return fastx + INDEX_SUFFIX
+
+def _recordRanges(raw, format : str):
+    '''
+    Yields (id, start, end, length) of every record of a binary handle by scanning its lines.
+    '''
+    offset = 0
+    current = None
+    length = 0
+    if format == 'fastq':
+        while True:
+            header = raw.readline()
+            if not header:
+                return
+            if not header.strip():
+                offset += len(header)
+                continue
+            seq = raw.readline()
+            plus = raw.readline()
+            qual = raw.readline()
+            assert header[:1] == b'@' and plus[:1] == b'+', f'Invalid FASTQ record {header.rstrip()}, records need four lines'
+            end = offset + len(header) + len(seq) + len(plus) + len(qual)
+            fields = header[1:].split(maxsplit=1)
+            yield fields[0].decode() if fields else '', offset, end, len(seq.rstrip())
+            offset = end
+    for line in raw:
+        if line[:1] == b'>':
+            if current is not None:
+                yield current[0], current[1], offset, length
+            fields = line[1:].split(maxsplit=1)
+            current = (fields[0].decode() if fields else '', offset)
+            length = 0
+        else:
+            length += len(line.rstrip())
+        offset += len(line)
+    if current is not None:
+        yield current[0], current[1], offset, length
+
+def buildIndex(fastx : str, format : str) -> str:
+    '''
+    Scans the FASTX once and writes the index atomically, returns the path of the index.
+    '''
+    index = indexPath(fastx)
+    stat = os.stat(fastx)
+    tmp = f'{index}.{os.getpid()}.tmp'
+    try:
+        with open(fastx, 'rb', buffering=1 << 20) as raw, open(tmp, 'w') as out:
+            out.write(f'{INDEX_MAGIC}\t{format}\t{stat.st_mtime_ns}\t{stat.st_size}\n')
+            for id, start, end, length in _recordRanges(raw, format):
+                out.write(f'{id}\t{start}\t{end}\t{length}\n')
+        os.replace(tmp, index)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+def loadIndex(fastx : str, format : str = None) -> tuple:
+    '''
+    Returns the record ranges {id : (start, end, length)} and the format, builds or rebuilds the index if needed.
+    '''
+    with open(fastx, 'rb') as raw:
+        assert raw.peek(2)[:2] != GZIP_MAGIC, f'{fastx} is compressed, the server needs random access to an uncompressed file'
+        format = format or formatFromPath(fastx) or sniffFormat(raw)
+    assert format is not None, f'Unknown format of {fastx}'
+    index = indexPath(fastx)
+    stat = os.stat(fastx)
+    valid = False
+    if os.path.isfile(index):
+        with open(index, 'r') as f:
+            valid = f.readline().rstrip('\n').split('\t') == [INDEX_MAGIC, format, str(stat.st_mtime_ns), str(stat.st_size)]
+    if not valid:
+        log(f'Indexing {fastx}')
+        buildIndex(fastx, format)
+    entries = {}
+    with open(index, 'r') as f:
+        next(f)
+        for line in f:
+            id, start, end, length = line.rstrip('\n').split('\t')
+            # the first record of duplicated IDs is served
+            if id not in entries:
+                entries[id] = (int(start), int(end), int(length))
+    return entries, format
+
+class RecordCache:
+    '''
+    LRU cache of record bytes with a capacity in bytes.
+    '''
+
+    def __init__(self, capacity : int) -> None:
+        self.capacity = capacity
+        self.size = 0
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, id : str) -> bytes:
+        record = self.records.get(id)
+        if record is None:
+            self.misses += 1
+            return None
+        self.records.move_to_end(id)
+        self.hits += 1
+        return record
+
+    def put(self, id : str, record : bytes) -> None:
+        if len(record) > self.capacity or id in self.records:
+            return
+        self.records[id] = record
+        self.size += len(record)
+        while self.size > self.capacity:
+            _, evicted = self.records.popitem(last=False)
+            self.size -= len(evicted)
+
+class ReadStore:
+    '''
+    Random access to the records of an uncompressed FASTX file by ID.
+    '''
+
+    def __init__(self, fastx : str, cacheBytes : int = CACHE_MB << 20, format : str = None) -> None:
+        self.path = fastx
+        self.index, self.format = loadIndex(fastx, format)
+        self.fd = os.open(fastx, os.O_RDONLY)
+        self.cache = RecordCache(cacheBytes)
+        self.lock = threading.Lock()
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def fetch(self, ids : list) -> tuple:
+        '''
+        Returns the records of the given IDs in request order and the IDs that are not in the file.
+
+        Returns
+        -------
+        records : list
+            record bytes, FASTX formatted
+        missing : list
+            unknown IDs
+        '''
+        found = {}
+        missing = []
+        wanted = []
+        with self.lock:
+            for id in ids:
+                if id in found:
+                    continue
+                record = self.cache.get(id)
+                if record is not None:
+                    found[id] = record
+                elif id in self.index:
+                    wanted.append(id)
+                else:
+                    missing.append(id)
+        # read misses in file order, coalescing records close to each other into one pread
+        wanted = sorted(set(wanted), key=lambda id : self.index[id][0])
+        group = []
+        for id in wanted + [None]:
+            if id is not None and group:
+                first, last = self.index[group[0]][0], self.index[group[-1]][1]
+                start, end = self.index[id][:2]
+                if start - last <= MAX_GAP and end - first <= MAX_READ:
+                    group.append(id)
+                    continue
+            if group:
+                first, last = self.index[group[0]][0], self.index[group[-1]][1]
+                data = os.pread(self.fd, last - first, first)
+                for member in group:
+                    start, end, _ = self.index[member]
+                    found[member] = data[start - first : end - first]
+            group = [id]
+        with self.lock:
+            for id in wanted:
+                self.cache.put(id, found[id])
+        return [found[id] for id in ids if id in found], missing
+
+    def region(self, id : str, start : int, end : int) -> bytes:
+        '''
+        Returns the 0-based interval [start, end) of a record, annotated like slice_fastx.py.
+        '''
+        records, missing = self.fetch([id])
+        if missing:
+            return None
+        lines = records[0].split(b'\n')
+        header = lines[0]
+        if self.format == 'fastq':
+            seq, qual = lines[1], lines[3]
+        else:
+            seq, qual = b''.join(lines[1:]), None
+        end = len(seq) if end is None or end > len(seq) else end
+        start = max(0, start)
+        header += b' sliced=(%d,%d)' % (start + 1, end)
+        if qual is not None:
+            return b'%s\n%s\n+\n%s\n' % (header, seq[start : end], qual[start : end])
+        return b'%s\n%s\n' % (header, seq[start : end])
+
+    def answer(self, request : dict) -> tuple:
+        '''
+        Returns the response header and the record bytes of a request.
+        '''
+        if 'ids' in request:
+            records, missing = self.fetch(request['ids'])
+        elif 'regions' in request:
+            records, missing = [], []
+            for id, start, end in request['regions']:
+                record = self.region(id, start, end)
+                if record is None:
+                    missing.append(id)
+                else:
+                    records.append(record)
+        elif request.get('command') == 'stats':
+            info = json.dumps({'records' : len(self.index), 'cached' : len(self.cache.records), 'cache_bytes' : self.cache.size, 'hits' : self.cache.hits, 'misses' : self.cache.misses}).encode()
+            return {'found' : 0, 'missing' : [], 'bytes' : len(info)}, info
+        else:
+            return {'error' : 'Request needs "ids" or "regions"', 'bytes' : 0}, b''
+        payload = b''.join(record if record.endswith(b'\n') else record + b'\n' for record in records)
+        return {'found' : len(records), 'missing' : missing, 'bytes' : len(payload)}, payload
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                header, payload = self.server.store.answer(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                header, payload = {'error' : str(e), 'bytes' : 0}, b''
+            header['path'] = os.path.abspath(self.server.store.path)
+            self.wfile.write(json.dumps(header).encode() + b'\n')
+            self.wfile.write(payload)
+            self.wfile.flush()
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(fastx : str, socketPath : str, cacheMB : int = CACHE_MB, format : str = None) -> None:
+    '''
+    Serves the records of fastx on a UNIX domain socket until interrupted.
+    '''
+    store = ReadStore(fastx, cacheMB << 20, format)
+    if os.path.exists(socketPath):
+        # a socket left by a server that was killed
+        assert not isServing(socketPath), f'A server is already listening on {socketPath}'
+        os.remove(socketPath)
+    # the socket is created by bind, only the user may connect from the start
+    umask = os.umask(0o077)
+    try:
+        server = _Server(socketPath, _Handler)
+    finally:
+        os.umask(umask)
+    server.store = store
+    os.chmod(socketPath, 0o600)
+    log(f'Serving {len(store.index)} records of {fastx} on {socketPath}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+
+def isServing(socketPath : str) -> bool:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socketPath)
+        return True
+    except OSError:
+        return False
+
+def request(socketPath : str, payload : dict) -> tuple:
+    '''
+    Sends one request to a server.
+
+    Returns
+    -------
+    header : dict
+        response header with 'found', 'missing', 'bytes' and 'path'
+    data : bytes
+        FASTX formatted records
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socketPath)
+        client.sendall(json.dumps(payload).encode() + b'\n')
+        response = client.makefile('rb')
+        header = json.loads(response.readline())
+        if 'error' in header:
+            raise ValueError(header['error'])
+        data = response.read(header['bytes'])
+    return header, data
+
+def parseRegion(region : str) -> list:
+    '''
+    Converts ID:START-END (1-based, inclusive) or ID to [id, start, end] 0-based [start, end).
+    '''
+    id, sep, interval = region.rpartition(':')
+    if not sep or '-' not in interval:
+        return [region, 0, None]
+    start, _, end = interval.partition('-')
+    return [id, int(start) - 1, int(end)]
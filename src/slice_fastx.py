@@ -4,23 +4,23 @@
 # website: https://jannessp.github.io
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+from contextlib import nullcontext
 from io import TextIOWrapper
 import os
+import re
 from Bio import SeqIO
 
-FORMATS = {
-    '.fa' : 'fasta',
-    '.fasta' : 'fasta',
-    '.fq' : 'fastq',
-    '.fastq' : 'fastq',
-    }
+from src.twobit import parseFasta
+from src.fastx_io import STDIO, BATCH_SIZE, QUEUE_DEPTH, openInput, openOutput, readAhead, writeBehind, log
+from src.recordbatch import iterRawRecords
+from src.paired import iterPairs, iterInterleaved, writePairs, mateID
 
 def parse() -> Namespace:
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument('inFastx', type=str, help='Fastx file from which to slice subsequences')
-    parser.add_argument('outFastx', type=str, help='Fastx file to write slices')
+    parser.add_argument('inFastx', type=str, help='Fastx file from which to slice subsequences, - for stdin')
+    parser.add_argument('outFastx', type=str, help='Fastx file to write slices, - for stdout')
     parser.add_argument('--append', action='store_true', help='Appends slices to existing outFastx')
     parser.add_argument('--lowerbound', default=None, type=int, help='Lower bound for slicing area (1-based)')
     parser.add_argument('--upperbound', default=None, type=int, help='Upper bound for slicing area (1-based)')
@@ -28,8 +28,23 @@ def parse() -> Namespace:
     parser.add_argument('--range', default=None, type=int, help='Range which to slice up- and downstream from the position')
     parser.add_argument('--slice_start', default=None, type=int, help='Slice number of nucleotides from start of reads')
     parser.add_argument('--slice_end', default=None, type=int, help='Slice number of nucleotides from end of reads')
+    motif = parser.add_argument_group('motif mode', 'Slice windows around every hit of sequence motifs instead of fixed positions')
+    motif.add_argument('--motif', nargs='+', default=None, type=str, help='Literal or IUPAC-degenerate motifs, e.g. DRACH or AGATCGGAAGAGC, overlapping hits are reported')
+    motif.add_argument('--flank', default=0, type=int, help='Number of nucleotides to include up- and downstream of each hit')
+    motif.add_argument('--motif_strand', choices=['both', 'forward', 'reverse'], default='both', help='Search the motifs on the read, its reverse complement or both')
+    motif.add_argument('--full_windows', action='store_true', help='Skip hits whose window would extend beyond the read')
     # TODO read input ids file
     parser.add_argument('--id', default=None, type=str, help='Fastx ID filter to slice from specific sequence (only works for one ID)')
+    parser.add_argument('--no_cache', action='store_true', help='Do not create or read the 2-bit sequence cache of a FASTA input')
+    parser.add_argument('--format', choices=['fasta', 'fastq'], default=None, help='Input format, detected from file extension or first byte if not set')
+    parser.add_argument('--out_format', choices=['fasta', 'fastq'], default=None, help='Output format, taken from file extension or input format if not set')
+    paired = parser.add_argument_group('paired-end reads', 'Slice mates in lockstep, inFastx and outFastx hold R1 (or interleaved pairs)')
+    paired.add_argument('--in2', type=str, default=None, help='Fastx file with R2 mates')
+    paired.add_argument('--out2', type=str, default=None, help='Fastx file for sliced R2 mates, interleaved into outFastx if not set')
+    paired.add_argument('--interleaved', action='store_true', help='inFastx contains interleaved R1/R2 mates')
+    parser.add_argument('--pipelined', action='store_true', help='Read, slice and write on separate threads to overlap I/O with slicing')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE, help='Number of records per batch handed between threads in --pipelined mode')
+    parser.add_argument('--queue_depth', type=int, default=QUEUE_DEPTH, help='Number of batches or compressed chunks buffered between threads')
     return parser.parse_args()
 
 def getSliceRegion(position : int, range : int, lowerbound : int, upperbound : int) -> tuple:
@@ -74,37 +89,121 @@ def getSliceRegion(position : int, range : int, lowerbound : int, upperbound : i
 
     return tuple(slice)
 
-def sliceFastx(inFastx : str, outFastx : str, slice : tuple, id : str = None) -> list:
+def sliceFastx(inFastx : str, outFastx : str, slice : tuple, id : str = None, useCache : bool = True, informat : str = None, outformat : str = None, append : bool = False, pipelined : bool = False, batchSize : int = BATCH_SIZE, queueDepth : int = QUEUE_DEPTH) -> list:
     '''
     Slice sequences and write new Fastx
 
     Parameters
     ----------
     inFastx : str
-        Fastx file path for incoming sequences
+        Fastx file path for incoming sequences, - for stdin
     outFastx : str
-        Fastx file path for outgoing sliced sequences
+        Fastx file path for outgoing sliced sequences, - for stdout
     slice : tuple
         Tuple containing the 0-based [included, excluded) slice interval
     id : str = None
         Only slice one specific sequence from incoming Fastx file
+    useCache : bool = True
+        Read FASTA input from the 2-bit sequence cache
+    informat : str = None
+        Input format, detected if None
+    outformat : str = None
+        Output format, taken from file extension or input format if None
+    append : bool = False
+        Append slices to an existing outFastx
+    pipelined : bool = False
+        Read, slice and write on separate threads, records are not kept
+    batchSize : int = BATCH_SIZE
+        Number of records per batch handed between threads
+    queueDepth : int = QUEUE_DEPTH
+        Number of batches buffered between threads
+
+    Returns
+    -------
+    slicedRecords : list
+        sliced SeqRecords, None if pipelined
     '''
-    slicedRecords = []
-    informat = FORMATS[os.path.splitext(inFastx)[1]].lower()
+    handle, informat = openInput(inFastx, informat, queueDepth)
 
-    for record in SeqIO.parse(inFastx, informat):
-        # with id filter
-        if id and record.id == id:
-            sliceRecord(record, slice, informat)
-            slicedRecords.append(record)
+    if informat == 'fasta' and inFastx != STDIO:
+        handle.close()
+        records = parseFasta(inFastx, useCache, {id} if id else None)
+    else:
+        records = SeqIO.parse(handle, informat)
 
-        elif not id:
-            sliceRecord(record, slice, informat)
-            slicedRecords.append(record)
+    def sliced(records):
+        for record in records:
+            # with id filter
+            if not id or record.id == id:
+                sliceRecord(record, slice, informat)
+                yield record
 
-    SeqIO.write(slicedRecords, outFastx, FORMATS[os.path.splitext(outFastx)[1].lower()])
+    out, outformat = openOutput(outFastx, outformat, append, queueDepth)
+    if pipelined:
+        slicedRecords = None
+        writeBehind(sliced(readAhead(records, batchSize, queueDepth)), out, outformat or informat, batchSize, queueDepth)
+    else:
+        slicedRecords = list(sliced(records))
+        SeqIO.write(slicedRecords, out, outformat or informat)
+    out.close()
+    handle.close()
     return slicedRecords
 
+def slicePairedFastx(in1 : str, in2 : str, out1 : str, out2 : str, slice : tuple, id : str = None, informat : str = None, outformat : str = None, append : bool = False) -> int:
+    '''
+    Slice both mates of paired reads and write synchronized Fastx files
+
+    Parameters
+    ----------
+    in1 : str
+        Fastx file path with R1 mates or interleaved pairs, - for stdin
+    in2 : str
+        Fastx file path with R2 mates, None if in1 is interleaved
+    out1 : str
+        Fastx file path for sliced R1 mates, - for stdout
+    out2 : str
+        Fastx file path for sliced R2 mates, pairs are interleaved into out1 if None
+    slice : tuple
+        Tuple containing the 0-based [included, excluded) slice interval
+    id : str = None
+        Only slice one specific pair, compared without /1 and /2 mate suffix
+    informat : str = None
+        Input format, detected if None
+    outformat : str = None
+        Output format, taken from file extension or input format if None
+    append : bool = False
+        Append slices to existing outputs
+
+    Returns
+    -------
+    written : int
+        number of written pairs
+    '''
+    handle1, informat = openInput(in1, informat)
+    handle2 = openInput(in2, informat)[0] if in2 is not None else nullcontext()
+    with handle1, handle2:
+        if in2 is None:
+            pairs = iterInterleaved(SeqIO.parse(handle1, informat))
+        else:
+            pairs = iterPairs(SeqIO.parse(handle1, informat), SeqIO.parse(handle2, informat))
+
+        def sliced(pairs):
+            for r1, r2 in pairs:
+                if not id or mateID(r1.id) == mateID(id):
+                    sliceRecord(r1, slice, informat)
+                    sliceRecord(r2, slice, informat)
+                    yield r1, r2
+
+        o1, outformat = openOutput(out1, outformat, append)
+        o2 = openOutput(out2, outformat, append)[0] if out2 is not None else None
+        try:
+            written = writePairs(sliced(pairs), o1, o2, outformat or informat)
+        finally:
+            o1.close()
+            if o2 is not None:
+                o2.close()
+    return written
+
 def sliceRecord(record : SeqIO.SeqRecord, slice : tuple, format : str) -> None:
     assert len(record.seq) >= slice[1], f'Slice {slice} too large for sequence {record.id} with length {len(record.seq)}'
     a = slice[0]
@@ -117,6 +216,138 @@ def sliceRecord(record : SeqIO.SeqRecord, slice : tuple, format : str) -> None:
     if format == 'fastq':
         record.letter_annotations['phred_quality'] = phred_quality
 
+IUPAC = {
+    'A' : 'A',
+    'C' : 'C',
+    'G' : 'G',
+    'T' : 'TU',
+    'U' : 'TU',
+    'R' : 'AG',
+    'Y' : 'CTU',
+    'S' : 'CG',
+    'W' : 'ATU',
+    'K' : 'GTU',
+    'M' : 'AC',
+    'B' : 'CGTU',
+    'D' : 'AGTU',
+    'H' : 'ACTU',
+    'V' : 'ACG',
+    'N' : 'ACGTU',
+    }
+
+COMPLEMENT_IUPAC = str.maketrans('ACGTURYSWKMBDHVN', 'TGCAAYRSWMKVHDBN')
+
+def reverseComplementMotif(motif : str) -> str:
+    return motif.upper().translate(COMPLEMENT_IUPAC)[::-1]
+
+def compileMotif(motif : str):
+    '''
+    Compiles a literal or IUPAC-degenerate motif to a case-insensitive byte regex, T and U match each other.
+    The pattern is a lookahead, so finditer reports overlapping hits with their span in group 1.
+    '''
+    motif = motif.upper()
+    unknown = set(motif) - set(IUPAC)
+    assert motif and not unknown, f'Motif {motif} contains unknown IUPAC codes {"".join(sorted(unknown))}'
+    pattern = ''.join(IUPAC[b] if len(IUPAC[b]) == 1 else f'[{IUPAC[b]}]' for b in motif)
+    return re.compile(f'(?=({pattern}))'.encode(), re.IGNORECASE)
+
+def compileMotifs(motifs : list, strand : str = 'both') -> list:
+    '''
+    Returns (regex, motif, strand) for every motif and searched strand. Reverse hits are found by
+    searching the reverse complement of the motif in the read, so reads are never reverse complemented.
+    Palindromic motifs are searched once on the forward strand.
+    '''
+    patterns = []
+    for motif in motifs:
+        motif = motif.upper()
+        if strand in ('both', 'forward'):
+            patterns.append((compileMotif(motif), motif, '+'))
+        rc = reverseComplementMotif(motif)
+        if strand == 'reverse' or (strand == 'both' and rc != motif):
+            patterns.append((compileMotif(rc), motif, '-'))
+    return patterns
+
+def motifHits(seq : bytes, patterns : list) -> list:
+    '''
+    Returns (start, end, motif, strand) of every hit in seq, 0-based [start, end) on the read, sorted by position.
+    '''
+    hits = []
+    for regex, motif, strand in patterns:
+        for match in regex.finditer(seq):
+            hits.append((match.start(1), match.end(1), motif, strand))
+    hits.sort(key=lambda hit : hit[:2])
+    return hits
+
+def motifFastx(inFastx : str, outFastx : str, motifs : list, flank : int = 0, strand : str = 'both', fullWindows : bool = False, id : str = None, informat : str = None, outformat : str = None, append : bool = False) -> dict:
+    '''
+    Slices a window of flank nucleotides around every motif hit in one pass over the raw records.
+
+    The windows of a read are written as separate records with IDs <id>_<n>, numbered by position,
+    the header is annotated with the hit and the window as motif=<motif> strand=<+/-> hit=(a,b) sliced=(c,d),
+    1-based inclusive coordinates on the read. Windows are clipped at the read ends.
+
+    Parameters
+    ----------
+    inFastx : str
+        Fastx file path for incoming sequences, - for stdin
+    outFastx : str
+        Fastx file path for outgoing windows, - for stdout
+    motifs : list
+        literal or IUPAC-degenerate motifs
+    flank : int = 0
+        nucleotides up- and downstream of each hit
+    strand : str = 'both'
+        'both', 'forward' or 'reverse'
+    fullWindows : bool = False
+        skip hits whose window would be clipped at the read ends
+    id : str = None
+        Only search one specific sequence
+    informat : str = None
+        Input format, detected if None
+    outformat : str = None
+        Output format, taken from file extension or input format if None
+    append : bool = False
+        Append windows to an existing outFastx
+
+    Returns
+    -------
+    stats : dict
+        number of reads, reads with hits and written windows
+    '''
+    assert flank >= 0, 'Flank has to be positive'
+    patterns = compileMotifs(motifs, strand)
+    stats = {'reads' : 0, 'reads_with_hits' : 0, 'windows' : 0}
+    handle, informat = openInput(inFastx, informat)
+    out, outformat = openOutput(outFastx, outformat, append)
+    outformat = outformat or informat
+    assert outformat == 'fasta' or informat == 'fastq', 'Cannot write FASTQ windows without qualities'
+    wanted = id.encode() if id else None
+    with handle, out:
+        write = out.buffer.write
+        for header, seq, qual in iterRawRecords(handle.buffer, informat):
+            fields = header.split(maxsplit=1)
+            readID = fields[0] if fields else b''
+            if wanted is not None and readID != wanted:
+                continue
+            stats['reads'] += 1
+            hits = motifHits(seq, patterns)
+            n = 0
+            for start, end, motif, hitStrand in hits:
+                a, b = start - flank, end + flank
+                if fullWindows and (a < 0 or b > len(seq)):
+                    continue
+                a, b = max(0, a), min(len(seq), b)
+                n += 1
+                description = b'%s_%d%s motif=%s strand=%s hit=(%d,%d) sliced=(%d,%d)' % (readID, n, b' ' + fields[1] if len(fields) > 1 else b'', motif.encode(), hitStrand.encode(), start + 1, end, a + 1, b)
+                if outformat == 'fastq':
+                    write(b'@%s\n%s\n+\n%s\n' % (description, seq[a : b], qual[a : b]))
+                else:
+                    write(b'>%s\n%s\n' % (description, seq[a : b]))
+            if n:
+                stats['reads_with_hits'] += 1
+                stats['windows'] += n
+    return stats
+
 def slice_start(num_of_bases : int) -> tuple:
     '''
     Slice sequences and write new Fastx
@@ -151,18 +382,26 @@ def main() -> None:
     args = parse()
     id = args.id
     append = args.append
-    assert append or not os.path.exists(args.outFastx), f'{args.outFastx} already exists! Use a different name or --append'
-    assert os.path.splitext(args.inFastx)[1].lower() in FORMATS, 'Unknown format of input file'
-    assert os.path.splitext(args.outFastx)[1].lower() in FORMATS, 'Unknown format of output file'
+    assert append or args.outFastx == STDIO or not os.path.exists(args.outFastx), f'{args.outFastx} already exists! Use a different name or --append'
+
+    if args.motif is not None:
+        assert args.in2 is None and not args.interleaved, 'Motif mode does not support paired reads'
+        stats = motifFastx(args.inFastx, args.outFastx, args.motif, args.flank, args.motif_strand, args.full_windows, id, args.format, args.out_format, append)
+        log(f'Found {stats["windows"]} motif hits in {stats["reads_with_hits"]} of {stats["reads"]} reads')
+        return
 
     if args.slice_start is not None:
         slice = slice_start(args.slice_start)
     elif args.slice_end is not None:
         slice = slice_end(args.slice_end)
     else:
-        slice = getSliceRegion(args.position, args.range, args.lowerbound, args.upperbound)
+        slice = getSliceRegion(args.center, args.range, args.lowerbound, args.upperbound)
 
-    sliceFastx(args.inFastx, args.outFastx, slice, id)
+    if args.in2 is not None or args.interleaved:
+        assert append or args.out2 is None or not os.path.exists(args.out2), f'{args.out2} already exists! Use a different name or --append'
+        slicePairedFastx(args.inFastx, args.in2, args.outFastx, args.out2, slice, id, args.format, args.out_format, append)
+    else:
+        sliceFastx(args.inFastx, args.outFastx, slice, id, not args.no_cache, args.format, args.out_format, append, args.pipelined, args.batch_size, args.queue_depth)
 
 if __name__ == '__main__':
     main()
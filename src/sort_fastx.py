@@ -0,0 +1,218 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+External merge sort of FASTA/FASTQ records by read ID, length or mean quality.
+
+Records are collected until the memory budget is reached, sorted and spilled as a run into a
+temporary file in a compact binary format (sort key, field lengths and the raw header, sequence
+and quality bytes, no line syntax). The runs are k-way merged into the output, more runs than
+the fan-in are merged in several passes, so inputs of any size are sorted with bounded memory.
+The sort is stable, reads with equal keys keep their input order.
+'''
+
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+
+from src.fastx_io import STDIO, openInput, openOutput, log
+from src.recordbatch import RecordBatch, iterRawRecords
+
+# ascending by ID, descending by length and mean quality
+SORT_KEYS = ['id', 'length', 'quality']
+
+# sort key, header length, sequence length, quality length (-1 for FASTA)
+RUN_RECORD = struct.Struct('<dIIi')
+
+# estimated Python object overhead per record held in memory
+RECORD_OVERHEAD = 200
+MEMORY = 1024
+MAX_FANIN = 128
+
+def idKey(header : bytes) -> bytes:
+    fields = header.split(maxsplit=1)
+    return fields[0] if fields else b''
+
+def sortKeys(records : list, by : str, reverse : bool = False) -> np.ndarray:
+    '''
+    Numeric sort keys of raw records, ascending keys give the sort order. IDs are compared as bytes instead, their keys are 0.
+    Reads without bases are sorted last by quality.
+    '''
+    if by == 'id' or not records:
+        return np.zeros(len(records))
+    batch = RecordBatch.fromRecords(records)
+    if by == 'length':
+        keys = -batch.lengths().astype(np.float64)
+    else:
+        assert batch.qual is not None, 'Sorting by quality needs FASTQ input'
+        keys = -np.nan_to_num(batch.meanQuality(), nan=-np.inf, posinf=np.finfo(np.float64).max)
+    return -keys if reverse else keys
+
+def sortRun(records : list, by : str, reverse : bool = False) -> list:
+    '''
+    Returns (key, record) tuples sorted stably.
+    '''
+    keys = sortKeys(records, by, reverse)
+    if by == 'id':
+        order = sorted(range(len(records)), key=lambda i : idKey(records[i][0]), reverse=reverse)
+    else:
+        order = np.argsort(keys, kind='stable').tolist()
+    keys = keys.tolist()
+    return [(keys[i], records[i]) for i in order]
+
+def writeRun(run, path : str) -> int:
+    '''
+    Writes (key, record) tuples in the binary run format, returns the number of records.
+    '''
+    n = 0
+    with open(path, 'wb', buffering=1 << 20) as out:
+        for key, (header, seq, qual) in run:
+            out.write(RUN_RECORD.pack(key, len(header), len(seq), -1 if qual is None else len(qual)))
+            out.write(header)
+            out.write(seq)
+            if qual is not None:
+                out.write(qual)
+            n += 1
+    return n
+
+def readRun(path : str, bufferSize : int = 1 << 20):
+    '''
+    Yields (key, record) tuples of a run file.
+    '''
+    with open(path, 'rb', buffering=bufferSize) as run:
+        while True:
+            fixed = run.read(RUN_RECORD.size)
+            if not fixed:
+                return
+            key, headerLen, seqLen, qualLen = RUN_RECORD.unpack(fixed)
+            header = run.read(headerLen)
+            seq = run.read(seqLen)
+            qual = run.read(qualLen) if qualLen >= 0 else None
+            yield key, (header, seq, qual)
+
+def mergeRuns(runs : list, by : str, reverse : bool = False):
+    '''
+    k-way merges sorted (key, record) iterables, equal keys keep the order of the runs.
+    '''
+    if by == 'id':
+        return heapq.merge(*runs, key=lambda item : idKey(item[1][0]), reverse=reverse)
+    return heapq.merge(*runs, key=lambda item : item[0])
+
+def writeRecords(records, handle, format : str) -> int:
+    '''
+    Writes raw (header, sequence, quality) records to a binary handle, returns the number of records.
+    '''
+    n = 0
+    for header, seq, qual in records:
+        if format == 'fastq':
+            assert qual is not None, 'Cannot write FASTQ without qualities'
+            handle.write(b'@%s\n%s\n+\n%s\n' % (header, seq, qual))
+        else:
+            handle.write(b'>%s\n%s\n' % (header, seq))
+        n += 1
+    return n
+
+def spillRuns(records, by : str, reverse : bool, budget : int, tmp : str) -> tuple:
+    '''
+    Splits the records into sorted runs of at most budget bytes, all runs but the last are written to tmp.
+
+    Returns
+    -------
+    paths : list
+        run files
+    last : list
+        sorted (key, record) tuples of the last run, kept in memory
+    '''
+    paths = []
+    chunk = []
+    size = 0
+    for record in records:
+        chunk.append(record)
+        size += len(record[0]) + len(record[1]) + (len(record[2]) if record[2] is not None else 0) + RECORD_OVERHEAD
+        if size >= budget:
+            path = os.path.join(tmp, f'run_{len(paths):06d}.bin')
+            writeRun(sortRun(chunk, by, reverse), path)
+            paths.append(path)
+            log(f'Spilled run {len(paths)} with {len(chunk)} reads')
+            chunk = []
+            size = 0
+    return paths, sortRun(chunk, by, reverse)
+
+def sortFastx(inFastx : str, outFastx : str, by : str = 'id', reverse : bool = False, memory : int = MEMORY, tmpDir : str = None, informat : str = None, outformat : str = None, fanIn : int = MAX_FANIN) -> dict:
+    '''
+    Sorts a FASTX file with bounded memory.
+
+    Parameters
+    ----------
+    inFastx : str
+        input FASTA/FASTQ, - for stdin
+    outFastx : str
+        output FASTA/FASTQ, - for stdout
+    by : str = 'id'
+        'id' (ascending), 'length' or 'quality' (mean quality, descending)
+    reverse : bool = False
+        reverse the order
+    memory : int = MEMORY
+        memory budget for records in MB
+    tmpDir : str = None
+        directory for the run files, needs about the size of the uncompressed input
+    informat : str = None
+        input format, detected if None
+    outformat : str = None
+        output format, taken from the output path or input format if None
+    fanIn : int = MAX_FANIN
+        maximum number of runs merged at once
+
+    Returns
+    -------
+    stats : dict
+        number of sorted reads and spilled runs
+    '''
+    assert by in SORT_KEYS, f'Unknown sort key {by}'
+    assert fanIn >= 2, 'At least two runs have to be merged at once'
+    budget = memory << 20
+    inp, informat = openInput(inFastx, informat)
+    with tempfile.TemporaryDirectory(dir=tmpDir, prefix='sort_') as tmp:
+        with inp:
+            paths, last = spillRuns(iterRawRecords(inp.buffer, informat), by, reverse, budget, tmp)
+        runs = len(paths) + 1
+        # half of the budget for read buffers of the merged runs
+        bufferSize = max(1 << 16, min(1 << 20, budget // (2 * min(fanIn, runs))))
+        # merge passes until the remaining runs and the in-memory run fit the fan-in
+        passes = 0
+        while len(paths) + 1 > fanIn:
+            merged = []
+            for start in range(0, len(paths), fanIn):
+                group = paths[start : start + fanIn]
+                if len(group) == 1:
+                    merged.extend(group)
+                    continue
+                path = os.path.join(tmp, f'pass_{passes}_{start // fanIn:06d}.bin')
+                writeRun(mergeRuns([readRun(p, bufferSize) for p in group], by, reverse), path)
+                for p in group:
+                    os.remove(p)
+                merged.append(path)
+            paths = merged
+            passes += 1
+
+        out, outformat = openOutput(outFastx, outformat)
+        with out:
+            records = (record for _, record in mergeRuns([readRun(p, bufferSize) for p in paths] + [iter(last)], by, reverse))
+            written = writeRecords(records, out.buffer, outformat or informat)
+    return {'reads' : written, 'runs' : runs, 'passes' : passes}
+
+def sortOutput(inFastx : str, outFastx : str, by : str, reverse : bool, memory : int, tmpDir : str, informat : str, outformat : str, force : bool) -> None:
+    assert force or outFastx == STDIO or not os.path.exists(outFastx), f'{outFastx} already exists!'
+    if tmpDir is None and outFastx != STDIO:
+        tmpDir = os.path.dirname(os.path.abspath(outFastx))
+    if tmpDir is not None:
+        free = shutil.disk_usage(tmpDir).free
+        if inFastx != STDIO and free < os.path.getsize(inFastx):
+            log(f'Warning: {tmpDir} has only {free >> 20} MB free, the runs need about the size of the uncompressed input')
+    stats = sortFastx(inFastx, outFastx, by, reverse, memory, tmpDir, informat, outformat)
+    log(f'Sorted {stats["reads"]} reads by {by} in {stats["runs"]} runs and {stats["passes"]} extra merge passes')
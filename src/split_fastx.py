@@ -0,0 +1,210 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Splitting uncompressed FASTA/FASTQ files into parts without parsing the records.
+
+Part boundaries are placed at byte offsets and moved forward to the next record start, which is
+found by looking at a few lines after the offset: a FASTA record starts with a '>' line, a FASTQ
+record with an '@' line followed by a '+' line two lines later (a quality line may start with '@',
+but a sequence line never starts with '+'). The byte ranges are copied in the kernel with
+os.copy_file_range or os.sendfile where available. A manifest lists every part with its byte
+range and number of records.
+'''
+
+import mmap
+import os
+import re
+
+from src.fastx_io import GZIP_MAGIC, formatFromPath, sniffFormat, log
+from src.checkpoint import copyRange
+
+SIZE_UNITS = {'' : 1, 'K' : 1 << 10, 'M' : 1 << 20, 'G' : 1 << 30, 'T' : 1 << 40}
+WINDOW = 1 << 16
+COUNT_CHUNK = 1 << 26
+
+def parseSize(size : str) -> int:
+    '''
+    Parses a byte size like 500M or 2G.
+    '''
+    match = re.fullmatch(r'(\d+)\s*([KMGT]?)B?', size.strip().upper())
+    assert match, f'Invalid size {size}, use e.g. 500M or 2G'
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def _lineStarts(data : bytes, start : int) -> list:
+    '''
+    Offsets in data of the lines starting at or after start, start itself only if it begins a line.
+    '''
+    if start == 0 or data[start - 1 : start] == b'\n':
+        pos = start
+    else:
+        pos = data.find(b'\n', start) + 1
+        if pos == 0:
+            return []
+    starts = []
+    while pos < len(data):
+        starts.append(pos)
+        pos = data.find(b'\n', pos) + 1
+        if pos == 0:
+            break
+    return starts
+
+def _count(data, sub : bytes, start : int, end : int) -> int:
+    '''
+    Counts sub in data[start:end] in chunks, mmap objects have no count method.
+    '''
+    n = 0
+    for a in range(start, end, COUNT_CHUNK):
+        # chunks overlap by len(sub) - 1 bytes, matches are counted in the chunk they start in
+        n += data[a : min(a + COUNT_CHUNK + len(sub) - 1, end)].count(sub)
+    return n
+
+def nextRecord(data, offset : int, format : str) -> int:
+    '''
+    Returns the offset of the first record starting at or after offset, len(data) if there is none.
+
+    Parameters
+    ----------
+    data : mmap or bytes
+        whole file
+    offset : int
+        position to search from
+    format : str
+        'fasta' or 'fastq'
+    '''
+    size = len(data)
+    if offset <= 0:
+        return 0
+    if offset >= size:
+        return size
+    if format == 'fasta':
+        pos = data.find(b'\n>', offset - 1)
+        return size if pos < 0 else pos + 1
+    window = WINDOW
+    while True:
+        # one byte before offset to know if offset starts a line
+        begin = offset - 1
+        chunk = data[begin : offset + window]
+        lines = _lineStarts(chunk, 1)
+        complete = offset + window >= size
+        for i in range(len(lines) - 2):
+            if chunk[lines[i] : lines[i] + 1] == b'@' and chunk[lines[i + 2] : lines[i + 2] + 1] == b'+':
+                return begin + lines[i]
+        if complete:
+            return size
+        window *= 4
+
+def countRecords(data, start : int, end : int, format : str) -> int:
+    '''
+    Counts the records in data[start:end], which starts at a record boundary, by counting line breaks.
+    '''
+    if start >= end:
+        return 0
+    if format == 'fasta':
+        return _count(data, b'\n>', start, end) + 1
+    lines = _count(data, b'\n', start, end)
+    if data[end - 1 : end] != b'\n':
+        lines += 1
+    return (lines + 3) // 4
+
+def recordBoundaries(data, format : str, records : int) -> list:
+    '''
+    Start offsets of every records-th record, found by counting lines or '>' line starts.
+    '''
+    boundaries = [0]
+    size = len(data)
+    if format == 'fasta':
+        pos = 0
+        while True:
+            for _ in range(records):
+                pos = data.find(b'\n>', pos + 1)
+                if pos < 0:
+                    return boundaries
+            boundaries.append(pos + 1)
+    # FASTQ, every 4 * records lines
+    pos = 0
+    lines = 4 * records
+    while pos < size:
+        for _ in range(lines):
+            pos = data.find(b'\n', pos) + 1
+            if pos <= 0:
+                return boundaries
+        if pos < size:
+            boundaries.append(pos)
+    return boundaries
+
+def splitFastx(inFastx : str, outDir : str, parts : int = None, size : int = None, records : int = None, format : str = None, prefix : str = None) -> list:
+    '''
+    Splits an uncompressed FASTX file at record boundaries. Exactly one of parts, size and records is given.
+
+    Parameters
+    ----------
+    inFastx : str
+        uncompressed FASTA/FASTQ file, FASTQ records need four lines
+    outDir : str
+        directory for the parts and the manifest
+    parts : int = None
+        number of parts of about equal size
+    size : int = None
+        target size of the parts in bytes
+    records : int = None
+        number of records per part
+    format : str = None
+        'fasta' or 'fastq', detected if None
+    prefix : str = None
+        name of the parts before .part_<i>, input file name without extension if None
+
+    Returns
+    -------
+    manifest : list
+        (path, start, end, records) per part
+    '''
+    assert sum(x is not None for x in (parts, size, records)) == 1, 'Give exactly one of parts, size and records'
+    with open(inFastx, 'rb') as raw:
+        assert raw.read(2) != GZIP_MAGIC, f'{inFastx} is compressed, only uncompressed files can be split at byte offsets'
+        raw.seek(0)
+        format = format or formatFromPath(inFastx) or sniffFormat(raw)
+    assert format is not None, f'Unknown format of {inFastx}'
+    stem, ext = os.path.splitext(os.path.basename(inFastx))
+    prefix = prefix or stem
+    os.makedirs(outDir, exist_ok=True)
+    fileSize = os.path.getsize(inFastx)
+    manifest = []
+    with open(inFastx, 'rb') as raw:
+        data = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) if fileSize else b''
+        try:
+            if records is not None:
+                assert records > 0, 'Number of records has to be positive'
+                boundaries = recordBoundaries(data, format, records)
+            else:
+                if parts is not None:
+                    assert parts > 0, 'Number of parts has to be positive'
+                    size = -(-fileSize // parts)
+                assert size > 0, 'Part size has to be positive'
+                boundaries = sorted(set(nextRecord(data, offset, format) for offset in range(0, fileSize, size)))
+            boundaries = [b for b in boundaries if b < fileSize] or [0]
+            ends = boundaries[1:] + [fileSize]
+            width = max(4, len(str(len(boundaries))))
+            for i, (start, end) in enumerate(zip(boundaries, ends)):
+                path = os.path.join(outDir, f'{prefix}.part_{i + 1:0{width}d}{ext}')
+                with open(path, 'wb') as out:
+                    copyRange(raw.fileno(), out.fileno(), start, end - start)
+                manifest.append((path, start, end, countRecords(data, start, end, format)))
+        finally:
+            if fileSize:
+                data.close()
+    return manifest
+
+def writeManifest(manifest : list, path : str) -> None:
+    with open(path, 'w') as out:
+        out.write('part\tpath\tstart\tend\tbytes\trecords\n')
+        for i, (part, start, end, records) in enumerate(manifest):
+            out.write(f'{i + 1}\t{part}\t{start}\t{end}\t{end - start}\t{records}\n')
+
+def splitOutput(inFastx : str, outDir : str, parts : int, size : str, records : int, format : str, prefix : str) -> None:
+    manifest = splitFastx(inFastx, outDir, parts, parseSize(size) if size is not None else None, records, format, prefix)
+    manifestPath = os.path.join(outDir, f'{prefix or os.path.splitext(os.path.basename(inFastx))[0]}.manifest.tsv')
+    writeManifest(manifest, manifestPath)
+    log(f'Wrote {len(manifest)} parts with {sum(part[3] for part in manifest)} records, manifest {manifestPath}')
@@ -0,0 +1,204 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Single-pass read length statistics for FASTA/FASTQ files.
+
+Lengths are collected in a log-binned histogram with 64 bins per power of two (~1% bin width)
+that also keeps the exact sum of lengths per bin. Read count, total bases, mean, shortest and
+longest read are exact, the bin containing N50/N90 is exact and the value inside that bin is
+interpolated. The exact mode counts every distinct length instead.
+'''
+
+from collections import Counter
+import os
+import numpy as np
+
+from src.fastx_io import STDIO, openInput
+from src.recordbatch import iterBatches
+
+SUB_BINS = 64
+MAX_OCTAVE = 48
+
+class LengthHistogram:
+    '''
+    Streaming histogram of read lengths with constant memory.
+    '''
+
+    def __init__(self, exact : bool = False) -> None:
+        self.counts = np.zeros(MAX_OCTAVE * SUB_BINS + 1, dtype=np.int64)
+        self.sums = np.zeros(MAX_OCTAVE * SUB_BINS + 1, dtype=np.int64)
+        self.exact = Counter() if exact else None
+        self.shortest = None
+        self.longest = 0
+
+    @staticmethod
+    def binOf(lengths : np.ndarray) -> np.ndarray:
+        '''
+        Bin 0 holds empty reads, bin i > 0 holds lengths in [lowerBound(i), lowerBound(i+1)).
+        '''
+        lengths = np.asarray(lengths, dtype=np.float64)
+        bins = np.zeros(len(lengths), dtype=np.int64)
+        nonzero = lengths > 0
+        bins[nonzero] = np.floor(np.log2(lengths[nonzero]) * SUB_BINS).astype(np.int64) + 1
+        return bins
+
+    @staticmethod
+    def lowerBound(bins : np.ndarray) -> np.ndarray:
+        return np.where(bins > 0, np.ceil(2 ** ((np.asarray(bins) - 1) / SUB_BINS)), 0)
+
+    def add(self, lengths : np.ndarray) -> None:
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if not len(lengths):
+            return
+        bins = self.binOf(lengths)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+        self.sums += np.bincount(bins, weights=lengths, minlength=len(self.sums)).astype(np.int64)
+        self.longest = max(self.longest, int(lengths.max()))
+        self.shortest = int(lengths.min()) if self.shortest is None else min(self.shortest, int(lengths.min()))
+        if self.exact is not None:
+            values, counts = np.unique(lengths, return_counts=True)
+            self.exact.update(dict(zip(values.tolist(), counts.tolist())))
+
+    def _distribution(self) -> tuple:
+        '''
+        Returns sorted lengths (or bin lower bounds), upper bounds, counts and base sums.
+        '''
+        if self.exact is not None:
+            lengths = np.array(sorted(self.exact), dtype=np.int64)
+            counts = np.array([self.exact[length] for length in lengths], dtype=np.int64)
+            return lengths, lengths, counts, lengths * counts
+        used = np.flatnonzero(self.counts)
+        lower = self.lowerBound(used)
+        upper = np.maximum(self.lowerBound(used + 1) - 1, lower)
+        return lower, upper, self.counts[used], self.sums[used]
+
+    def nx(self, x : float) -> float:
+        '''
+        Length L such that reads of length >= L contain x percent of all bases.
+        '''
+        lower, upper, counts, sums = self._distribution()
+        if not len(counts):
+            return 0
+        target = sums.sum() * x / 100
+        covered = np.cumsum(sums[::-1])[::-1]
+        i = int(np.flatnonzero(covered >= target)[-1])
+        if self.exact is not None:
+            return int(lower[i])
+        # bases of reads longer than bin i, the rest of target is covered inside bin i
+        above = covered[i] - sums[i]
+        mean = sums[i] / counts[i]
+        inside = np.ceil((target - above) / mean)
+        estimate = upper[i] - (inside - 1) * (upper[i] - lower[i]) / max(counts[i], 1)
+        return float(np.clip(np.round(estimate), lower[i], upper[i]))
+
+    def quantile(self, q : float) -> float:
+        '''
+        Read length quantile q in [0, 1] over reads.
+        '''
+        lower, upper, counts, _ = self._distribution()
+        if not len(counts):
+            return 0
+        cumulative = np.cumsum(counts)
+        rank = q * (cumulative[-1] - 1)
+        i = int(np.searchsorted(cumulative, rank, side='right'))
+        if self.exact is not None:
+            return int(lower[i])
+        before = cumulative[i] - counts[i]
+        return float(lower[i] + (upper[i] - lower[i]) * (rank - before) / max(counts[i], 1))
+
+    def summary(self) -> dict:
+        reads = int(self.counts.sum())
+        total = int(self.sums.sum())
+        return {
+            'reads' : reads,
+            'bases' : total,
+            'mean' : total / reads if reads else 0,
+            'shortest' : self.shortest or 0,
+            'longest' : self.longest,
+            'N50' : self.nx(50),
+            'N90' : self.nx(90),
+            'Q10' : self.quantile(0.1),
+            'Q25' : self.quantile(0.25),
+            'median' : self.quantile(0.5),
+            'Q75' : self.quantile(0.75),
+            'Q90' : self.quantile(0.9),
+        }
+
+    def histogram(self, binsPerOctave : int = 2) -> list:
+        '''
+        Coarse log-binned histogram as a list of (lower bound, upper bound, reads, bases).
+        '''
+        assert SUB_BINS % binsPerOctave == 0, f'bins per octave must divide {SUB_BINS}'
+        step = SUB_BINS // binsPerOctave
+        rows = []
+        if self.counts[0]:
+            rows.append((0, 0, int(self.counts[0]), 0))
+        coarse = (np.arange(1, len(self.counts)) - 1) // step
+        counts = np.bincount(coarse, weights=self.counts[1:]).astype(np.int64)
+        sums = np.bincount(coarse, weights=self.sums[1:]).astype(np.int64)
+        for c in np.flatnonzero(counts):
+            lower = int(self.lowerBound(np.array([c * step + 1]))[0])
+            upper = int(self.lowerBound(np.array([(c + 1) * step + 1]))[0]) - 1
+            rows.append((lower, max(lower, upper), int(counts[c]), int(sums[c])))
+        return rows
+
+def indexLengths(fastx : str):
+    '''
+    Returns read lengths from a samtools faidx/fqidx index `<fastx>.fai`, None if there is no
+    up to date index.
+    '''
+    fai = fastx + '.fai'
+    if fastx == STDIO or not os.path.isfile(fai) or os.path.getmtime(fai) < os.path.getmtime(fastx):
+        return None
+    lengths = []
+    with open(fai, 'r') as index:
+        for line in index:
+            fields = line.split('\t')
+            if len(fields) > 1:
+                lengths.append(int(fields[1]))
+    return np.array(lengths, dtype=np.int64)
+
+def lengthStats(fastx : str, format : str = None, exact : bool = False, useIndex : bool = True, batchSize : int = 10000) -> LengthHistogram:
+    '''
+    Collects read lengths of a FASTX file in one streaming pass.
+
+    Parameters
+    ----------
+    fastx : str
+        FASTA/FASTQ file, - for stdin
+    format : str = None
+        'fasta' or 'fastq', detected if None
+    exact : bool = False
+        count every distinct length for exact N50 and quantiles
+    useIndex : bool = True
+        read lengths from `<fastx>.fai` if present
+    batchSize : int = 10000
+        number of reads parsed per batch
+
+    Returns
+    -------
+    histogram : LengthHistogram
+    '''
+    histogram = LengthHistogram(exact)
+    lengths = indexLengths(fastx) if useIndex else None
+    if lengths is not None:
+        histogram.add(lengths)
+        return histogram
+    handle, format = openInput(fastx, format)
+    with handle:
+        for batch in iterBatches(handle.buffer, format, batchSize):
+            histogram.add(batch.lengths())
+    return histogram
+
+def output(histogram : LengthHistogram, binsPerOctave : int = 2) -> None:
+    for key, item in histogram.summary().items():
+        print(f'{key}: {item:.1f}' if isinstance(item, float) else f'{key}: {item}')
+    rows = histogram.histogram(binsPerOctave)
+    if rows:
+        print('\nlength\treads\tbases')
+        peak = max(row[2] for row in rows)
+        for lower, upper, reads, bases in rows:
+            print(f'{lower}-{upper}\t{reads}\t{bases}\t{"#" * int(np.ceil(50 * reads / peak))}')
@@ -0,0 +1,259 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Compact binary cache for FASTA references, similar to UCSC .2bit.
+
+Bases are stored with 2 bits each (A=0, C=1, G=2, T/U=3). Runs of ambiguous bases (e.g. N)
+and soft-masked (lowercase) blocks are stored as interval lists, so the original sequence is
+restored exactly. Code 3 is decoded as the more frequent of T and U in a contig, the other one is
+stored as exception runs like ambiguous bases. Per-contig base counts are precomputed while building the cache.
+
+The cache is written next to the FASTA as `<fasta>.fx2b` on first use and rebuilt whenever the
+modification time or size of the source FASTA changes.
+'''
+
+import os
+import struct
+import numpy as np
+from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
+
+from src.fastx_io import openInput
+
+MAGIC = b'FX2B'
+VERSION = 2
+SUFFIX = '.fx2b'
+
+# magic, version, source mtime in ns, source size, number of contigs
+HEADER = struct.Struct('<4sHqqI')
+# header length, sequence length, rna flag, ambiguous blocks, mask blocks, counted symbols
+CONTIG = struct.Struct('<IQBIII')
+
+ENCODE = np.zeros(256, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    ENCODE[base] = code
+ENCODE[ord('U')] = 3
+
+DNA = np.frombuffer(b'ACGT', dtype=np.uint8)
+RNA = np.frombuffer(b'ACGU', dtype=np.uint8)
+ACCURATE = np.zeros(256, dtype=bool)
+ACCURATE[list(b'ACGTU')] = True
+
+def cachePath(fasta : str) -> str:
+    return fasta + SUFFIX
+
+def _runs(mask : np.ndarray, values : np.ndarray = None) -> tuple:
+    '''
+    Returns start positions and lengths of consecutive True runs in mask.
+    If values are given, runs are additionally split where the value changes.
+    '''
+    idx = np.flatnonzero(mask)
+    if not len(idx):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    breaks = np.diff(idx) != 1
+    if values is not None:
+        breaks |= values[idx[1:]] != values[idx[:-1]]
+    breaks = np.flatnonzero(breaks) + 1
+    starts = idx[np.r_[0, breaks]]
+    ends = idx[np.r_[breaks - 1, len(idx) - 1]] + 1
+    return starts.astype(np.int64), (ends - starts).astype(np.int64)
+
+def encode(seq : str) -> dict:
+    '''
+    2-bit encodes a sequence.
+
+    Parameters
+    ----------
+    seq : str
+        nucleotide sequence, may contain ambiguous and lowercase (soft-masked) bases
+
+    Returns
+    -------
+    entry : dict
+        length, rna flag, packed bases, ambiguous and mask blocks and base counts
+    '''
+    raw = np.frombuffer(seq.encode(), dtype=np.uint8)
+    masked = raw >= ord('a')
+    upper = np.where(masked, raw - 32, raw).astype(np.uint8)
+    counts = np.bincount(upper, minlength=256)
+    rna = bool(counts[ord('U')] > counts[ord('T')])
+    # code 3 decodes to one of T and U, the other one is kept exactly as exception runs
+    ambiguous = ~ACCURATE[upper] | (upper == (ord('T') if rna else ord('U')))
+
+    codes = ENCODE[upper]
+    codes = np.concatenate((codes, np.zeros(-len(codes) % 4, dtype=np.uint8))).reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+
+    ambStarts, ambLengths = _runs(ambiguous, upper)
+    maskStarts, maskLengths = _runs(masked)
+    symbols = np.flatnonzero(counts).astype(np.uint8)
+
+    return {
+        'length' : len(raw),
+        'rna' : rna,
+        'packed' : packed.astype(np.uint8),
+        'amb' : (ambStarts, ambLengths, upper[ambStarts]),
+        'mask' : (maskStarts, maskLengths),
+        'counts' : (symbols, counts[symbols].astype(np.int64)),
+    }
+
+def buildCache(fasta : str, cache : str = None) -> str:
+    '''
+    Parses the FASTA once and writes the binary cache atomically.
+
+    Parameters
+    ----------
+    fasta : str
+        source FASTA file
+    cache : str = None
+        path of the cache, defaults to `<fasta>.fx2b`
+
+    Returns
+    -------
+    cache : str
+        path of the written cache
+    '''
+    cache = cache or cachePath(fasta)
+    stat = os.stat(fasta)
+    tmp = f'{cache}.{os.getpid()}.tmp'
+    try:
+        inp, _ = openInput(fasta, 'fasta')
+        with inp, open(tmp, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, VERSION, stat.st_mtime_ns, stat.st_size, 0))
+            n = 0
+            for title, seq in SimpleFastaParser(inp):
+                entry = encode(seq)
+                title = title.encode()
+                out.write(CONTIG.pack(len(title), entry['length'], entry['rna'], len(entry['amb'][0]), len(entry['mask'][0]), len(entry['counts'][0])))
+                out.write(title)
+                for array in (*entry['amb'], *entry['mask'], *entry['counts'], entry['packed']):
+                    out.write(array.tobytes())
+                n += 1
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, VERSION, stat.st_mtime_ns, stat.st_size, n))
+        os.replace(tmp, cache)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return cache
+
+def isValid(fasta : str, cache : str = None) -> bool:
+    '''
+    Checks if the cache exists and was built from the current state of the FASTA.
+    '''
+    cache = cache or cachePath(fasta)
+    if not os.path.isfile(cache):
+        return False
+    stat = os.stat(fasta)
+    with open(cache, 'rb') as c:
+        header = c.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return False
+    magic, version, mtime, size, _ = HEADER.unpack(header)
+    return magic == MAGIC and version == VERSION and mtime == stat.st_mtime_ns and size == stat.st_size
+
+class TwoBitFile:
+    '''
+    Reads a cache built by `buildCache`. Only the contig index is loaded on construction,
+    sequences are decoded on request.
+    '''
+
+    def __init__(self, cache : str) -> None:
+        self.path = cache
+        self.contigs = []
+        with open(cache, 'rb') as c:
+            magic, version, _, _, n = HEADER.unpack(c.read(HEADER.size))
+            assert magic == MAGIC and version == VERSION, f'{cache} is not a valid sequence cache'
+            for _ in range(n):
+                titleLen, length, rna, nAmb, nMask, nSym = CONTIG.unpack(c.read(CONTIG.size))
+                title = c.read(titleLen).decode()
+                amb = (np.fromfile(c, np.int64, nAmb), np.fromfile(c, np.int64, nAmb), np.fromfile(c, np.uint8, nAmb))
+                mask = (np.fromfile(c, np.int64, nMask), np.fromfile(c, np.int64, nMask))
+                symbols = np.fromfile(c, np.uint8, nSym)
+                counts = np.fromfile(c, np.int64, nSym)
+                self.contigs.append({
+                    'title' : title,
+                    'id' : title.split(maxsplit=1)[0] if title else '',
+                    'length' : length,
+                    'rna' : bool(rna),
+                    'amb' : amb,
+                    'mask' : mask,
+                    'counts' : {chr(s) : int(cnt) for s, cnt in zip(symbols, counts)},
+                    'offset' : c.tell(),
+                })
+                c.seek((length + 3) // 4, os.SEEK_CUR)
+
+    def counts(self) -> list:
+        '''
+        Returns the precomputed base counts per contig as a list of (id, counts) tuples.
+        '''
+        return [(contig['id'], contig['counts']) for contig in self.contigs]
+
+    def sequence(self, contig : dict, start : int = 0, end : int = None) -> str:
+        '''
+        Decodes the interval 0-based [start, end) of a contig.
+        '''
+        end = contig['length'] if end is None else min(end, contig['length'])
+        if start >= end:
+            return ''
+        with open(self.path, 'rb') as c:
+            c.seek(contig['offset'] + start // 4)
+            packed = np.fromfile(c, np.uint8, (end + 3) // 4 - start // 4)
+        codes = ((packed[:, None] >> np.array([6, 4, 2, 0], dtype=np.uint8)) & 3).ravel()
+        first = start - start % 4
+        seq = (RNA if contig['rna'] else DNA)[codes[start - first : end - first]]
+
+        ambStarts, ambLengths, ambChars = contig['amb']
+        for s, l, char in zip(ambStarts, ambLengths, ambChars):
+            a, b = max(s, start), min(s + l, end)
+            if a < b:
+                seq[a - start : b - start] = char
+        maskStarts, maskLengths = contig['mask']
+        for s, l in zip(maskStarts, maskLengths):
+            a, b = max(s, start), min(s + l, end)
+            if a < b:
+                seq[a - start : b - start] += 32
+        return seq.tobytes().decode()
+
+    def records(self, ids : set = None):
+        '''
+        Yields SeqRecords like SeqIO.parse(fasta, 'fasta'), optionally only for the given ids.
+        '''
+        for contig in self.contigs:
+            if ids is not None and contig['id'] not in ids:
+                continue
+            yield SeqRecord(Seq(self.sequence(contig)), id=contig['id'], name=contig['id'], description=contig['title'])
+
+def loadCache(fasta : str, build : bool = True) -> TwoBitFile:
+    '''
+    Returns the cache of the FASTA, builds it if it is missing or outdated.
+    Returns None if the cache cannot be used, e.g. the directory is not writable.
+    '''
+    cache = cachePath(fasta)
+    try:
+        if not isValid(fasta, cache):
+            if not build:
+                return None
+            buildCache(fasta, cache)
+        return TwoBitFile(cache)
+    except (OSError, AssertionError, struct.error):
+        return None
+
+def parseFasta(fasta : str, useCache : bool = True, ids : set = None):
+    '''
+    Iterates the records of a FASTA file, reading from the sequence cache if possible.
+    '''
+    twobit = loadCache(fasta) if useCache else None
+    if twobit is not None:
+        yield from twobit.records(ids)
+    else:
+        handle, _ = openInput(fasta, 'fasta')
+        with handle:
+            for record in SeqIO.parse(handle, 'fasta'):
+                if ids is None or record.id in ids:
+                    yield record
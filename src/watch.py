@@ -0,0 +1,221 @@
+# author: Jannes Spangenberg
+# e-mail: jannes.spangenberg@uni-jena.de
+# github: https://github.com/JannesSP
+# website: https://jannessp.github.io
+
+'''
+Incremental processing of FASTX files appearing in a directory during a live sequencing run.
+
+New files are processed once they are complete: on Linux inotify reports files that were closed
+after writing or moved into the directory, elsewhere (or if inotify is not available) the
+directory is polled and a file counts as complete once its size and modification time did not
+change for a settle time.
+
+A JSON checkpoint next to the outputs records every processed file and the size of every
+concatenated output after it. Each file is processed into part files first, the parts are
+appended and synced and only then the checkpoint is replaced atomically. After a crash, outputs
+are truncated to the sizes in the checkpoint, so a partly appended file is processed again and
+nothing is duplicated or lost.
+'''
+
+from argparse import ArgumentParser
+import ctypes
+import ctypes.util
+from fnmatch import fnmatch
+import os
+import select
+import struct
+import time
+
+from src.fastx_io import STDIO, formatFromPath, log
+from src.batch import appendPart, mergeStats
+from src.checkpoint import Checkpoint, partPath
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT = struct.Struct('iIII')
+
+POLL_INTERVAL = 10
+SETTLE = 30
+
+def addWatchArguments(parser : ArgumentParser) -> None:
+    watch = parser.add_argument_group('watch mode', 'Process new files in a directory (or matching a quoted glob) as they are completed, until interrupted')
+    watch.add_argument('--watch', action='store_true', help='Keep watching the input directory for new files')
+    watch.add_argument('--state', type=str, default=None, help='Checkpoint file of processed files, restarts continue from it, defaults to a .watch.json file next to the outputs')
+    watch.add_argument('--poll_interval', type=float, default=POLL_INTERVAL, help='Seconds between directory scans if inotify is not available')
+    watch.add_argument('--settle', type=float, default=SETTLE, help='Seconds a file has to be unchanged to count as complete when it was not reported closed by inotify')
+    watch.add_argument('--idle_exit', type=float, default=None, help='Stop after this many seconds without new files, e.g. at the end of a run')
+
+class Inotify:
+    '''
+    Minimal inotify binding via ctypes, reports names of files closed after writing or moved into a directory.
+    Raises an OSError or AttributeError if inotify is not available.
+    '''
+
+    def __init__(self, directory : str) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'Cannot watch {directory}')
+
+    def read(self, timeout : float = None) -> set:
+        '''
+        Waits up to timeout seconds (forever if None) and returns the names of completed files.
+        '''
+        names = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                names.add(os.fsdecode(data[offset : offset + length].rstrip(b'\0')))
+                offset += length
+        return names
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def openInotify(directory : str) -> Inotify:
+    try:
+        return Inotify(directory)
+    except (OSError, AttributeError):
+        return None
+
+def watchedDirectory(path : str) -> tuple:
+    '''
+    Returns the directory to watch and a function telling if a file name belongs to the input.
+    A directory matches all FASTA/FASTQ files, a glob matches file names with its last component.
+    '''
+    if os.path.isdir(path):
+        return path, lambda name : formatFromPath(name) is not None
+    directory, pattern = os.path.split(path)
+    directory = directory or '.'
+    assert os.path.isdir(directory), f'{directory} is not a directory, only the file name may contain wildcards'
+    return directory, lambda name : fnmatch(name, pattern)
+
+def completedFiles(path : str, checkpoint : Checkpoint, interval : float = POLL_INTERVAL, settle : float = SETTLE, idleExit : float = None):
+    '''
+    Yields files of the watched directory that are complete and not in the checkpoint, in sorted order per scan.
+
+    Parameters
+    ----------
+    path : str
+        directory or glob
+    checkpoint : Checkpoint
+        files in the checkpoint are skipped
+    interval : float = POLL_INTERVAL
+        seconds between scans without inotify
+    settle : float = SETTLE
+        seconds a file has to be unchanged to be complete without a close event
+    idleExit : float = None
+        return after this many seconds without a new file
+    '''
+    directory, matches = watchedDirectory(path)
+    inotify = openInotify(directory)
+    log(f'Watching {directory} with {"inotify" if inotify is not None else "polling"}')
+    seen = {}
+    closed = set()
+    lastNew = time.monotonic()
+    try:
+        while True:
+            pending = False
+            for name in sorted(os.listdir(directory)):
+                file = os.path.join(directory, name)
+                # hidden files include part files of outputs written into the watched directory
+                if name.startswith('.') or not matches(name) or checkpoint.isDone(file) or not os.path.isfile(file):
+                    continue
+                stat = os.stat(file)
+                state = (stat.st_size, stat.st_mtime_ns)
+                if name in closed or (seen.get(file) == state and time.time() - stat.st_mtime >= settle):
+                    closed.discard(name)
+                    seen.pop(file, None)
+                    lastNew = time.monotonic()
+                    yield file
+                else:
+                    seen[file] = state
+                    pending = True
+            idle = time.monotonic() - lastNew
+            if idleExit is not None and idle >= idleExit:
+                return
+            # without pending files inotify can block until the next event or the idle timeout
+            timeout = interval if pending or inotify is None else None
+            if timeout is None and idleExit is not None:
+                timeout = idleExit - idle
+            if inotify is not None:
+                closed |= inotify.read(timeout)
+            else:
+                time.sleep(min(timeout, idleExit - idle) if idleExit is not None else timeout)
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+def watch(worker, args, path : str, outputs : list, statePath : str, interval : float = POLL_INTERVAL, settle : float = SETTLE, idleExit : float = None, headerLines : list = None) -> dict:
+    '''
+    Calls worker(args, file, *outPaths) for every new complete file and checkpoints after each file.
+
+    Parameters
+    ----------
+    worker : function
+        processes one file and returns a statistics dict
+    args : Namespace
+        passed to every call
+    path : str
+        directory or glob to watch
+    outputs : list
+        output files the outputs of all files are appended to, or functions mapping an input
+        file to its own output paths
+    statePath : str
+        checkpoint file
+    interval, settle, idleExit : float
+        see completedFiles
+    headerLines : list = None
+        number of header lines per output that are only kept in an empty output, e.g. 1 for CSV
+
+    Returns
+    -------
+    stats : dict
+        merged statistics of the files processed in this run
+    '''
+    assert STDIO not in outputs, 'Watch mode cannot append to stdout'
+    headerLines = headerLines or [0] * len(outputs)
+    checkpoint = Checkpoint(statePath)
+    concat = not all(callable(output) for output in outputs)
+    if concat:
+        checkpoint.restore(outputs)
+    stats = []
+    try:
+        for file in completedFiles(path, checkpoint, interval, settle, idleExit):
+            stat = os.stat(file)
+            finals = outputs if concat else [output(file) for output in outputs]
+            parts = [partPath(final) for final in finals]
+            try:
+                stats.append(worker(args, file, *parts))
+                sizes = {}
+                for part, final, skip in zip(parts, finals, headerLines):
+                    if not concat:
+                        os.replace(part, final)
+                        continue
+                    with open(final, 'ab') as out:
+                        appendPart(part, out, skip if out.tell() else 0)
+                        out.flush()
+                        os.fsync(out.fileno())
+                        sizes[os.path.abspath(final)] = out.tell()
+            finally:
+                for part in parts:
+                    if os.path.exists(part):
+                        os.remove(part)
+            checkpoint.markDone(file, stat, sizes)
+            checkpoint.save()
+            log(f'Processed {file}, {len(checkpoint.files)} files in total')
+    except KeyboardInterrupt:
+        log('Stopped watching')
+    return mergeStats(stats)
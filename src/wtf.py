@@ -6,6 +6,11 @@
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
 from Bio import SeqIO
 import os
+import numpy as np
+
+from src.twobit import loadCache
+from src.fastx_io import STDIO, formatFromPath, openInput
+from src.recordbatch import iterRawRecords
 
 ACCURATE = 'ACGTU'
 AMBIGUOUS = 'KMRSWYN'
@@ -29,14 +34,58 @@ IUPAC_RNA = {
 
 IUPAC = None
 
+# 2-bit codes of the bases, every other character is ambiguous
+KMER_CODE = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate(('Aa', 'Cc', 'Gg', 'TtUu')):
+    for base in bases:
+        KMER_CODE[ord(base)] = code
+
+MAX_K = 15
+# largest k with int64 bincount arrays, larger k are counted with np.unique into uint32 arrays
+MAX_BINCOUNT_K = 12
+CHUNK_SIZE = 1 << 22
+
 def parse() -> Namespace:
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter,
         description='What the fasta will analyse your reference fasta sequence'
     )
-    parser.add_argument('FASTA_or_SEQ', type=str, help='FASTA reference file or sequence')
+    parser.add_argument('FASTA_or_SEQ', type=str, help='FASTA reference file or sequence, - to read FASTA from stdin')
     parser.add_argument('--rna', action='store_true', help='switch to RNA if reference FASTA contains RNA')
-    return parser.parse_args()
+    parser.add_argument('--no_cache', action='store_true', help='Do not create or read the 2-bit sequence cache of the FASTA')
+    kmers = parser.add_argument_group('k-mer counting')
+    kmers.add_argument('-k', '--kmer', type=int, default=None, metavar='K', help=f'Count k-mers of length K (1-{MAX_K}) over all sequences instead of the base content, also accepts FASTQ')
+    kmers.add_argument('--canonical', action='store_true', help='Merge every k-mer with its reverse complement, the lexicographically smaller one is reported')
+    kmers.add_argument('--spectrum', action='store_true', help='Print the k-mer spectrum (number of distinct k-mers per multiplicity) instead of the k-mer counts')
+    kmers.add_argument('--top', type=int, default=None, help='Print only the N most frequent k-mers')
+    kmers.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Number of bases encoded at once, bounds the memory for long sequences')
+    args = parser.parse_args()
+    assert args.kmer is None or 1 <= args.kmer <= MAX_K, f'k has to be between 1 and {MAX_K}'
+    return args
+
+def fold_counts(characters : dict) -> dict:
+    '''
+    Adds character counts to the counts of all nucleotide IUPAC characters. Lowercase (soft-masked)
+    bases are counted as uppercase, T and U together as T, or as U with --rna.
+    Raises a KeyError if base unknown.
+
+    Parameters
+    ----------
+    characters : dict
+        Counts of single characters
+
+    Returns
+    -------
+    counts : dict
+        Counts of all nucleotide IUPAC characters
+    '''
+    iupac = IUPAC or IUPAC_DNA
+    thymine = 'U' if 'U' in iupac else 'T'
+    counts = {symbol:0 for symbol in iupac}
+    for base, count in characters.items():
+        base = base.upper()
+        counts[thymine if base in 'TU' else base] += count
+    return counts
 
 def count_bases(fasta_sequence : str) -> dict:
     '''
@@ -51,12 +100,27 @@ def count_bases(fasta_sequence : str) -> dict:
     Returns
     -------
     counts : dict
-        Counts of all nucleotide IUPAC characters
+        Counts of all nucleotide IUPAC characters, see fold_counts
     '''
-    counts = {symbol:0 for symbol in IUPAC_DNA}
-    for base in fasta_sequence:
-        counts[base] += 1
-    return counts
+    bases = np.bincount(np.frombuffer(fasta_sequence.encode(), dtype=np.uint8), minlength=256)
+    return fold_counts({chr(base) : int(bases[base]) for base in np.flatnonzero(bases)})
+
+def cached_counts(cached : dict) -> dict:
+    '''
+    Converts precomputed counts from the sequence cache to the output of count_bases.
+    Raises a KeyError if base unknown.
+
+    Parameters
+    ----------
+    cached : dict
+        Counts of all characters of an uppercase sequence
+
+    Returns
+    -------
+    counts : dict
+        Counts of all nucleotide IUPAC characters, see fold_counts
+    '''
+    return fold_counts(cached)
 
 def get_seq_content(counts : dict) -> dict:
     '''
@@ -90,7 +154,7 @@ def get_seq_content(counts : dict) -> dict:
         else:
             amb += counts[character]
 
-        if character in 'ATW':
+        if character in 'ATUW':
             at += counts[character]
         elif character in 'GCS':
             gc += counts[character]
@@ -105,6 +169,140 @@ def output(content : dict, id : str = None) -> None:
         print(f'{key}: {item}, ', end='')
     print(f'AT%: {(content["AT"]/content["total"]):.3}, GC%: {(content["GC"]/content["total"]):.3}, ambiguous%: {(content["ambiguous"]/content["total"]):.3}')
 
+def kmer_codes(sequence : bytes, k : int, canonical : bool = False) -> np.ndarray:
+    '''
+    2-bit encodes a sequence and returns the codes of all k-mers without ambiguous bases.
+    The code of a k-mer is its bases read as a base 4 number with A=0, C=1, G=2, T/U=3.
+
+    Parameters
+    ----------
+    sequence : bytes
+        nucleotide sequence, lowercase bases are counted like uppercase
+    k : int
+        k-mer length
+    canonical : bool = False
+        return the smaller code of each k-mer and its reverse complement
+
+    Returns
+    -------
+    codes : np.ndarray
+        k-mer codes as int64 in order of their start position
+    '''
+    bases = KMER_CODE[np.frombuffer(sequence, dtype=np.uint8)]
+    windows = len(bases) - k + 1
+    if windows <= 0:
+        return np.zeros(0, dtype=np.int64)
+    # number of ambiguous bases in every window
+    ambiguous = np.zeros(len(bases) + 1, dtype=np.int64)
+    np.cumsum(bases == 4, out=ambiguous[1:])
+    valid = ambiguous[k:] == ambiguous[:-k]
+    bases = (bases & 3).astype(np.int64)
+    codes = np.zeros(windows, dtype=np.int64)
+    for i in range(k):
+        codes <<= 2
+        codes |= bases[i : i + windows]
+    if canonical:
+        reverse = np.zeros(windows, dtype=np.int64)
+        for i in reversed(range(k)):
+            reverse <<= 2
+            reverse |= 3 - bases[i : i + windows]
+        np.minimum(codes, reverse, out=codes)
+    return codes[valid]
+
+def add_kmers(counts : np.ndarray, codes : np.ndarray) -> None:
+    '''
+    Adds the occurrences of the k-mer codes to counts. A full bincount costs 4^k, so it is only used
+    if there are at least as many codes as k-mers, fewer codes are counted with np.unique.
+    '''
+    if len(codes) >= len(counts) and counts.dtype == np.int64:
+        counts += np.bincount(codes, minlength=len(counts))
+    elif len(codes):
+        codes, occurrences = np.unique(codes, return_counts=True)
+        counts[codes] += occurrences.astype(counts.dtype)
+
+def count_kmers(sequences, k : int, canonical : bool = False, chunk_size : int = CHUNK_SIZE) -> np.ndarray:
+    '''
+    Counts k-mers of all sequences into a dense array of length 4^k.
+    Long sequences are processed in chunks overlapping by k-1 bases, so memory stays bounded.
+    The codes of short sequences are buffered up to chunk_size and counted together.
+
+    Parameters
+    ----------
+    sequences : iterable
+        sequences as bytes
+    k : int
+        k-mer length, 1 to MAX_K
+    canonical : bool = False
+        count k-mers and their reverse complements together
+    chunk_size : int = CHUNK_SIZE
+        number of bases encoded and k-mers counted at once
+
+    Returns
+    -------
+    counts : np.ndarray
+        counts[code] is the number of occurrences of the k-mer with this code
+    '''
+    assert 1 <= k <= MAX_K, f'k has to be between 1 and {MAX_K}'
+    size = 4 ** k
+    counts = np.zeros(size, dtype=np.int64 if k <= MAX_BINCOUNT_K else np.uint32)
+    step = max(chunk_size, k)
+    buffer = []
+    buffered = 0
+    for sequence in sequences:
+        for start in range(0, max(len(sequence) - k + 1, 1), step):
+            codes = kmer_codes(sequence[start : start + step + k - 1], k, canonical)
+            buffer.append(codes)
+            buffered += len(codes)
+            if buffered >= step:
+                add_kmers(counts, np.concatenate(buffer))
+                buffer.clear()
+                buffered = 0
+    if buffer:
+        add_kmers(counts, np.concatenate(buffer))
+    return counts
+
+def decode_kmer(code : int, k : int, rna : bool = False) -> str:
+    bases = 'ACGU' if rna else 'ACGT'
+    return ''.join(bases[(code >> 2 * (k - 1 - i)) & 3] for i in range(k))
+
+def kmer_spectrum(counts : np.ndarray) -> np.ndarray:
+    '''
+    Returns the number of distinct k-mers for every multiplicity, spectrum[m] for k-mers occurring m times.
+    '''
+    return np.bincount(counts[counts > 0].astype(np.int64))
+
+def output_kmers(counts : np.ndarray, k : int, rna : bool = False, top : int = None) -> None:
+    observed = np.flatnonzero(counts)
+    # most frequent first, equal counts in lexicographic order
+    observed = observed[np.argsort(-counts[observed].astype(np.int64), kind='stable')]
+    if top is not None:
+        observed = observed[:top]
+    print('kmer\tcount')
+    for code in observed.tolist():
+        print(f'{decode_kmer(code, k, rna)}\t{counts[code]}')
+
+def output_spectrum(spectrum : np.ndarray) -> None:
+    print('multiplicity\tkmers')
+    for multiplicity in np.flatnonzero(spectrum).tolist():
+        print(f'{multiplicity}\t{spectrum[multiplicity]}')
+
+def iter_sequences(fasta : str, use_cache : bool = True):
+    '''
+    Yields the sequences of a FASTA/FASTQ file, stdin or a sequence given on the command line as bytes.
+    '''
+    if fasta != STDIO and not os.path.isfile(fasta):
+        yield fasta.encode()
+        return
+    twobit = loadCache(fasta) if use_cache and fasta != STDIO and formatFromPath(fasta) == 'fasta' else None
+    if twobit is not None:
+        for contig in twobit.contigs:
+            yield twobit.sequence(contig).encode()
+        return
+    handle, format = openInput(fasta)
+    with handle:
+        for _, sequence, _ in iterRawRecords(handle.buffer, format):
+            yield sequence
+
 def main() -> None:
     args = parse()
     fasta = args.FASTA_or_SEQ
@@ -116,12 +314,31 @@ def main() -> None:
     else:
         IUPAC = IUPAC_DNA
 
+    if args.kmer is not None:
+        counts = count_kmers(iter_sequences(fasta, not args.no_cache), args.kmer, args.canonical, args.chunk_size)
+        if args.spectrum:
+            output_spectrum(kmer_spectrum(counts))
+        else:
+            output_kmers(counts, args.kmer, rna, args.top)
+        return
+
     # provided FASTA file
-    if fasta.endswith('.fa') or fasta.endswith('.fasta'):
+    if fasta == STDIO:
+        handle, format = openInput(fasta)
+        for record in SeqIO.parse(handle, format):
+            output(get_seq_content(count_bases(str(record.seq))), record.id)
+
+    elif formatFromPath(fasta) == 'fasta':
         assert os.path.exists(fasta) and os.path.isfile(fasta)
 
-        for record in SeqIO.parse(fasta, 'fasta'):
-            output(get_seq_content(count_bases(str(record.seq))), record.id)
+        twobit = None if args.no_cache else loadCache(fasta)
+        if twobit is not None:
+            for id, counts in twobit.counts():
+                output(get_seq_content(cached_counts(counts)), id)
+        else:
+            handle, _ = openInput(fasta, 'fasta')
+            for record in SeqIO.parse(handle, 'fasta'):
+                output(get_seq_content(count_bases(str(record.seq))), record.id)
 
     # provided sequence
     else:
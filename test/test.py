@@ -3,9 +3,45 @@
 # github: https://github.com/JannesSP
 # website: https://jannessp.github.io
 
-from src.filter_fastx import filterIDs, filterLength
-from src.slice_fastx import sliceFastx, getSliceRegion
+from src.filter_fastx import filterIDs, filterLength, filterPairedFastx, recordPredicate
+from src.slice_fastx import sliceFastx, getSliceRegion, compileMotifs, motifHits, motifFastx
 from src.mergeIDs import intersect, union
+from src.twobit import loadCache, isValid, parseFasta
+from src.pipeline import buildPipeline, runPipeline
+from src.fastx_io import openInput, openOutput, readAhead, writeBehind
+from src.recordbatch import RecordBatch, iterBatches
+from src.stats import LengthHistogram, lengthStats
+from src.paired import iterPairs, iterInterleaved, filterPairs
+from src.dedup import DigestSet, dedupRecords, dedupPartitioned, newStats
+from src.wtf import count_bases, cached_counts, count_kmers, decode_kmer, kmer_spectrum
+from src.batch import expandInputs, mergeStats, perFileOutput, runBatch
+from src.replace_fastx import replaceWorker, replaceBase
+import src.replace_fastx
+from src.watch import watch
+from src.checkpoint import Checkpoint
+import src.watch
+import src.slice_fastx
+from src.ids import iterIDs, sourceType
+from src.sort_fastx import sortFastx
+from src.split_fastx import splitFastx
+from src.serve import ReadStore, RecordCache, serve, request, isServing
+import src.serve
+from src.replace_bam import replaceBam
+import src.replace_bam
+from src.resume import startCheckpoint
+import src.filter_bam
+from src.bam_metrics import parseFilter, alignmentMetrics, writeMetrics, loadMetrics
+from io import StringIO
+import gzip
+import threading
+import pysam
+import numpy as np
+import time
+from argparse import Namespace
+from Bio import SeqIO
+from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
+import pytest
 import os
 
 testFastq = os.path.join(os.path.dirname(__file__), 'test.fastq')
@@ -32,50 +68,572 @@ unionIDs = set([
     'c6eee8d3-wxyz-4755-5678-1ad20e923257'
     ])
 
+
 def test_filter_fastq_ids():
     foundRecords, filteredIDs, missingIDs = filterIDs(testFastq, 'fastq', open(ids, 'r'))
     assert found == set(map(lambda rec : rec.name, foundRecords))
     assert filtered == set(filteredIDs)
     assert missing == set(missingIDs)
 
+
 def test_filter_fasta_ids():
     foundRecords, filteredIDs, missingIDs = filterIDs(testFasta, 'fasta', open(ids, 'r'))
     assert found == set(map(lambda rec : rec.name, foundRecords))
     assert filtered == set(filteredIDs)
     assert missing == set(missingIDs)
 
+
 def test_slice_fasta_id():
     records = sliceFastx(open(testFasta, 'r'), open(os.path.join(os.path.dirname(__file__), 'outfiles', 'fasta_out_sliced.fa'), 'w'), (8,15), 'fasta', '4052e08f-635c-419f-acd0-383c7ba40daa')
     assert records[0].seq == 'AGGUAUC'
 
+
 def test_slice_fastq_id():
     records = sliceFastx(open(testFastq, 'r'), open(os.path.join(os.path.dirname(__file__), 'outfiles', 'fastq_out_sliced.fq'), 'w'), (8,15), 'fastq', '4052e08f-635c-419f-acd0-383c7ba40daa')
     assert records[0].seq == 'AGGUAUC'
 
 # overwrites output file from test_clise_fasta_id()
+
+
 def test_slice_fasta():
     records = sliceFastx(open(testFasta, 'r'), open(os.path.join(os.path.dirname(__file__), 'outfiles', 'fasta_out_sliced.fa'), 'w'), (8,15), 'fasta')
     seqs = [str(record.seq) for record in records]
     assert seqs == ['AGGUAUC', 'UGAUUUA', 'GUGCCCC', 'ACGUCAC', 'CCCACCC']
 
+
 def test_getSlice_position_r():
     assert (4, 15) == getSliceRegion(position = 10, range = 5, lowerbound = None, upperbound = None)
 
+
 def test_getSlice_lower_upper():
     assert (4, 15) == getSliceRegion(position = None, range = None, lowerbound = 5, upperbound = 15)
 
+
 def test_filter_fastq_length_long():
     reads, longest, shortest = filterLength(testFastq, 'fastq', 70, 'long')
     assert longReads == set(map(lambda rec : rec.name, reads))
 
+
 def test_filter_fastq_length_short():
     reads, longest, shortest = filterLength(testFastq, 'fastq', 70, 'short')
     assert shortReads == set(map(lambda rec : rec.name, reads))
 
+
 def test_intersect_ids():
     ids = intersect([os.path.join(os.path.dirname(__file__), 'ids.txt'), os.path.join(os.path.dirname(__file__), 'ids_2.txt')])
     assert ids == intersectIDs
 
+
 def test_union_ids():
     ids = union([os.path.join(os.path.dirname(__file__), 'ids.txt'), os.path.join(os.path.dirname(__file__), 'ids_2.txt')])
-    assert ids == unionIDs
\ No newline at end of file
+    assert ids == unionIDs
+
+
+def test_twobit_roundtrip(tmp_path):
+    fasta = tmp_path / 'ref.fa'
+    fasta.write_text('>chr1 first contig\nACGTNNNNacgtRYacg\n>chr2\nGGGCCCAAAT\n>rna\nACGUUNacgu\n')
+    assert loadCache(str(fasta)) is not None
+    assert isValid(str(fasta))
+    cached = [(rec.id, rec.description, str(rec.seq)) for rec in parseFasta(str(fasta))]
+    parsed = [(rec.id, rec.description, str(rec.seq)) for rec in SeqIO.parse(str(fasta), 'fasta')]
+    assert cached == parsed
+    assert loadCache(str(fasta)).counts()[0] == ('chr1', {'A':3, 'C':3, 'G':3, 'T':2, 'N':4, 'R':1, 'Y':1})
+
+
+def test_twobit_mixed_tu(tmp_path):
+    fasta = tmp_path / 'mixed.fa'
+    fasta.write_text('>m\nACGTUACGU\n>u\nUUUtaNu\n')
+    assert loadCache(str(fasta)) is not None
+    assert [str(rec.seq) for rec in parseFasta(str(fasta))] == ['ACGTUACGU', 'UUUtaNu']
+    twobit = loadCache(str(fasta))
+    assert twobit.sequence(twobit.contigs[0], 2, 6) == 'GTUA'
+
+
+def test_wtf_cached_counts(tmp_path):
+    fasta = tmp_path / 'rna.fa'
+    fasta.write_text('>r\nACGUUNacguRyAAUt\n')
+    cached = cached_counts(loadCache(str(fasta)).counts()[0][1])
+    assert cached == count_bases('ACGUUNacguRyAAUt')
+    assert cached['T'] == 5 and cached['A'] == 4 and cached['Y'] == 1
+
+
+def test_twobit_slice_region(tmp_path):
+    fasta = tmp_path / 'ref.fa'
+    fasta.write_text('>chr1\nACGTNNNNacgtRYacg\n')
+    twobit = loadCache(str(fasta))
+    assert twobit.sequence(twobit.contigs[0], 3, 10) == 'TNNNNac'
+
+
+def test_pipeline_stages():
+    stages = buildPipeline(f'length>=70 | exclude:{ids} | slice:8-14 | revcomp:rna', 'fastq')
+    records = list(runPipeline(SeqIO.parse(testFastq, 'fastq'), stages))
+    assert set(rec.id for rec in records) == set(['cf9d662a-850f-49a9-ab55-86ea4e34aa23', '9ca3164f-ce83-4e41-ae86-44a1646aaec4', 'c672e8d3-0b3b-48b5-8170-1ad20e923257'])
+    assert all(len(rec) == 7 for rec in records)
+
+
+def test_pipeline_invalid_slice():
+    for expression in ('slice:500', 'slice:a-b', 'slice:'):
+        with pytest.raises(ValueError, match='slice:LOWER-UPPER'):
+            buildPipeline(expression, 'fasta')
+
+
+def test_sniff_format(tmp_path):
+    noext = tmp_path / 'reads'
+    noext.write_bytes(open(testFastq, 'rb').read())
+    handle, format = openInput(str(noext))
+    assert format == 'fastq'
+    assert len(list(SeqIO.parse(handle, format))) == 5
+    handle, format = openInput(str(noext), 'fastq')
+    assert format == 'fastq'
+
+
+def test_pipelined_gzip_roundtrip(tmp_path):
+    outfile = str(tmp_path / 'reads.fq.gz')
+    handle, format = openInput(testFastq)
+    out, outformat = openOutput(outfile)
+    assert writeBehind(readAhead(SeqIO.parse(handle, format), 2, 1), out, outformat, 2, 1) == 5
+    out.close()
+    handle, format = openInput(outfile)
+    assert format == 'fastq'
+    assert [str(rec.seq) for rec in SeqIO.parse(handle, format)] == [str(rec.seq) for rec in SeqIO.parse(testFastq, 'fastq')]
+
+
+def test_readahead_stops_early():
+    produced = []
+
+    def records():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    threads = threading.active_count()
+    it = readAhead(records(), 1, 1)
+    assert next(it) == 0
+    it.close()
+    # the reader thread ended instead of blocking on the full queue
+    assert threading.active_count() == threads
+    assert len(produced) < 10
+
+
+def test_write_behind_stops_on_error():
+    def write(batch, handle, format):
+        raise IOError('disk full')
+
+    with pytest.raises(IOError):
+        writeBehind(iter(range(1000)), None, 'fasta', 1, 1, write)
+
+
+def test_recordbatch_kernels():
+    batch = RecordBatch.fromRecords([(b'r1 x', b'ACGGN', b'IIII!'), (b'r2', b'', b''), (b'r3', b'ccAT', b'5555')])
+    assert batch.ids == ['r1', 'r2', 'r3']
+    assert batch.lengths().tolist() == [5, 0, 4]
+    assert batch.gcFraction().tolist() == [0.6, 0.0, 0.5]
+    assert batch.meanPhred()[0] == 32.0 and batch.meanPhred()[2] == 20.0
+    assert batch.baseCounts(b'ACGTN').tolist() == [[1, 1, 2, 0, 1], [0, 0, 0, 0, 0], [1, 2, 0, 1, 0]]
+    selected = batch.select(batch.lengths() >= 4)
+    assert selected.ids == ['r1', 'r3'] and selected.seq.tobytes() == b'ACGGNccAT'
+
+
+def test_recordbatch_parse_fastq():
+    batches = list(iterBatches(open(testFastq, 'rb'), 'fastq', 2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sum(batch.lengths().sum() for batch in batches) == sum(len(rec) for rec in SeqIO.parse(testFastq, 'fastq'))
+
+
+def test_length_stats():
+    exact = lengthStats(testFastq, exact=True).summary()
+    assert exact['reads'] == 5 and exact['bases'] == 1351
+    assert exact['shortest'] == 67 and exact['longest'] == 486
+    assert exact['N50'] == 322 and exact['N90'] == 192
+    binned = lengthStats(testFastq).summary()
+    assert abs(binned['N50'] - exact['N50']) <= 0.02 * exact['N50']
+
+
+def test_length_histogram_empty():
+    assert LengthHistogram().summary()['N50'] == 0
+
+
+def test_recordbatch_quality():
+    batch = RecordBatch.fromRecords([(b'r1', b'AC', b'I+'), (b'r2', b'ACGT', b'5555')])
+    assert abs(batch.expectedErrors()[0] - 0.1001) < 1e-9
+    assert abs(batch.meanQuality()[0] - 13.0) < 0.01
+    assert abs(batch.meanQuality()[1] - 20.0) < 1e-9
+    assert batch.meanPhred()[0] == 25.0
+
+
+def test_paired_filter_policy():
+    r1 = [SeqRecord(Seq('A' * n), id=f'r{i}/1') for i, n in enumerate([100, 10, 50])]
+    r2 = [SeqRecord(Seq('C' * n), id=f'r{i}/2') for i, n in enumerate([20, 10, 200])]
+    both = filterPairs(iterPairs(r1, r2), lambda rec : len(rec) >= 50, 'both')
+    assert [a.id for a, b in both] == ['r2/1']
+    either = filterPairs(iterInterleaved([rec for pair in zip(r1, r2) for rec in pair]), lambda rec : len(rec) >= 50, 'either')
+    assert [a.id for a, b in either] == ['r0/1', 'r2/1']
+
+
+def test_paired_mismatch():
+    r1 = [SeqRecord(Seq('A'), id='a/1'), SeqRecord(Seq('A'), id='b/1')]
+    r2 = [SeqRecord(Seq('A'), id='a/2'), SeqRecord(Seq('A'), id='c/2')]
+    with pytest.raises(ValueError):
+        list(iterPairs(r1, r2))
+    with pytest.raises(ValueError):
+        list(iterPairs(r1, r2[:1]))
+
+
+def test_dedup_memory_and_partitioned(tmp_path):
+    records = [(f'r{i}'.encode(), b'ACGT'[i % 3 : i % 3 + 2] * (i % 5), b'') for i in range(40)]
+    stats = newStats()
+    inMemory = list(dedupRecords(records, 'sequence', 64, stats))
+    assert [rec[0] for rec in inMemory] == [b'r0', b'r1', b'r2', b'r3', b'r4', b'r6', b'r7', b'r8', b'r9', b'r11', b'r12', b'r13', b'r14']
+    assert stats == {'reads' : 40, 'unique' : len(inMemory)}
+    partitioned = list(dedupPartitioned(lambda : iter(records), 'sequence', 128, 3, str(tmp_path)))
+    assert partitioned == inMemory
+
+
+def test_digest_set_growth():
+    for bits in (64, 128):
+        digests = [(i * 0x9E3779B97F4A7C15) % (1 << bits) for i in range(1, 5000)]
+        seen = DigestSet(bits, 4)
+        assert all(seen.add(d) for d in digests)
+        assert not any(seen.add(d) for d in digests)
+        assert len(seen) == len(digests) and len(seen.lo) == 8192
+
+
+def test_kmer_counts():
+    sequences = [b'ACGTNacgtAAAA', b'TTTTCG']
+    counts = count_kmers(sequences, 2)
+    assert {decode_kmer(code, 2) : int(counts[code]) for code in counts.nonzero()[0]} == {'AA' : 3, 'CG' : 3, 'TT' : 3, 'AC' : 2, 'GT' : 2, 'TA' : 1, 'TC' : 1}
+    canonical = count_kmers(sequences, 2, canonical=True)
+    assert canonical[0] == 6 and canonical.sum() == counts.sum()
+    assert list(kmer_spectrum(counts)) == [0, 2, 2, 3]
+
+
+def test_kmer_chunks():
+    records = [str(record.seq).encode() for record in SeqIO.parse(testFastq, 'fastq')]
+    for k in (5, 13):
+        assert (count_kmers(records, k, True, chunk_size=7) == count_kmers(records, k, True)).all()
+
+
+def test_kmer_many_short_reads():
+    rng = np.random.default_rng(1)
+    reads = [rng.choice(list(b'ACGT'), 40).astype(np.uint8).tobytes() for _ in range(2000)]
+    k = 12
+    expected = {}
+    for read in reads:
+        for i in range(len(read) - k + 1):
+            expected[read[i:i+k].decode()] = expected.get(read[i:i+k].decode(), 0) + 1
+    start = time.time()
+    counts = count_kmers(reads, k)
+    # one bincount over 4^k per read took about 50 ms each
+    assert time.time() - start < 5
+    assert {decode_kmer(code, k) : int(counts[code]) for code in counts.nonzero()[0]} == expected
+
+
+def test_batch_concat_order(tmp_path):
+    records = list(SeqIO.parse(testFastq, 'fastq'))
+    for i, record in enumerate(records):
+        SeqIO.write([record], str(tmp_path / f'chunk_{i}.fastq'), 'fastq')
+    inputs = expandInputs(str(tmp_path))
+    assert len(inputs) == len(records)
+    out, csv = str(tmp_path / 'all.fastq'), str(tmp_path / 'all.csv')
+    args = Namespace(format=None, srcbase='A', tgtbase='G')
+    stats = mergeStats(runBatch(replaceWorker, args, inputs, [out, csv], processes=2, headerLines=[0, 1]))
+    assert [record.id for record in SeqIO.parse(out, 'fastq')] == [record.id for record in records]
+    assert stats['reads'] == len(records) and stats['replaced'] == sum(str(record.seq).count('A') for record in records)
+    with open(csv) as c:
+        assert c.readline().startswith('readid') and len(c.readlines()) == stats['replaced']
+
+
+def test_batch_helpers():
+    assert perFileOutput('/data/fastq_pass/chunk_1.fastq.gz', 'out', 'fasta') == os.path.join('out', 'chunk_1.fasta.gz')
+    assert mergeStats([{'written' : 2, 'longest' : 5, 'unseen' : {'a', 'b'}}, {'written' : 3, 'longest' : 4, 'unseen' : {'b'}}]) == {'written' : 5, 'longest' : 5, 'unseen' : {'b'}}
+
+
+def test_watch_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.watch, 'openInotify', lambda directory : None)
+    inDir = tmp_path / 'in'
+    inDir.mkdir()
+    records = list(SeqIO.parse(testFastq, 'fastq'))
+    SeqIO.write(records[:2], str(inDir / 'chunk_0.fastq'), 'fastq')
+    out, csv, state = str(tmp_path / 'out.fastq'), str(tmp_path / 'out.csv'), str(tmp_path / 'state.json')
+    args = Namespace(format=None, srcbase='A', tgtbase='G')
+    stats = watch(replaceWorker, args, str(inDir), [out, csv], state, interval=0.05, settle=0, idleExit=0.3, headerLines=[0, 1])
+    assert stats['reads'] == 2
+    # a partial append after the checkpoint is truncated, processed files are not processed again
+    with open(out, 'a') as o:
+        o.write('@partial\n')
+    SeqIO.write(records[2:], str(inDir / 'chunk_1.fastq'), 'fastq')
+    stats = watch(replaceWorker, args, str(inDir), [out, csv], state, interval=0.05, settle=0, idleExit=0.3, headerLines=[0, 1])
+    assert stats['reads'] == len(records) - 2
+    assert [record.id for record in SeqIO.parse(out, 'fastq')] == [record.id for record in records]
+    assert len(Checkpoint(state).files) == 2
+    with open(csv) as c:
+        assert sum(line.startswith('readid') for line in c) == 1
+
+
+def test_ids_from_records(tmp_path):
+    fastqIDs = [record.id for record in SeqIO.parse(testFastq, 'fastq')]
+    assert list(iterIDs(testFastq)) == fastqIDs
+    assert list(iterIDs(testFasta)) == [record.id for record in SeqIO.parse(testFasta, 'fasta')]
+    # content based detection without extension, gzip included
+    gz = str(tmp_path / 'reads')
+    with open(testFastq, 'rb') as f, openOutput(gz + '.gz', 'fastq')[0] as out:
+        out.write(f.read().decode())
+    os.rename(gz + '.gz', gz)
+    assert sourceType(gz) == 'fastq' and list(iterIDs(gz)) == fastqIDs
+    assert sourceType(ids) == 'ids'
+    bam = os.path.join(os.path.dirname(__file__), 'test_psU.bam')
+    assert sourceType(bam) == 'bam'
+    assert intersect([testFastq, testFasta, ids]) == set(fastqIDs) & {line.strip() for line in open(ids)}
+    assert union([bam, ids]) == set(iterIDs(bam)) | {line.strip() for line in open(ids)}
+
+
+def test_sort_external(tmp_path):
+    records = list(SeqIO.parse(testFastq, 'fastq'))
+    inp = str(tmp_path / 'in.fastq')
+    SeqIO.write(records + records[:2], inp, 'fastq')
+    # a budget of 0 MB spills every read into its own run and needs several merge passes
+    stats = sortFastx(inp, str(tmp_path / 'id.fastq'), 'id', memory=0, fanIn=2)
+    assert stats['reads'] == len(records) + 2 and stats['passes'] > 1
+    assert [record.id for record in SeqIO.parse(str(tmp_path / 'id.fastq'), 'fastq')] == sorted([record.id for record in records + records[:2]])
+    sortFastx(inp, str(tmp_path / 'length.fasta'), 'length', memory=0, fanIn=3)
+    lengths = [len(record) for record in SeqIO.parse(str(tmp_path / 'length.fasta'), 'fasta')]
+    assert lengths == sorted(lengths, reverse=True)
+    sortFastx(inp, str(tmp_path / 'quality.fastq'), 'quality', reverse=True, memory=0)
+    sortFastx(inp, str(tmp_path / 'quality_mem.fastq'), 'quality', reverse=True)
+    with open(str(tmp_path / 'quality.fastq')) as a, open(str(tmp_path / 'quality_mem.fastq')) as b:
+        assert a.read() == b.read()
+
+
+def test_split_boundaries(tmp_path):
+    # quality lines starting with '@' and '+' must not be taken for record starts
+    inp = str(tmp_path / 'reads.fastq')
+    with open(inp, 'w') as f:
+        for i in range(6):
+            f.write(f'@r{i}\nACGT\n+\n{"@+" if i % 2 else "+@"}II\n')
+    # a part size of one byte puts a boundary into every record
+    manifest = splitFastx(inp, str(tmp_path / 'bytes'), size=1)
+    assert [part[3] for part in manifest] == [1] * 6
+    assert [next(SeqIO.parse(part[0], 'fastq')).id for part in manifest] == [f'r{i}' for i in range(6)]
+    manifest = splitFastx(inp, str(tmp_path / 'records'), records=4)
+    assert [part[3] for part in manifest] == [4, 2]
+    manifest = splitFastx(testFasta, str(tmp_path / 'parts'), parts=3)
+    assert sum(part[3] for part in manifest) == 5
+    assert b''.join(open(part[0], 'rb').read() for part in manifest) == open(testFasta, 'rb').read()
+
+
+def test_read_store(tmp_path):
+    inp = str(tmp_path / 'reads.fastq')
+    records = list(SeqIO.parse(testFastq, 'fastq'))
+    SeqIO.write(records, inp, 'fastq')
+    store = ReadStore(inp, cacheBytes=1 << 20)
+    wanted = [records[3].id, 'unknown', records[0].id]
+    found, missing = store.fetch(wanted)
+    assert missing == ['unknown']
+    assert [record.id for record in SeqIO.parse(StringIO(b''.join(found).decode()), 'fastq')] == [records[3].id, records[0].id]
+    store.fetch(wanted)
+    assert store.cache.hits == 2
+    region = store.region(records[1].id, 2, 10).decode().split('\n')
+    assert region[1] == str(records[1].seq[2:10]) and 'sliced=(3,10)' in region[0]
+    store.close()
+    cache = RecordCache(10)
+    for id in 'abc':
+        cache.put(id, b'12345')
+    assert list(cache.records) == ['b', 'c']
+
+
+def test_serve_socket(tmp_path):
+    inp = str(tmp_path / 'reads.fasta')
+    records = list(SeqIO.parse(testFasta, 'fasta'))
+    SeqIO.write(records, inp, 'fasta')
+    sock = str(tmp_path / 'reads.sock')
+    threading.Thread(target=serve, args=(inp, sock, 1), daemon=True).start()
+    for _ in range(100):
+        if isServing(sock):
+            break
+        time.sleep(0.05)
+    header, data = request(sock, {'ids' : [records[2].id]})
+    assert header['found'] == 1 and data.decode().startswith('>' + records[2].description)
+    header, data = request(sock, {'regions' : [[records[0].id, 0, 5]]})
+    assert data.decode().split('\n')[1] == str(records[0].seq[:5])
+
+
+def test_serve_socket_mode(tmp_path, monkeypatch):
+    inp = str(tmp_path / 'reads.fasta')
+    SeqIO.write(list(SeqIO.parse(testFasta, 'fasta')), inp, 'fasta')
+    sock = str(tmp_path / 'reads.sock')
+    modes = []
+
+    class Server(src.serve._Server):
+        def server_bind(self):
+            super().server_bind()
+            modes.append(os.stat(sock).st_mode & 0o777)
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(src.serve, '_Server', Server)
+    with pytest.raises(KeyboardInterrupt):
+        serve(inp, sock, 1)
+    # no access for other users already right after bind
+    assert modes and modes[0] & 0o077 == 0
+
+
+def test_motif_hits():
+    patterns = compileMotifs(['DRACH'])
+    hits = motifHits(b'ggactgtttagtcc', patterns)
+    assert [(hit[0], hit[1], hit[3]) for hit in hits] == [(0, 5, '+'), (4, 9, '-'), (9, 14, '-')]
+    # overlapping hits and U matching T
+    assert [hit[0] for hit in motifHits(b'AAAA', compileMotifs(['AA'], 'forward'))] == [0, 1, 2]
+    assert len(motifHits(b'ACGU', compileMotifs(['ACGT']))) == 1
+
+
+def test_motif_fastx(tmp_path):
+    inp = str(tmp_path / 'reads.fastq')
+    with open(inp, 'w') as f:
+        f.write('@r1 x\nGGACTGTTTAGTCC\n+\nABCDEFGHIJKLMN\n@r2\nTTTTTT\n+\nIIIIII\n')
+    out = str(tmp_path / 'windows.fastq')
+    stats = motifFastx(inp, out, ['GTTT'], flank=2)
+    assert stats == {'reads' : 2, 'reads_with_hits' : 1, 'windows' : 1}
+    record = next(SeqIO.parse(out, 'fastq'))
+    assert record.id == 'r1_1' and str(record.seq) == 'CTGTTTAG'
+    assert 'hit=(6,9) sliced=(4,11)' in record.description
+    stats = motifFastx(inp, str(tmp_path / 'full.fasta'), ['GGAC'], flank=1, fullWindows=True)
+    assert stats['windows'] == 0
+
+
+def test_replace_bam_clipped(tmp_path):
+    # read ACUUAGGCUA was written as ACCCAGGCCA, CSV positions are on the read as sequenced
+    csv = str(tmp_path / 'replaced.csv')
+    with open(csv, 'w') as f:
+        f.write('readid,position,sourcebase,targetbase\nr,2,U,C\nr,3,U,C\nr,8,U,C\n')
+    inbam = str(tmp_path / 'in.bam')
+    header = {'HD' : {'VN' : '1.6'}, 'SQ' : [{'SN' : 'ref', 'LN' : 100}]}
+    with pysam.AlignmentFile(inbam, 'wb', header=header) as out:
+        for flag, cigar, seq in [(0, '10M', 'ACCCAGGCCA'), (2048 + 16, '2H6M2H', 'GCCTGG'), (256, '10M', None)]:
+            read = pysam.AlignedSegment(out.header)
+            read.query_name, read.flag, read.reference_id, read.reference_start, read.cigarstring = 'r', flag, 0, 10, cigar
+            if seq is not None:
+                read.query_sequence = seq
+                read.query_qualities = pysam.qualitystring_to_array('I' * len(seq))
+            out.write(read)
+    outbam = str(tmp_path / 'out.bam')
+    stats = replaceBam(inbam, outbam, csv, threads=2)
+    assert stats == {'alignments' : 3, 'restored_alignments' : 2, 'restored_bases' : 5, 'without_sequence' : 1}
+    reads = list(pysam.AlignmentFile(outbam, 'rb'))
+    assert [read.query_sequence for read in reads] == ['ACTTAGGCTA', 'GCCTAA', None]
+    assert reads[1].is_supplementary and list(reads[1].query_qualities) == [40] * 6
+    with open(csv, 'w') as f:
+        f.write('readid,position,sourcebase,targetbase\nr,0,U,C\n')
+    with pytest.raises(ValueError, match='is not the replaced base'):
+        replaceBam(inbam, outbam, csv, threads=2)
+
+
+def test_bam_metrics(tmp_path):
+    inbam = str(tmp_path / 'in.bam')
+    header = {'HD' : {'VN' : '1.6'}, 'SQ' : [{'SN' : 'ref', 'LN' : 100}]}
+    with pysam.AlignmentFile(inbam, 'wb', header=header) as out:
+        for name, flag, cigar, mapq, nm in [('a', 0, '2S8M', 60, 1), ('b', 16, '3H6M1I1S', 20, 2), ('c', 0, '10M', 5, 0), ('d', 4, None, 0, None)]:
+            read = pysam.AlignedSegment(out.header)
+            read.query_name, read.flag, read.mapping_quality = name, flag, mapq
+            if cigar is not None:
+                read.reference_id, read.reference_start, read.cigarstring = 0, 10, cigar
+            read.query_sequence = 'ACGTACGTAC' if name != 'b' else 'ACGTACGT'
+            if nm is not None:
+                read.set_tag('NM', nm)
+            out.write(read)
+    metrics = alignmentMetrics(inbam, batchSize=3)
+    assert metrics['read_id'].tolist() == [b'a', b'b', b'c', b'd']
+    assert metrics['read_length'].tolist() == [10, 11, 10, 10]
+    assert metrics['aligned_length'].tolist() == [8, 7, 10, 0]
+    # reverse alignment, clips in read direction
+    assert metrics['clip_start'].tolist() == [2, 1, 0, 0] and metrics['clip_end'].tolist() == [0, 3, 0, 0]
+    assert np.allclose(metrics['identity'][:3], [7 / 8, 5 / 7, 1]) and np.isnan(metrics['identity'][3])
+    filters = [parseFilter('mapq>=20'), parseFilter('identity>0.8')]
+    sequences = []
+    metrics = alignmentMetrics(inbam, filters, batchSize=3, write=lambda name, seq: sequences.append((name, seq)))
+    assert metrics['read_id'].tolist() == [b'a'] and sequences == [('a', 'ACGTACGTAC')]
+    path = str(tmp_path / 'metrics.npz')
+    writeMetrics(metrics, path)
+    assert loadMetrics(path)['mapq'].tolist() == [60]
+
+
+def test_resume_replace_fastx(tmp_path, monkeypatch):
+    out, csv, state = str(tmp_path / 'out.fastq.gz'), str(tmp_path / 'out.csv'), str(tmp_path / 'out.json')
+    replaceRecord = src.replace_fastx.replaceRecord
+    calls = []
+
+    def interrupted(record, srcbase, tgtbase):
+        calls.append(record.id)
+        if len(calls) == 4:
+            raise KeyboardInterrupt
+        return replaceRecord(record, srcbase, tgtbase)
+
+    monkeypatch.setattr(src.replace_fastx, 'replaceRecord', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        replaceBase(testFastq, 'fastq', 'A', 'G', out, csv, startCheckpoint(state, [out, csv], False), every=2)
+    # a run without --resume does not overwrite the progress
+    with pytest.raises(SystemExit):
+        startCheckpoint(state, [out, csv], False)
+    monkeypatch.setattr(src.replace_fastx, 'replaceRecord', replaceRecord)
+    stats = replaceBase(testFastq, 'fastq', 'A', 'G', out, csv, startCheckpoint(state, [out, csv], True), every=2)
+    assert stats['reads'] == 5 and not os.path.exists(state)
+    expected = replaceBase(testFastq, 'fastq', 'A', 'G', str(tmp_path / 'full.fastq'), str(tmp_path / 'full.csv'))
+    assert stats == expected
+    with gzip.open(out, 'rt') as resumed:
+        assert resumed.read() == open(str(tmp_path / 'full.fastq')).read()
+    assert open(csv).read() == open(str(tmp_path / 'full.csv')).read()
+
+
+def test_resume_replace_bam(tmp_path, monkeypatch):
+    inp = pysam.AlignmentFile(os.path.join(os.path.dirname(__file__), 'test_psU.bam'), 'rb')
+    reads = list(inp)
+    inbam = str(tmp_path / 'in.bam')
+    with pysam.AlignmentFile(inbam, 'wb', template=inp) as out:
+        for i in range(30):
+            out.write(reads[i % 3])
+    csv = os.path.join(os.path.dirname(__file__), 'test_psU.csv')
+    outbam, state = str(tmp_path / 'out.bam'), str(tmp_path / 'out.json')
+    restoreAlignment = src.replace_bam.restoreAlignment
+    calls = []
+
+    def interrupted(read, replacement):
+        calls.append(read.query_name)
+        if len(calls) == 17:
+            raise KeyboardInterrupt
+        return restoreAlignment(read, replacement)
+
+    monkeypatch.setattr(src.replace_bam, 'restoreAlignment', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        replaceBam(inbam, outbam, csv, 2, startCheckpoint(state, [outbam], False), every=7)
+    monkeypatch.setattr(src.replace_bam, 'restoreAlignment', restoreAlignment)
+    stats = replaceBam(inbam, outbam, csv, 2, startCheckpoint(state, [outbam], True), every=7)
+    assert stats['alignments'] == 30 and stats['restored_bases'] == 3700
+    expected = [read.to_string() for read in pysam.AlignmentFile(os.path.join(os.path.dirname(__file__), 'test_psU_replaced.bam'), 'rb')]
+    assert [read.to_string() for read in pysam.AlignmentFile(outbam, 'rb')] == expected * 10
+
+
+def test_paired_output_format(tmp_path):
+    out1, out2 = str(tmp_path / 'o1.fa'), str(tmp_path / 'o2.fa')
+    written = filterPairedFastx(open(testFastq), open(testFastq), 'fastq', recordPredicate(long=5), 'both', out1, out2)
+    assert written == 5
+    assert open(out1).read(1) == '>' and len(list(SeqIO.parse(out2, 'fasta'))) == 5
+
+
+def test_paired_slice_closes_inputs(tmp_path, monkeypatch):
+    handles = []
+    openInput = src.slice_fastx.openInput
+
+    def opened(*args):
+        handle, format = openInput(*args)
+        handles.append(handle)
+        return handle, format
+
+    monkeypatch.setattr(src.slice_fastx, 'openInput', opened)
+    out1, out2 = str(tmp_path / 'o1.fq'), str(tmp_path / 'o2.fq')
+    assert src.slice_fastx.slicePairedFastx(testFastq, testFastq, out1, out2, (0, 5)) == 5
+    assert len(handles) == 2 and all(handle.closed for handle in handles)
+    assert all(len(record) == 5 for record in SeqIO.parse(out2, 'fastq'))
+
+
+def test_filter_bam_unindexed(tmp_path):
+    out = str(tmp_path / 'long.fa')
+    src.filter_bam.filterLength(os.path.join(os.path.dirname(__file__), 'test_psU.bam'), out, 500, 'long')
+    assert len(list(SeqIO.parse(out, 'fasta'))) == 2